@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+"""
+動画圧縮ツール ベンチマークスクリプト
+- chunks:   分割並列エンコード（--chunks）と従来の直列2-passの処理時間を比較
+- profiles: 複数プロファイルの同時出力（--profiles）とプロファイル毎の個別実行を比較
+- firstpass: Pass 1 の高速化（音声の省略・fastfirstpass・統計の再利用）による処理時間の削減と、
+            出力サイズ・SSIM が許容範囲内に収まることを確認
+- corpus:   lavfi で生成した再現可能な動画群 × 品質プリセット × 圧縮方式の処理時間・メモリ・サイズ精度を計測し、
+            JSON に保存・ベースラインと比較して性能の劣化を検出
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import platform
+import os
+import sys
+import subprocess
+import tempfile
+import shutil
+import time
+import resource
+from pathlib import Path
+
+class Colors:
+    RED = '\033[0;31m'
+    GREEN = '\033[0;32m'
+    YELLOW = '\033[1;33m'
+    BLUE = '\033[0;34m'
+    CYAN = '\033[0;36m'
+    NC = '\033[0m'
+
+SCRIPT_PATH = Path(__file__).parent / "compress_video.py"
+
+# corpus スイートの動画群（長さ・解像度・動きの複雑さの異なる lavfi ソース）
+CORPUS = [
+    {'name': 'static_720p', 'source': 'smptebars=size=1280x720:rate=30', 'duration': 20, 'target_mb': 1,
+     'description': '静止画に近い映像'},
+    {'name': 'testsrc_720p', 'source': 'testsrc2=size=1280x720:rate=30', 'duration': 30, 'target_mb': 3,
+     'description': '標準的な動き'},
+    {'name': 'mandelbrot_1080p', 'source': 'mandelbrot=size=1920x1080:rate=30', 'duration': 20, 'target_mb': 4,
+     'description': '細部の多い高解像度映像'},
+    {'name': 'noise_480p', 'source': 'testsrc2=size=854x480:rate=30,noise=alls=40:allf=t+u:all_seed=1',
+     'duration': 15, 'target_mb': 2, 'description': 'ノイズの多い映像（圧縮困難）'},
+    {'name': 'long_360p', 'source': 'testsrc2=size=640x360:rate=30', 'duration': 120, 'target_mb': 5,
+     'description': '長尺の低解像度映像'},
+]
+
+QUALITY_PRESETS = ['fast', 'medium', 'slow', 'high']
+
+# 圧縮方式とそれを選ぶための compress_video.py の引数
+STRATEGIES = {
+    'two_pass': ['--no-ladder'],
+    'ladder': [],
+    'chunks': ['--no-ladder', '--chunks', 'auto'],
+    'converge': ['--converge'],
+}
+
+def create_benchmark_video(work_dir, duration, size):
+    """ベンチマーク用の動画を作成（目標サイズを確実に超えるよう高ビットレート）"""
+    print(f"{Colors.YELLOW}ベンチマーク用動画を作成しています ({duration}秒, {size})...{Colors.NC}")
+
+    video_file = os.path.join(work_dir, "benchmark_source.mp4")
+    cmd = [
+        'ffmpeg', '-y', '-f', 'lavfi', '-i', f'testsrc2=duration={duration}:size={size}:rate=30',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0',
+        '-c:a', 'aac', video_file
+    ]
+    subprocess.run(cmd, capture_output=True, check=True)
+    return video_file
+
+def children_cpu_time():
+    """終了済み子プロセス（ffmpegを含む）の累積CPU時間（秒）"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run_case(name, commands, output_files, work_dir=None):
+    """1ケース（1つ以上のコマンド）を実行して処理時間・CPU時間・出力サイズを返す
+
+    work_dir を指定すると、出力キャッシュを無効にしてプローブキャッシュなどもケース毎に
+    work_dir 内の空のディレクトリを使う（キャッシュのヒットを計測せず、ユーザーのキャッシュも汚さない）。
+    """
+    print(f"{Colors.BLUE}実行中: {name}{Colors.NC}")
+
+    env = None
+    if work_dir is not None:
+        env = {**os.environ, 'XDG_CACHE_HOME': tempfile.mkdtemp(prefix='cache_', dir=work_dir)}
+        commands = [[*args, '--no-output-cache'] for args in commands]
+
+    start = time.perf_counter()
+    cpu_start = children_cpu_time()
+    for args in commands:
+        result = subprocess.run(['python3', str(SCRIPT_PATH), *args], capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            print(f"{Colors.RED}❌ 失敗: {name}{Colors.NC}")
+            print(result.stdout[-2000:])
+            return None
+    elapsed = time.perf_counter() - start
+    cpu_time = children_cpu_time() - cpu_start
+
+    size_mb = sum(os.path.getsize(f) for f in output_files) / (1024 * 1024)
+    print(f"{Colors.GREEN}✅ {name}: {elapsed:.2f}秒 (CPU {cpu_time:.2f}秒), {size_mb:.2f}MB{Colors.NC}")
+    return {'name': name, 'elapsed': elapsed, 'cpu_time': cpu_time, 'size_mb': size_mb}
+
+def scaled_clip(clip, scale):
+    """--duration-scale に合わせて長さと目標サイズを縮める（ビットレートはほぼ一定）"""
+    duration = max(1, round(clip['duration'] * scale))
+    target_mb = max(1, math.ceil(clip['target_mb'] * duration / clip['duration']))
+    return {**clip, 'duration': duration, 'target_mb': target_mb}
+
+def create_corpus_video(corpus_dir, clip):
+    """corpus の動画を作成（仕様のハッシュをファイル名に含め、同じ仕様なら再利用）"""
+    spec = json.dumps({k: clip[k] for k in ('source', 'duration')}, sort_keys=True)
+    digest = hashlib.blake2b(spec.encode(), digest_size=6).hexdigest()
+    video_file = os.path.join(corpus_dir, f"{clip['name']}-{digest}.mkv")
+    if os.path.exists(video_file):
+        return video_file
+
+    print(f"{Colors.YELLOW}corpus を作成しています: {clip['name']} ({clip['duration']}秒){Colors.NC}")
+    partial = video_file + '.partial'
+    cmd = [
+        'ffmpeg', '-y', '-f', 'lavfi', '-i', clip['source'],
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(clip['duration']), '-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0',
+        '-c:a', 'flac', '-f', 'matroska', partial
+    ]
+    subprocess.run(cmd, capture_output=True, check=True)
+    os.replace(partial, video_file)
+    return video_file
+
+def run_measured(args, env):
+    """compress_video.py を実行し、子孫プロセス（ffmpeg）を含む CPU 時間とピーク RSS を wait4 で取得"""
+    return measure_process(['python3', str(SCRIPT_PATH), *args], env)
+
+def measure_process(cmd, env=None):
+    """コマンドを実行し、処理時間・CPU時間・ピーク RSS・出力を返す"""
+    with tempfile.TemporaryFile() as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        log.seek(0)
+        output = log.read().decode('utf-8', errors='replace')
+    return {
+        'returncode': process.returncode,
+        'elapsed': elapsed,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        # Linux の ru_maxrss は KB 単位
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+        'output': output,
+    }
+
+def ffmpeg_version():
+    result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
+    return result.stdout.splitlines()[0] if result.stdout else 'unknown'
+
+def bench_corpus(args, work_dir):
+    """corpus × 品質プリセット × 圧縮方式の全組み合わせを計測"""
+    clips = [scaled_clip(clip, args.duration_scale) for clip in CORPUS
+             if not args.clips or clip['name'] in args.clips]
+    corpus_dir = args.corpus_dir or os.path.join(work_dir, 'corpus')
+    os.makedirs(corpus_dir, exist_ok=True)
+    output_dir = os.path.join(work_dir, 'outputs')
+    os.makedirs(output_dir)
+
+    # 出力キャッシュ・プローブキャッシュはベンチマーク専用にして、ユーザーのキャッシュを汚さない
+    env = {**os.environ, 'XDG_CACHE_HOME': os.path.join(work_dir, 'cache')}
+
+    results = []
+    for clip in clips:
+        source = create_corpus_video(corpus_dir, clip)
+        for preset in args.presets:
+            for strategy in args.strategies:
+                name = f"{clip['name']}/{preset}/{strategy}"
+                output_file = os.path.join(output_dir, f"{clip['name']}_{preset}_{strategy}.mp4")
+                print(f"{Colors.BLUE}実行中: {name}{Colors.NC}")
+                measured = run_measured(
+                    [source, output_file, '-s', str(clip['target_mb']), '-q', preset, '--no-output-cache',
+                     *STRATEGIES[strategy]],
+                    env
+                )
+                result = {
+                    'clip': clip['name'], 'preset': preset, 'strategy': strategy,
+                    'duration': clip['duration'], 'target_mb': clip['target_mb'],
+                    'ok': measured['returncode'] == 0 and os.path.exists(output_file),
+                    'elapsed': measured['elapsed'], 'cpu_time': measured['cpu_time'],
+                    'peak_rss_mb': measured['peak_rss_mb'],
+                }
+                if not result['ok']:
+                    print(f"{Colors.RED}❌ 失敗: {name}{Colors.NC}")
+                    print(measured['output'][-2000:])
+                    results.append(result)
+                    continue
+
+                size_mb = os.path.getsize(output_file) / (1024 * 1024)
+                result.update({
+                    'realtime_factor': clip['duration'] / measured['elapsed'],
+                    'size_mb': size_mb,
+                    'size_error_pct': (size_mb / clip['target_mb'] - 1) * 100,
+                    'within_target': size_mb <= clip['target_mb'],
+                })
+                color = Colors.GREEN if result['within_target'] else Colors.YELLOW
+                print(f"{color}✅ {name}: {result['elapsed']:.2f}秒 (CPU {result['cpu_time']:.2f}秒, "
+                      f"{result['realtime_factor']:.2f}x 実時間, RSS {result['peak_rss_mb']:.0f}MB), "
+                      f"{size_mb:.2f}MB / 目標 {clip['target_mb']}MB ({result['size_error_pct']:+.1f}%){Colors.NC}")
+                os.remove(output_file)
+                results.append(result)
+
+    return {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'ffmpeg': ffmpeg_version(),
+            'duration_scale': args.duration_scale,
+        },
+        'results': results,
+    }
+
+def compare_with_baseline(report, baseline, tolerance):
+    """ベースラインと比較し、処理時間・CPU時間の悪化や目標サイズ超過をリストアップ"""
+    if baseline['meta'].get('duration_scale') != report['meta']['duration_scale']:
+        print(f"{Colors.YELLOW}⚠️  ベースラインと --duration-scale が異なるため比較できません{Colors.NC}")
+        return []
+    for field in ('cpu_count', 'ffmpeg'):
+        if baseline['meta'].get(field) != report['meta'][field]:
+            print(f"{Colors.YELLOW}⚠️  ベースラインと {field} が異なります: "
+                  f"{baseline['meta'].get(field)} → {report['meta'][field]}{Colors.NC}")
+
+    baseline_results = {(r['clip'], r['preset'], r['strategy']): r for r in baseline['results']}
+    regressions = []
+    print()
+    print(f"{Colors.CYAN}ベースラインとの比較（許容: +{tolerance * 100:.0f}%）{Colors.NC}")
+    print("=" * 50)
+    for result in report['results']:
+        key = (result['clip'], result['preset'], result['strategy'])
+        base = baseline_results.get(key)
+        if base is None or not base['ok']:
+            continue
+        name = '/'.join(key)
+        if not result['ok']:
+            regressions.append(f"{name}: 失敗するようになりました")
+            continue
+
+        wall_ratio = result['elapsed'] / base['elapsed']
+        cpu_ratio = result['cpu_time'] / base['cpu_time'] if base['cpu_time'] else 1.0
+        print(f"{name}: 処理時間 {wall_ratio:.2f}倍, CPU時間 {cpu_ratio:.2f}倍, "
+              f"サイズ誤差 {base['size_error_pct']:+.1f}% → {result['size_error_pct']:+.1f}%")
+        if wall_ratio > 1 + tolerance:
+            regressions.append(f"{name}: 処理時間が {wall_ratio:.2f}倍になりました")
+        if cpu_ratio > 1 + tolerance:
+            regressions.append(f"{name}: CPU時間が {cpu_ratio:.2f}倍になりました")
+        if base['within_target'] and not result['within_target']:
+            regressions.append(f"{name}: 目標サイズを超えるようになりました ({result['size_mb']:.2f}MB)")
+    return regressions
+
+def run_corpus_suite(args, work_dir):
+    report = bench_corpus(args, work_dir)
+    results = [r for r in report['results'] if r['ok']]
+
+    print()
+    print(f"{Colors.CYAN}ベンチマーク結果{Colors.NC}")
+    print("=" * 50)
+    for preset in args.presets:
+        for strategy in args.strategies:
+            cases = [r for r in results if r['preset'] == preset and r['strategy'] == strategy]
+            if not cases:
+                continue
+            print(f"{preset}/{strategy}: 合計 {sum(r['elapsed'] for r in cases):.2f}秒, "
+                  f"平均 {sum(r['realtime_factor'] for r in cases) / len(cases):.2f}x 実時間, "
+                  f"最大 RSS {max(r['peak_rss_mb'] for r in cases):.0f}MB, "
+                  f"目標サイズ内 {sum(r['within_target'] for r in cases)}/{len(cases)}, "
+                  f"平均サイズ誤差 {sum(r['size_error_pct'] for r in cases) / len(cases):+.1f}%")
+    failed = len(report['results']) - len(results)
+    if failed:
+        print(f"{Colors.RED}失敗: {failed}件{Colors.NC}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"{Colors.BLUE}結果を保存しました:{Colors.NC} {args.json}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{Colors.RED}性能の劣化を検出しました:{Colors.NC}")
+            for regression in regressions:
+                print(f"  - {regression}")
+        else:
+            print(f"{Colors.GREEN}ベースラインからの劣化はありません{Colors.NC}")
+
+    if failed or regressions:
+        sys.exit(1)
+
+def parse_list(choices):
+    """カンマ区切りのリストを解釈（choices 以外の値はエラー）"""
+    def parse(value):
+        items = [item.strip() for item in value.split(',') if item.strip()]
+        unknown = [item for item in items if item not in choices]
+        if unknown or not items:
+            raise argparse.ArgumentTypeError(
+                f"{', '.join(unknown) or value} は指定できません（{', '.join(choices)}）")
+        return items
+    return parse
+
+def measure_ssim(output_file, source):
+    """出力と元動画の SSIM（All）を計算"""
+    result = subprocess.run(['ffmpeg', '-i', output_file, '-i', source, '-lavfi', 'ssim', '-f', 'null', '-'],
+                            capture_output=True, text=True)
+    for line in reversed(result.stderr.splitlines()):
+        if 'All:' in line:
+            return float(line.split('All:')[1].split()[0])
+    return None
+
+def bench_firstpass(args, work_dir, source):
+    """Pass 1 の設定毎に 2-pass エンコードの処理時間・サイズ・SSIM を比較
+    
+    - full:     Pass 2 と同じ設定で音声も処理（x264 の fastfirstpass も無効）
+    - previous: 音声も処理する従来の Pass 1（ffmpeg 既定の fastfirstpass のみ）
+    - fast:     現在の Pass 1（-an / -sn / -dn と fastfirstpass）
+    - cached:   fast の統計を再利用して Pass 2 のみ実行（Pass 1 統計のキャッシュヒット時）
+    """
+    sys.path.insert(0, str(SCRIPT_PATH.parent))
+    from compress_video import VideoCompressor
+
+    compressor = VideoCompressor(verbose=False)
+    duration = compressor.get_video_duration(compressor.get_video_info(source, use_cache=False))
+    bitrate = compressor.calculate_target_bitrate(args.size, duration)
+    print(f"目標ビットレート: {bitrate}bps ({args.size}MB)")
+
+    def previous_first_pass(cmd, fastfirstpass=None):
+        """-an / -sn / -dn と fastfirstpass の指定を除いた Pass 1（fastfirstpass を渡すとその値を明示）"""
+        cmd = [arg for arg in cmd if arg not in ('-an', '-sn', '-dn')]
+        index = cmd.index('-fastfirstpass')
+        del cmd[index:index + 2]
+        if fastfirstpass is not None:
+            cmd[index:index] = ['-fastfirstpass', fastfirstpass]
+        return cmd
+
+    results = []
+    for preset in args.presets:
+        preset_config = compressor.quality_presets[preset]
+        fast_passlog = None
+        for variant in ('full', 'previous', 'fast', 'cached'):
+            passlog_dir = os.path.join(work_dir, f"passlog_{preset}_{variant}")
+            if variant == 'cached':
+                shutil.copytree(fast_passlog, passlog_dir)
+            else:
+                os.makedirs(passlog_dir)
+            output_file = os.path.join(work_dir, f"firstpass_{preset}_{variant}.mp4")
+            commands = compressor.two_pass_commands(source, output_file, bitrate, preset_config,
+                                                    os.path.join(passlog_dir, 'ffmpeg2pass'),
+                                                    reuse_first_pass=variant == 'cached')
+            cmds = [cmd for cmd, _ in commands]
+            if variant == 'full':
+                cmds[0] = previous_first_pass(cmds[0], fastfirstpass='0')
+            elif variant == 'previous':
+                cmds[0] = previous_first_pass(cmds[0])
+
+            name = f"{preset}/{variant}"
+            print(f"{Colors.BLUE}実行中: {name}{Colors.NC}")
+            elapsed = cpu_time = 0.0
+            first_pass_time = None
+            for cmd in cmds:
+                measured = measure_process(cmd)
+                if measured['returncode'] != 0:
+                    print(f"{Colors.RED}❌ 失敗: {name}{Colors.NC}")
+                    print(measured['output'][-2000:])
+                    return results
+                if '-pass' in cmd and cmd[cmd.index('-pass') + 1] == '1':
+                    first_pass_time = measured['elapsed']
+                elapsed += measured['elapsed']
+                cpu_time += measured['cpu_time']
+            if variant == 'fast':
+                fast_passlog = passlog_dir
+
+            result = {
+                'preset': preset, 'variant': variant, 'elapsed': elapsed, 'cpu_time': cpu_time,
+                'first_pass_time': first_pass_time,
+                'size_mb': os.path.getsize(output_file) / (1024 * 1024),
+                'ssim': measure_ssim(output_file, source),
+            }
+            first_pass = f"Pass 1 {first_pass_time:.2f}秒" if first_pass_time is not None else "Pass 1 なし"
+            print(f"{Colors.GREEN}✅ {name}: {elapsed:.2f}秒 ({first_pass}, CPU {cpu_time:.2f}秒), "
+                  f"{result['size_mb']:.3f}MB, SSIM {result['ssim']}{Colors.NC}")
+            results.append(result)
+    return results
+
+def run_firstpass_suite(args, work_dir, source):
+    results = bench_firstpass(args, work_dir, source)
+
+    print()
+    print(f"{Colors.CYAN}ベンチマーク結果（full との比較、許容: サイズ ±{args.size_tolerance}%, "
+          f"SSIM -{args.ssim_tolerance}）{Colors.NC}")
+    print("=" * 50)
+    failures = []
+    for preset in args.presets:
+        cases = {r['variant']: r for r in results if r['preset'] == preset}
+        reference = cases.get('full')
+        if reference is None:
+            continue
+        for variant, result in cases.items():
+            size_diff = (result['size_mb'] / reference['size_mb'] - 1) * 100
+            ssim_diff = (result['ssim'] or 0) - (reference['ssim'] or 0)
+            saving = (1 - result['elapsed'] / reference['elapsed']) * 100
+            print(f"{preset}/{variant}: 処理時間 {result['elapsed']:.2f}秒 ({saving:.1f}% 削減), "
+                  f"サイズ {size_diff:+.2f}%, SSIM {ssim_diff:+.4f}")
+            if abs(size_diff) > args.size_tolerance or ssim_diff < -args.ssim_tolerance:
+                failures.append(f"{preset}/{variant}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'bitrate_size_mb': args.size, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"{Colors.BLUE}結果を保存しました:{Colors.NC} {args.json}")
+
+    if failures:
+        print(f"{Colors.RED}許容範囲を超えました: {', '.join(failures)}{Colors.NC}")
+        sys.exit(1)
+    print(f"{Colors.GREEN}サイズ・画質とも許容範囲内です{Colors.NC}")
+
+def bench_chunks(args, work_dir, source):
+    """直列 2-pass と分割並列エンコードを比較"""
+    serial_output = os.path.join(work_dir, 'serial.mp4')
+    chunked_output = os.path.join(work_dir, 'chunked.mp4')
+    return [
+        run_case("直列 2-pass", [[source, serial_output, '-s', str(args.size)]], [serial_output], work_dir),
+        run_case(f"分割並列 (--chunks {args.chunks})",
+                 [[source, chunked_output, '-s', str(args.size), '--chunks', args.chunks]], [chunked_output],
+                 work_dir)
+    ]
+
+def bench_profiles(args, work_dir, source):
+    """プロファイル毎の個別実行と、1回のデコードからの同時出力を比較"""
+    # 入力より小さい目標サイズになるよう、ベンチマーク専用のプロファイルを用意
+    presets = ['fast', 'medium', 'slow']
+    profiles = {
+        f"bench{i}": {'target_size_mb': args.size * (i + 1), 'quality_preset': presets[i % len(presets)]}
+        for i in range(args.profile_count)
+    }
+    config_file = os.path.join(work_dir, 'benchmark_config.json')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump({'default_settings': {}, 'profiles': profiles}, f)
+
+    stem = Path(source).stem
+    loop_dir = os.path.join(work_dir, 'loop')
+    fanout_dir = os.path.join(work_dir, 'fanout')
+    os.makedirs(loop_dir)
+
+    loop_commands = [
+        [source, os.path.join(loop_dir, f"{stem}_{name}.mp4"), '-p', name, '--config', config_file]
+        for name in profiles
+    ]
+    fanout_command = [source, '--profiles', ','.join(profiles), '--config', config_file, '-o', fanout_dir]
+    return [
+        # 1回のデコードの効果だけを比べるため、どちらもキャッシュを使わずに計測する
+        run_case(f"プロファイル毎に実行 ({len(profiles)}回)", loop_commands,
+                 [os.path.join(loop_dir, f"{stem}_{name}.mp4") for name in profiles], work_dir),
+        run_case("同時出力 (--profiles)", [fanout_command],
+                 [os.path.join(fanout_dir, f"{stem}_{name}.mp4") for name in profiles], work_dir)
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="動画圧縮ツール ベンチマーク")
+    parser.add_argument('--suite', choices=['chunks', 'profiles', 'corpus', 'firstpass'], default='chunks',
+                        help='実行するベンチマーク（デフォルト: chunks）')
+    parser.add_argument('--duration', type=int, default=120, help='ベンチマーク動画の長さ（秒、デフォルト: 120）')
+    parser.add_argument('--resolution', default='1280x720', help='ベンチマーク動画の解像度（デフォルト: 1280x720）')
+    parser.add_argument('-s', '--size', type=int, default=10, help='目標サイズ（MB、デフォルト: 10）')
+    parser.add_argument('--chunks', default='auto', help='分割エンコードのセグメント数（デフォルト: auto）')
+    parser.add_argument('--profile-count', type=int, default=3,
+                        help='profiles で同時に出力するプロファイル数（デフォルト: 3）')
+    parser.add_argument('--clips', type=parse_list([clip['name'] for clip in CORPUS]),
+                        help='corpus で使う動画（カンマ区切り、デフォルト: 全て）')
+    parser.add_argument('--presets', type=parse_list(QUALITY_PRESETS), default=QUALITY_PRESETS,
+                        help='corpus / firstpass で計測する品質プリセット（カンマ区切り、デフォルト: 全て）')
+    parser.add_argument('--strategies', type=parse_list(list(STRATEGIES)), default=list(STRATEGIES),
+                        help=f"corpus で計測する圧縮方式（{', '.join(STRATEGIES)}、デフォルト: 全て）")
+    parser.add_argument('--duration-scale', type=float, default=1.0,
+                        help='corpus の動画の長さの倍率（目標サイズも比例して縮小、デフォルト: 1.0）')
+    parser.add_argument('--corpus-dir', help='corpus の動画を保存・再利用するディレクトリ（デフォルト: 毎回作成）')
+    parser.add_argument('--json', help='corpus の結果を保存する JSON ファイル')
+    parser.add_argument('--baseline', help='比較するベースラインの JSON ファイル（劣化があれば終了コード 1）')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='ベースラインからの処理時間・CPU時間の許容増加率（デフォルト: 0.15）')
+    parser.add_argument('--size-tolerance', type=float, default=2.0,
+                        help='firstpass で許容する出力サイズの差（%%、デフォルト: 2.0）')
+    parser.add_argument('--ssim-tolerance', type=float, default=0.002,
+                        help='firstpass で許容する SSIM の低下（デフォルト: 0.002）')
+    args = parser.parse_args()
+
+    if not shutil.which('ffmpeg'):
+        print(f"{Colors.RED}エラー: ffmpegがインストールされていません{Colors.NC}")
+        sys.exit(1)
+
+    print(f"{Colors.CYAN}動画圧縮ツール ベンチマーク ({args.suite}){Colors.NC}")
+    print("=" * 50)
+    print(f"CPUコア数: {os.cpu_count()}")
+
+    work_dir = tempfile.mkdtemp(prefix='compressor_benchmark_')
+    try:
+        if args.suite == 'corpus':
+            run_corpus_suite(args, work_dir)
+            return
+
+        source = create_benchmark_video(work_dir, args.duration, args.resolution)
+
+        if args.suite == 'firstpass':
+            run_firstpass_suite(args, work_dir, source)
+            return
+        if args.suite == 'profiles':
+            results = bench_profiles(args, work_dir, source)
+        else:
+            results = bench_chunks(args, work_dir, source)
+
+        print()
+        print(f"{Colors.CYAN}ベンチマーク結果{Colors.NC}")
+        print("=" * 50)
+        for result in results:
+            if result:
+                print(f"{result['name']}: {result['elapsed']:.2f}秒 (CPU {result['cpu_time']:.2f}秒) / "
+                      f"{result['size_mb']:.2f}MB")
+
+        baseline, candidate = results
+        if baseline and candidate:
+            print(f"{Colors.GREEN}高速化: {baseline['elapsed'] / candidate['elapsed']:.2f}倍, "
+                  f"CPU時間削減: {(1 - candidate['cpu_time'] / baseline['cpu_time']) * 100:.1f}%{Colors.NC}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -13,8 +13,36 @@ import shutil
 from pathlib import Path
 import json
 import re
+import asyncio
+import contextvars
+import importlib
+import hashlib
+import sqlite3
+import math
+import fnmatch
 import time
 import threading
+import tempfile
+import signal
+import uuid
+import errno
+import queue
+import heapq
+import itertools
+import socketserver
+import urllib.parse
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import deque
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from contextlib import contextmanager, ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 class Colors:
     RED = '\033[0;31m'
@@ -25,42 +53,1433 @@ class Colors:
     MAGENTA = '\033[0;35m'
     NC = '\033[0m'  # No Color
 
-class ProgressBar:
-    def __init__(self, total_duration):
-        self.total_duration = total_duration
-        self.current_time = 0
+class CompressionError(Exception):
+    """圧縮処理のエラーの基底クラス"""
+
+class FFmpegNotFoundError(CompressionError):
+    """ffmpeg / ffprobe が見つからない"""
+
+class InputNotFoundError(CompressionError):
+    """入力ファイル・ディレクトリが見つからない"""
+
+class ProfileNotFoundError(CompressionError):
+    """指定されたプロファイルが設定ファイルにない"""
+
+class ProbeError(CompressionError):
+    """ffprobe による動画情報の取得に失敗"""
+    
+    def __init__(self, message, stderr=''):
+        super().__init__(message)
+        self.stderr = stderr
+
+class EncodeError(CompressionError):
+    """ffmpeg の実行に失敗（stderr は末尾の数行）"""
+    
+    def __init__(self, message, returncode=None, stderr=''):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+class JobCancelledError(CompressionError):
+    """ジョブサーバーでジョブが取り消された"""
+
+class QueueFullError(CompressionError):
+    """ジョブサーバーの待ち行列が満杯で受け付けられない"""
+
+class CompressionResult:
+    """1ファイルの圧縮結果（strategy は copy / cache / remux / drop_tracks / audio / two_pass / crf / segmented）"""
+    
+    def __init__(self, input_file, output_file, input_size, output_size, target_size_mb, strategy,
+                 duration=None, video_bitrate=None, iterations=1, elapsed=0.0, bytes_moved=0, io=None,
+                 quality=None):
+        self.input_file = str(input_file)
+        self.output_file = str(output_file)
+        self.input_size = input_size
+        self.output_size = output_size
+        self.target_size_mb = target_size_mb
+        self.strategy = strategy
+        self.duration = duration
+        self.video_bitrate = video_bitrate
+        self.iterations = iterations
+        self.elapsed = elapsed
+        # 出力の配置・コピーで実際に転送したバイト数と、方法毎のバイト数
+        self.bytes_moved = bytes_moved
+        self.io = dict(io or {})
+        # サンプリングによる品質検証の結果（ssim / ssim_min / psnr / psnr_min / samples、未検証なら None）
+        self.quality = quality
+    
+    @property
+    def input_size_mb(self):
+        return self.input_size / (1024 * 1024)
+    
+    @property
+    def output_size_mb(self):
+        return self.output_size / (1024 * 1024)
+    
+    @property
+    def compression_ratio(self):
+        """削減率（%）"""
+        return 100 - (self.output_size * 100 / self.input_size) if self.input_size else 0.0
+    
+    @property
+    def within_target(self):
+        return self.output_size_mb <= self.target_size_mb
+    
+    def to_dict(self):
+        return {
+            **vars(self),
+            'input_size_mb': self.input_size_mb,
+            'output_size_mb': self.output_size_mb,
+            'compression_ratio': self.compression_ratio,
+            'within_target': self.within_target
+        }
+
+class ProgressDashboard:
+    """全ジョブの進捗イベントを1か所で描画するレンダラー
+    
+    描画は進捗イベントを受け取った時だけ、かつ最小間隔で間引いて行う。
+    TTY では1行のステータスを上書きし、それ以外（CIログなど）では
+    log_interval 秒ごとに1行のログを出力する。
+    """
+    
+    def __init__(self, stream=None, refresh_interval=0.25, log_interval=10.0):
+        self.stream = stream or sys.stdout
+        self.is_tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.min_interval = refresh_interval if self.is_tty else log_interval
         self.spinner_chars = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
         self.spinner_index = 0
-        self.is_running = True
-        
-    def update_progress(self, current_time):
-        self.current_time = current_time
-        
+        self.jobs = {}
+        self.next_job_id = 0
+        self.last_draw = 0.0
+        self.status_visible = False
+        self.lock = threading.Lock()
+    
+    def start_job(self, label, duration):
+        """ジョブを登録してIDを返す"""
+        with self.lock:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.jobs[job_id] = {'label': label, 'duration': duration, 'event': None}
+            return job_id
+    
+    def update(self, job_id, event):
+        """進捗イベントを反映（前回の描画から最小間隔が経過していれば再描画）"""
+        with self.lock:
+            if job_id not in self.jobs:
+                return
+            self.jobs[job_id]['event'] = event
+            now = time.monotonic()
+            if now - self.last_draw >= self.min_interval:
+                self.last_draw = now
+                self._draw()
+    
+    def finish_job(self, job_id, success=True):
+        """ジョブの完了を表示して登録を解除"""
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            if job is None:
+                return
+            self._clear_status()
+            if success:
+                line = (f"{Colors.GREEN}✓{Colors.NC} {self.draw_progress_bar(100)} 100.0% "
+                        f"{Colors.GREEN}完了{Colors.NC} {job['label']}")
+            else:
+                line = f"{Colors.RED}✗{Colors.NC} {job['label']} {Colors.RED}失敗{Colors.NC}"
+            self.stream.write(line + "\n")
+            if self.jobs and self.is_tty:
+                self._draw()
+            self.stream.flush()
+    
+    def print(self, message):
+        """ステータス行を崩さずにメッセージを出力"""
+        with self.lock:
+            self._clear_status()
+            self.stream.write(message + "\n")
+            if self.jobs and self.is_tty:
+                self._draw()
+            self.stream.flush()
+    
     def draw_progress_bar(self, progress, width=40):
         filled = int(width * progress / 100)
         bar = "█" * filled + "▒" * (width - filled)
         return f"[{bar}]"
+    
+    def _clear_status(self):
+        if self.status_visible:
+            self.stream.write("\r\033[K")
+            self.status_visible = False
+    
+    def _job_stats(self, job):
+        event = job['event']
+        progress = event.progress if event else 0.0
+        speed = event.speed if event and event.speed else 0.0
+        fps = event.fps if event and event.fps else 0.0
+        out_time = event.out_time if event else 0.0
+        remaining = max(0.0, job['duration'] - out_time)
+        eta = remaining / speed if speed > 0 else None
+        return progress, fps, speed, remaining, eta
+    
+    @staticmethod
+    def _format_eta(eta):
+        if eta is None:
+            return "--:--"
+        return f"{int(eta // 60):02d}:{int(eta % 60):02d}"
+    
+    def _draw(self):
+        if not self.jobs:
+            return
+        stats = [(job, *self._job_stats(job)) for job in self.jobs.values()]
+        
+        # 全体のスループットとETA（残りのメディア時間 / 合計速度）
+        total_fps = sum(fps for _, _, fps, _, _, _ in stats)
+        total_speed = sum(speed for _, _, _, speed, _, _ in stats)
+        total_remaining = sum(remaining for _, _, _, _, remaining, _ in stats)
+        total_eta = total_remaining / total_speed if total_speed > 0 else None
         
-    def animate_spinner(self):
-        while self.is_running:
-            progress = min(self.current_time / self.total_duration * 100, 100) if self.total_duration > 0 else 0
+        if len(stats) == 1:
+            job, progress, fps, speed, _, eta = stats[0]
+            summary = (f"{self.draw_progress_bar(progress)} {progress:.1f}% "
+                       f"{fps:.0f}fps {speed:.2f}x ETA {self._format_eta(eta)} {job['label']}")
+        else:
+            per_job = ' · '.join(f"{job['label']} {progress:.0f}%" for job, progress, *_ in stats)
+            summary = (f"[{len(stats)}ジョブ] {total_fps:.0f}fps {total_speed:.2f}x "
+                       f"ETA {self._format_eta(total_eta)} | {per_job}")
+        
+        if self.is_tty:
             spinner = self.spinner_chars[self.spinner_index % len(self.spinner_chars)]
-            progress_bar = self.draw_progress_bar(progress)
-            
-            elapsed_mins = int(self.current_time // 60)
-            elapsed_secs = int(self.current_time % 60)
-            
-            print(f"\r{Colors.CYAN}{spinner}{Colors.NC} {progress_bar} {progress:.1f}% "
-                  f"({elapsed_mins:02d}:{elapsed_secs:02d})", end='', flush=True)
-            
             self.spinner_index += 1
-            time.sleep(0.1)
+            width = shutil.get_terminal_size().columns
+            self.stream.write(f"\r\033[K{Colors.CYAN}{spinner}{Colors.NC} {summary[:max(10, width - 3)]}")
+            self.status_visible = True
+        else:
+            self.stream.write(f"進捗: {summary}\n")
+        self.stream.flush()
+
+class ProgressEvent:
+    """ffmpeg -progress の1ブロック分の進捗"""
+    
+    def __init__(self, fields, duration=0):
+        self.frame = self._parse_number(fields.get('frame'), int)
+        self.fps = self._parse_number(fields.get('fps'))
+        # bitrate は "1234.5kbits/s"、speed は "1.5x" 形式
+        self.bitrate_kbps = self._parse_number(fields.get('bitrate', '').replace('kbits/s', ''))
+        self.speed = self._parse_number(fields.get('speed', '').rstrip('x'))
+        self.total_size = self._parse_number(fields.get('total_size'), int)
+        
+        # out_time_ms も実際はマイクロ秒単位
+        out_time_us = self._parse_number(fields.get('out_time_us') or fields.get('out_time_ms'), int)
+        self.out_time = max(0.0, out_time_us / 1000000) if out_time_us is not None else 0.0
+        self.duration = duration
+        self.done = fields.get('progress') == 'end'
+    
+    @staticmethod
+    def _parse_number(value, cast=float):
+        """数値に変換（N/A や空文字は None）"""
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+    
+    @property
+    def progress(self):
+        """進捗率（0〜100）"""
+        if self.done:
+            return 100.0
+        if self.duration <= 0:
+            return 0.0
+        return min(self.out_time / self.duration * 100, 100.0)
+
+class Span:
+    """計測区間（ffprobe・ffmpeg の各パス・コピー・ジョブ全体）の記録
+    
+    cpu_time は区間内の Python スレッドの CPU 時間と、区間内で終了した ffmpeg / ffprobe の
+    CPU 時間の合計。asyncio で実行した区間では計測できないため None になる。
+    """
+    
+    def __init__(self, stage, name=None, job_id=None, attributes=None, measure_cpu=True):
+        self.stage = stage
+        self.name = name or stage
+        self.job_id = job_id
+        self.attributes = dict(attributes or {})
+        self.started_at = time.time()
+        self.wall_time = None
+        self.cpu_time = None
+        self.fps = None
+        self.speed = None
+        self.input_bytes = None
+        self.output_bytes = None
+        self.status = 'ok'
+        self.error = None
+        self.child_cpu_time = 0.0
+        # 出力の配置・コピーの方法毎のバイト数（rename / link / reflink / copy_file_range / sendfile / copy）
+        self.io = {}
+        self._start = time.perf_counter()
+        self._thread_cpu_start = time.thread_time() if measure_cpu else None
+    
+    def add_child_usage(self, usage):
+        """終了した子プロセスの rusage（os.wait4 の戻り値）を加算"""
+        self.child_cpu_time += usage.ru_utime + usage.ru_stime
+    
+    def add_io(self, method, size):
+        self.io[method] = self.io.get(method, 0) + size
+    
+    @property
+    def bytes_moved(self):
+        """実際にデータを転送したバイト数（rename・リンク・reflink は含まない）"""
+        return sum(size for method, size in self.io.items() if method in DATA_COPY_METHODS)
+    
+    def record_progress(self, event):
+        """ffmpeg の進捗から平均fps・速度を記録（-progress の値は開始からの平均）"""
+        if event.fps is not None:
+            self.fps = event.fps
+        if event.speed is not None:
+            self.speed = event.speed
+    
+    def finish(self, error=None):
+        self.wall_time = time.perf_counter() - self._start
+        if self._thread_cpu_start is not None:
+            self.cpu_time = time.thread_time() - self._thread_cpu_start + self.child_cpu_time
+        if error is not None:
+            self.status = 'cancelled' if isinstance(error, (KeyboardInterrupt, asyncio.CancelledError)) else 'error'
+            self.error = str(error) or type(error).__name__
+    
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'name': self.name,
+            'job_id': self.job_id,
+            'started_at': self.started_at,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'fps': self.fps,
+            'speed': self.speed,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'bytes_moved': self.bytes_moved,
+            'io': self.io,
+            'status': self.status,
+            'error': self.error,
+            **self.attributes
+        }
+
+class Telemetry:
+    """計測区間をフックに配信する
+    
+    フックは on_span(span) メソッド（任意で close()）を持つオブジェクトか、span を受け取る
+    callable。区間は入れ子にでき、子の ffmpeg の CPU 時間は親（ジョブ）にも加算される。
+    """
+    
+    def __init__(self):
+        self.hooks = []
+        self.lock = threading.Lock()
+        self._current = contextvars.ContextVar('telemetry_span', default=None)
+    
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+    
+    def current(self):
+        """実行中の計測区間（なければ None）"""
+        return self._current.get()
+    
+    @contextmanager
+    def span(self, stage, name=None, measure_cpu=True, **attributes):
+        parent = self._current.get()
+        if parent is not None:
+            # ジョブの属性（プリセット・入力ファイルなど）を子の区間にも付ける
+            attributes = {**parent.attributes, **attributes}
+            job_id = parent.job_id
+        else:
+            job_id = uuid.uuid4().hex[:12] if stage == 'job' else None
+        span = Span(stage, name, job_id, attributes, measure_cpu)
+        token = self._current.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._current.reset(token)
+            span.finish(error)
+            if parent is not None:
+                # 並列セグメントのスレッドからも加算されるためロックする
+                with self.lock:
+                    parent.child_cpu_time += span.child_cpu_time
+                    for method, size in span.io.items():
+                        parent.add_io(method, size)
+            self.emit(span)
+    
+    def emit(self, span):
+        """全フックに区間を渡す（フックの失敗は圧縮処理に影響させない）"""
+        for hook in self.hooks:
+            try:
+                if hasattr(hook, 'on_span'):
+                    hook.on_span(span)
+                else:
+                    hook(span)
+            except Exception as e:
+                print(f"{Colors.YELLOW}警告: テレメトリのフックでエラーが発生しました - {e}{Colors.NC}",
+                      file=sys.stderr)
+    
+    def close(self):
+        for hook in self.hooks:
+            if hasattr(hook, 'close'):
+                hook.close()
+
+class JsonLinesTelemetryHook:
+    """計測区間を1行1件の JSON として追記"""
+    
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.lock = threading.Lock()
+    
+    def on_span(self, span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n'
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+class PrometheusTextfileHook:
+    """node_exporter の textfile collector 用に、段階・プリセット別の累積値を .prom ファイルに書き出す"""
+    
+    PREFIX = 'video_compressor'
+    
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.lock = threading.Lock()
+        self.counters = self._load()
+    
+    def _load(self):
+        """既存のファイルから累積値を引き継ぐ（CLI を1ファイルずつ起動してもカウンタが戻らないように）"""
+        counters = {}
+        try:
+            lines = self.path.read_text(encoding='utf-8').splitlines()
+        except OSError:
+            return counters
+        pattern = re.compile(rf'^{self.PREFIX}_(\w+)\{{(.*)\}} (\S+)$')
+        for line in lines:
+            match = pattern.match(line)
+            if not match:
+                continue
+            labels = tuple(sorted(
+                (key, re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value))
+                for key, value in re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2))
+            ))
+            try:
+                counters[(match.group(1), labels)] = float(match.group(3))
+            except ValueError:
+                continue
+        return counters
+    
+    def _add(self, metric, labels, value):
+        if value is None:
+            return
+        key = (metric, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def on_span(self, span):
+        labels = {'stage': span.stage, 'preset': str(span.attributes.get('preset', ''))}
+        with self.lock:
+            self._add('stage_runs_total', {**labels, 'status': span.status}, 1)
+            self._add('stage_seconds_total', labels, span.wall_time)
+            self._add('stage_cpu_seconds_total', labels, span.cpu_time)
+            self._add('stage_input_bytes_total', labels, span.input_bytes)
+            self._add('stage_output_bytes_total', labels, span.output_bytes)
+            if span.stage != 'job':
+                # ジョブには子の区間の値が合算されているため、二重に数えないよう段階毎の値だけを足す
+                for method, size in span.io.items():
+                    self._add('io_bytes_total', {**labels, 'method': method}, size)
+            if span.stage == 'job':
+                strategy = str(span.attributes.get('strategy', ''))
+                self._add('jobs_total', {'preset': labels['preset'], 'strategy': strategy, 'status': span.status}, 1)
+            self.write()
+    
+    def write(self):
+        """一時ファイルに書いてから置き換え、collector が書きかけのファイルを読まないようにする"""
+        lines = []
+        for metric in sorted({metric for metric, _ in self.counters}):
+            lines.append(f"# TYPE {self.PREFIX}_{metric} counter")
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != metric:
+                    continue
+                label_text = ','.join(f'{key}="{self._escape(value_)}"' for key, value_ in labels)
+                lines.append(f"{self.PREFIX}_{metric}{{{label_text}}} {value}")
+        temp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        temp_path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        os.replace(temp_path, self.path)
+    
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def load_telemetry_hook(spec):
+    """'モジュール:名前' 形式の指定からフックを読み込む（クラスなら引数なしでインスタンス化する）"""
+    module_name, _, attribute = spec.partition(':')
+    if not module_name or not attribute:
+        raise CompressionError(f"テレメトリのフックは モジュール:名前 の形式で指定してください: {spec}")
+    try:
+        hook = getattr(importlib.import_module(module_name), attribute)
+    except (ImportError, AttributeError) as e:
+        raise CompressionError(f"テレメトリのフックを読み込めません: {spec} - {e}") from e
+    return hook() if isinstance(hook, type) else hook
+
+# linux/fs.h の FICLONE（btrfs・XFS などでデータブロックを共有するコピー）
+FICLONE = 0x40049409
+# データを実際に転送するコピー方法（転送量の集計対象）
+DATA_COPY_METHODS = ('copy_file_range', 'sendfile', 'copy')
+
+def copy_file_fast(source, destination, allow_link=False):
+    """source を新しいファイル destination にコピーし、使った方法を返す
+    
+    allow_link=True ならまずハードリンクを試す。続いて reflink、copy_file_range（NFS 4.2 では
+    サーバー側でコピーされる）、sendfile の順に試し、どれも使えなければ通常のコピーを行う。
+    """
+    if allow_link:
+        try:
+            os.link(source, destination)
+            return 'link'
+        except OSError:
+            pass
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        method = _copy_file_data(src, dst)
+    shutil.copystat(source, destination)
+    return method
+
+def _copy_file_data(src, dst):
+    size = os.fstat(src.fileno()).st_size
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if method == 'copy_file_range':
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                else:
+                    copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return method
+        except OSError as e:
+            # 非対応のファイルシステム・組み合わせなら次の方法へ（途中まで書けた後の失敗はそのまま返す）
+            if offset or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                         errno.ENOTSUP, errno.EBADF):
+                raise
+    
+    src.seek(0)
+    dst.seek(0)
+    dst.truncate()
+    shutil.copyfileobj(src, dst, 1024 * 1024)
+    return 'copy'
+
+class ProbeCache:
+    """ffprobe結果の永続キャッシュ（パス・サイズ・mtime_ns をキーに SQLite へ保存）"""
+    
+    def __init__(self, db_path, max_entries=20000):
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # 複数プロセス（cronの重複実行など）から同時に使われても待ち合わせる
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS probe ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, info TEXT, accessed REAL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS probe_accessed ON probe (accessed)')
+    
+    def key(self, file_path):
+        """キャッシュキー (絶対パス, サイズ, mtime_ns) を取得"""
+        stat = os.stat(file_path)
+        return str(Path(file_path).resolve()), stat.st_size, stat.st_mtime_ns
+    
+    def get(self, key):
+        """キーに一致するキャッシュを返す（サイズやmtimeが変わっていれば None）"""
+        path, size, mtime_ns = key
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                'SELECT info FROM probe WHERE path = ? AND size = ? AND mtime_ns = ?',
+                (path, size, mtime_ns)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE probe SET accessed = ? WHERE path = ?', (time.time(), path))
+        return json.loads(row[0])
+    
+    def put(self, key, info):
+        """プローブ結果を保存し、上限を超えた分は最も古く参照されたものから削除"""
+        path, size, mtime_ns = key
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO probe (path, size, mtime_ns, info, accessed) VALUES (?, ?, ?, ?, ?)',
+                (path, size, mtime_ns, json.dumps(info), time.time())
+            )
+            excess = self.conn.execute('SELECT COUNT(*) FROM probe').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    'DELETE FROM probe WHERE path IN (SELECT path FROM probe ORDER BY accessed LIMIT ?)',
+                    (excess,)
+                )
+    
+    def invalidate(self, file_path=None):
+        """指定ファイル（省略時は全件）のキャッシュを削除"""
+        with self.lock, self.conn:
+            if file_path is None:
+                self.conn.execute('DELETE FROM probe')
+            else:
+                self.conn.execute('DELETE FROM probe WHERE path = ?', (str(Path(file_path).resolve()),))
+
+class OutputCache:
+    """圧縮結果のコンテンツアドレス型キャッシュ（入力の内容ハッシュ＋実効設定をキーに保存）
+    
+    ファイル名が違っても内容と設定が同じ入力は、ffmpegを起動せずにキャッシュから
+    ハードリンク（別ファイルシステムならコピー）で出力を作る。合計サイズが上限を
+    超えたら最も古く参照されたものから削除する。
+    """
+    
+    # これより大きい入力は先頭・末尾と等間隔のサンプルだけでハッシュし、ヒット時に全体を照合する
+    FULL_HASH_LIMIT = 64 * 1024 * 1024
+    SAMPLE_COUNT = 16
+    SAMPLE_BYTES = 256 * 1024
+    READ_BYTES = 1024 * 1024
+    
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / 'objects'
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.cache_dir / 'index.sqlite3'), timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, full_hash TEXT, size INTEGER, created REAL, accessed REAL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            # 同じファイルを何度も読まないよう、ハッシュは (パス, サイズ, mtime_ns) 毎に覚えておく
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                'path TEXT, size INTEGER, mtime_ns INTEGER, kind TEXT, digest TEXT, '
+                'PRIMARY KEY (path, size, mtime_ns, kind))'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+    
+    def _hash_file(self, file_path, kind):
+        """ファイルのハッシュを計算（kind='sample' はサンプリング、'full' は全体）"""
+        stat = os.stat(file_path)
+        memo_key = (str(Path(file_path).resolve()), stat.st_size, stat.st_mtime_ns, kind)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT digest FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ? AND kind = ?', memo_key
+            ).fetchone()
+        if row:
+            return row[0]
+        
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(str(stat.st_size).encode())
+        with open(file_path, 'rb') as f:
+            if kind == 'full':
+                for block in iter(lambda: f.read(self.READ_BYTES), b''):
+                    digest.update(block)
+            else:
+                # 先頭（コンテナのヘッダ）と末尾を含む等間隔の位置から読む
+                step = (stat.st_size - self.SAMPLE_BYTES) / (self.SAMPLE_COUNT - 1)
+                for i in range(self.SAMPLE_COUNT):
+                    f.seek(int(step * i))
+                    digest.update(f.read(self.SAMPLE_BYTES))
+        
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM hashes WHERE path = ? AND kind = ?', (memo_key[0], kind))
+            self.conn.execute('INSERT INTO hashes VALUES (?, ?, ?, ?, ?)', (*memo_key, digest.hexdigest()))
+        return digest.hexdigest()
+    
+    def key(self, input_path, settings):
+        """入力の内容ハッシュと実効設定からキャッシュキーを作る"""
+        kind = 'full' if os.path.getsize(input_path) <= self.FULL_HASH_LIMIT else 'sample'
+        content = f"{kind}:{self._hash_file(input_path, kind)}"
+        payload = json.dumps({'content': content, 'settings': settings}, sort_keys=True)
+        return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+    
+    def _object_path(self, key):
+        return self.objects_dir / key[:2] / f"{key}.mp4"
+    
+    def _passlog_path(self, key):
+        return self.cache_dir / 'passlogs' / key[:2] / key
+    
+    @staticmethod
+    def _size(path):
+        """出力ファイル、または Pass 1 統計のディレクトリの合計サイズ"""
+        if path.is_dir():
+            return sum(entry.stat().st_size for entry in path.iterdir())
+        return path.stat().st_size
+    
+    def materialize(self, source, destination):
+        """ハードリンクで出力を作り、できなければコピーする（戻り値は使った方法）"""
+        return copy_file_fast(source, destination, allow_link=True)
+    
+    def _count(self, name, amount=1):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO stats (name, value) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                (name, amount)
+            )
+    
+    def _verify(self, key, input_path, object_path):
+        """登録済みで壊れておらず入力とも一致すれば、参照時刻を更新してサイズを返す（なければ None）"""
+        with self.lock:
+            row = self.conn.execute('SELECT full_hash, size FROM entries WHERE key = ?', (key,)).fetchone()
+        
+        # ハードリンク先の出力が外部で上書きされていないかサイズで確認
+        if row is None or not object_path.exists() or self._size(object_path) != row[1]:
+            return None
+        # サンプリングハッシュの一致だけで誤ったファイルを返さないよう全体のハッシュを照合
+        if os.path.getsize(input_path) > self.FULL_HASH_LIMIT and self._hash_file(input_path, 'full') != row[0]:
+            return None
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        return row[1]
+    
+    def lookup(self, key, input_path):
+        """キャッシュ済みの出力のパスを返す（なければ None）"""
+        object_path = self._object_path(key)
+        size = self._verify(key, input_path, object_path)
+        if size is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        self._count('bytes_saved', size)
+        return object_path
+    
+    def lookup_passlog(self, key, input_path, passlog_dir):
+        """キャッシュ済みの Pass 1 統計を passlog_dir にコピー（あれば True）"""
+        passlog_path = self._passlog_path(key)
+        if self._verify(key, input_path, passlog_path) is None:
+            self._count('passlog_misses')
+            return False
+        for entry in passlog_path.iterdir():
+            copy_file_fast(entry, Path(passlog_dir) / entry.name)
+        self._count('passlog_hits')
+        return True
+    
+    def store(self, key, input_path, output_path):
+        """エンコード結果をキャッシュに登録し、上限を超えた分を削除"""
+        object_path = self._object_path(key)
+        object_path.parent.mkdir(exist_ok=True)
+        temp_path = object_path.with_name(f".{key}.{uuid.uuid4().hex[:12]}.partial")
+        try:
+            self.materialize(output_path, temp_path)
+            os.replace(temp_path, object_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+        
+        self._register(key, input_path, object_path.stat().st_size)
+    
+    def store_passlog(self, key, input_path, passlog_dir):
+        """Pass 1 の統計ファイル（ffmpeg2pass-*）を登録し、上限を超えた分を削除"""
+        passlog_path = self._passlog_path(key)
+        passlog_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = passlog_path.with_name(f".{key}.{uuid.uuid4().hex[:12]}.partial")
+        temp_path.mkdir()
+        try:
+            for entry in Path(passlog_dir).glob('ffmpeg2pass*'):
+                copy_file_fast(entry, temp_path / entry.name)
+            shutil.rmtree(passlog_path, ignore_errors=True)
+            os.replace(temp_path, passlog_path)
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self._register(key, input_path, self._size(passlog_path))
+    
+    def _register(self, key, input_path, size):
+        full_hash = None
+        if os.path.getsize(input_path) > self.FULL_HASH_LIMIT:
+            full_hash = self._hash_file(input_path, 'full')
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entries (key, full_hash, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, full_hash, size, now, now)
+            )
+        self.evict()
+    
+    def evict(self, max_bytes=None):
+        """合計サイズが上限以下になるまで、最も古く参照されたものから削除"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self.lock, self.conn:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            rows = self.conn.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall()
+            for key, size in rows:
+                if total <= max_bytes:
+                    break
+                self._object_path(key).unlink(missing_ok=True)
+                shutil.rmtree(self._passlog_path(key), ignore_errors=True)
+                self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+    
+    def stats(self):
+        """ヒット・ミス数などの統計を返す"""
+        with self.lock:
+            counters = dict(self.conn.execute('SELECT name, value FROM stats').fetchall())
+            entries, total = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'bytes_saved': counters.get('bytes_saved', 0),
+            'passlog_hits': counters.get('passlog_hits', 0),
+            'passlog_misses': counters.get('passlog_misses', 0),
+            'entries': entries,
+            'size': total
+        }
+    
+    def clear(self):
+        """キャッシュ済みの出力と統計をすべて削除"""
+        self.evict(max_bytes=0)
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM hashes')
+            self.conn.execute('DELETE FROM stats')
+
+class BatchJournal:
+    """バッチ処理の各ジョブの状態（pending/running/done/failed/skipped）を記録するジャーナル
+    
+    JSON Lines で追記し、読み込み時はジョブ毎に最後のレコードを採用する。追記の度に
+    fsync するため、クラッシュしても失われるのは書きかけの最終行だけになる。
+    開いている間はロックファイルを排他ロックし、同じ出力先を使う別のプロセスを起動させない
+    （そのため読み込んだ running のジョブは終了したプロセスが残したものになる）。
+    """
+    
+    FILE_NAME = '.compress_journal.jsonl'
+    
+    def __init__(self, journal_path, reset=False):
+        self.path = Path(journal_path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.lock_file = self._acquire_lock()
+        
+        if not reset and self.path.exists():
+            self._load()
+        # 最新状態だけに書き直してから追記を始める
+        self._compact()
+        self.file = open(self.path, 'a', encoding='utf-8')
+    
+    def _acquire_lock(self):
+        # ジャーナル本体は圧縮時に置き換えるため、ロックは別のファイルで取る
+        lock_file = open(self.path.with_name(self.path.name + '.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise CompressionError(f"別のプロセスが同じ出力先で処理中です（ジャーナル: {self.path}）")
+        return lock_file
+    
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # クラッシュ時に書きかけだった行は無視
+                    continue
+                self.entries[entry['key']] = entry
+    
+    def _compact(self):
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+    
+    @staticmethod
+    def fingerprint(file_path):
+        """入力ファイルの指紋（サイズと更新時刻）"""
+        stat = os.stat(file_path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+    
+    def record(self, key, **fields):
+        """ジョブの状態を更新して追記"""
+        with self.lock:
+            entry = {**self.entries.get(key, {'key': key}), **fields, 'updated_at': time.time()}
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[key] = entry
+    
+    def is_complete(self, key, fingerprint, settings, output_file):
+        """同じ入力・同じ設定で完了済みかつ出力が残っているか"""
+        entry = self.get(key)
+        return (entry is not None
+                and entry.get('state') in ('done', 'skipped')
+                and entry.get('fingerprint') == fingerprint
+                and entry.get('settings') == settings
+                and Path(output_file).exists())
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.lock_file.close()
+
+class DirectoryWatcher:
+    """ディレクトリ直下のファイルの追加・書き込み完了を検知（Linux では inotify、それ以外はポーリング）"""
+    
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+    
+    def __init__(self, directory, poll_interval=2.0):
+        self.directory = Path(directory)
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.backend = 'polling'
+        self.snapshot = {}
+        
+        if sys.platform.startswith('linux'):
+            try:
+                self._init_inotify()
+                self.backend = 'inotify'
+            except OSError:
+                self.fd = None
+        if self.fd is None:
+            self.snapshot = self._scan()
+    
+    def _init_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 に失敗しました: {os.strerror(err)}")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(str(self.directory)), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, f"inotify_add_watch に失敗しました: {os.strerror(err)}")
+        self.fd = fd
+    
+    def _scan(self):
+        """ディレクトリ直下のファイルの (サイズ, mtime_ns) を取得"""
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        snapshot[Path(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue
+        return snapshot
+    
+    def existing_files(self):
+        """監視開始時点で存在するファイル"""
+        return list(self._scan())
+    
+    def poll(self, timeout):
+        """timeout 秒まで待ち、追加・変更されたファイルのパスを返す"""
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            snapshot = self._scan()
+            changed = [path for path, state in snapshot.items() if self.snapshot.get(path) != state]
+            self.snapshot = snapshot
+            return changed
+        
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        
+        changed = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            _, mask, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & self.IN_Q_OVERFLOW:
+                # イベントが溢れた場合は取りこぼしがないよう全件を対象にする
+                return self.existing_files()
+            if name:
+                changed.append(self.directory / os.fsdecode(name))
+        return changed
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class CancelScope:
+    """ジョブ単位の取り消し（実行中の ffmpeg を停止し、以降は ffmpeg を起動させない）"""
+    
+    def __init__(self):
+        self.cancelled = False
+        self.processes = set()
+        self.lock = threading.Lock()
+    
+    def check(self):
+        if self.cancelled:
+            raise JobCancelledError("ジョブが取り消されました")
+    
+    def add(self, process):
+        with self.lock:
+            self.processes.add(process)
+            cancelled = self.cancelled
+        # 起動と取り消しが同時に起きた場合も確実に止める
+        if cancelled:
+            process.terminate()
+    
+    def discard(self, process):
+        with self.lock:
+            self.processes.discard(process)
+    
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+        for process in processes:
+            process.terminate()
+
+class CompressionJob:
+    """ジョブサーバーで受け付けた1件の圧縮（state は queued / running / done / failed / cancelled）"""
+    
+    def __init__(self, input_file, output_file, target_size_mb, quality_preset, priority=0, options=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.input_file = str(input_file)
+        self.output_file = str(output_file)
+        self.target_size_mb = target_size_mb
+        self.quality_preset = quality_preset
+        self.priority = priority
+        self.options = dict(options or {})
+        self.state = 'queued'
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.scope = CancelScope()
+    
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'input_file': self.input_file,
+            'output_file': self.output_file,
+            'target_size_mb': self.target_size_mb,
+            'quality_preset': self.quality_preset,
+            'priority': self.priority,
+            'options': self.options,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error
+        }
+
+class JobServer:
+    """VideoCompressor を優先度付きの待ち行列と固定数のワーカーで実行する（HTTP 層からは独立）
+    
+    priority が大きいジョブから、同じ優先度なら受け付けた順に実行する。queue_size を超えて
+    待機中のジョブが溜まると QueueFullError で受け付けを断る。終了したジョブは直近 HISTORY 件だけ保持する。
+    """
+    
+    HISTORY = 1000
+    # 待ち時間・実行時間の分位数を計算する直近のジョブ数
+    LATENCY_WINDOW = 1000
+    
+    def __init__(self, compressor, workers=1, queue_size=None, threads_per_job=None, log=print):
+        self.compressor = compressor
+        self.queue_size = queue_size
+        self.threads_per_job = threads_per_job
+        self.log = log
+        self.jobs = {}
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.queued = 0
+        self.running = 0
+        self.counts = {'submitted': 0, 'rejected': 0, 'done': 0, 'failed': 0, 'cancelled': 0}
+        self.latencies = {name: deque(maxlen=self.LATENCY_WINDOW) for name in ('queue_wait', 'run')}
+        self.latency_totals = {name: [0.0, 0] for name in self.latencies}
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in self.workers:
+            thread.start()
+    
+    def submit(self, input_file, output_file, target_size_mb=45, quality_preset='medium', priority=0, **options):
+        """ジョブを待ち行列に追加して CompressionJob を返す"""
+        if not Path(input_file).is_file():
+            raise InputNotFoundError(f"ファイル '{input_file}' が見つかりません")
+        job = CompressionJob(input_file, output_file, target_size_mb, quality_preset, priority, options)
+        with self.condition:
+            if self.closed:
+                raise QueueFullError("サーバーは終了処理中です")
+            if self.queue_size and self.queued >= self.queue_size:
+                self.counts['rejected'] += 1
+                raise QueueFullError(f"待ち行列が満杯です（上限: {self.queue_size}）")
+            self.jobs[job.id] = job
+            heapq.heappush(self.heap, (-priority, next(self.sequence), job))
+            self.queued += 1
+            self.counts['submitted'] += 1
+            # ワーカーの「開始」より先に出るようにロック内でログを出す
+            self.log(f"{Colors.CYAN}受付: {job.id} {Path(job.input_file).name} (優先度: {priority}, "
+                     f"待機中: {self.queued}){Colors.NC}")
+            self.condition.notify()
+        return job
+    
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+    
+    def list_jobs(self):
+        with self.condition:
+            return list(self.jobs.values())
+    
+    def cancel(self, job_id):
+        """待機中のジョブは取り除き、実行中のジョブは ffmpeg を停止する（ジョブがなければ None）"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job.scope.cancel()
+            if job.state == 'queued':
+                # 待ち行列からは取り出し時に読み飛ばす
+                self.queued -= 1
+                self._finish(job, 'cancelled')
+        return job
+    
+    def _finish(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        job.finished_at = time.time()
+        self.counts[state] += 1
+        # 古い終了済みのジョブから忘れる
+        finished = [job_id for job_id, entry in self.jobs.items() if entry.finished]
+        for job_id in finished[:max(0, len(finished) - self.HISTORY)]:
+            del self.jobs[job_id]
+    
+    def _record_latency(self, name, seconds):
+        self.latencies[name].append(seconds)
+        self.latency_totals[name][0] += seconds
+        self.latency_totals[name][1] += 1
+    
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.heap and not self.closed:
+                    self.condition.wait()
+                if not self.heap:
+                    return
+                _, _, job = heapq.heappop(self.heap)
+                if job.state != 'queued':
+                    continue
+                self.queued -= 1
+                self.running += 1
+                job.state = 'running'
+                job.started_at = time.time()
+                self._record_latency('queue_wait', job.started_at - job.submitted_at)
             
-    def stop(self):
-        self.is_running = False
+            self.log(f"{Colors.BLUE}開始: {job.id} {Path(job.input_file).name}{Colors.NC}")
+            state, error = 'done', None
+            token = self.compressor.cancel_scope.set(job.scope)
+            try:
+                result = self.compressor.compress_video(job.input_file, job.output_file, job.target_size_mb,
+                                                        job.quality_preset, threads=self.threads_per_job,
+                                                        show_progress=False, **job.options)
+                job.result = result.to_dict()
+            except JobCancelledError:
+                state = 'cancelled'
+            except Exception as e:
+                # 取り消しで ffmpeg を止めた場合も取り消しとして扱う
+                state, error = ('cancelled', None) if job.scope.cancelled else ('failed', str(e))
+            finally:
+                self.compressor.cancel_scope.reset(token)
+            
+            with self.condition:
+                self.running -= 1
+                self._record_latency('run', time.time() - job.started_at)
+                self._finish(job, state, error)
+            color = {'done': Colors.GREEN, 'failed': Colors.RED}.get(state, Colors.YELLOW)
+            label = {'done': '完了', 'failed': '失敗', 'cancelled': '取り消し'}[state]
+            self.log(f"{color}{label}: {job.id} {Path(job.input_file).name}"
+                     f"{f' - {error}' if error else ''}{Colors.NC}")
+    
+    def metrics(self):
+        """待ち行列の深さ・実行中のジョブ数・件数・待ち時間と実行時間の分位数"""
+        with self.condition:
+            latencies = {}
+            for name, values in self.latencies.items():
+                ordered = sorted(values)
+                total, count = self.latency_totals[name]
+                latencies[name] = {
+                    'p50': ordered[len(ordered) // 2] if ordered else None,
+                    'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+                    'sum': total,
+                    'count': count
+                }
+            return {
+                'queue_depth': self.queued,
+                'running': self.running,
+                'workers': len(self.workers),
+                'queue_size': self.queue_size,
+                'jobs': dict(self.counts),
+                'latency': latencies
+            }
+    
+    def metrics_text(self):
+        """metrics() を Prometheus のテキスト形式で返す"""
+        metrics = self.metrics()
+        prefix = f"{PrometheusTextfileHook.PREFIX}_server"
+        lines = []
+        for name in ('queue_depth', 'running', 'workers'):
+            lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {metrics[name]}"]
+        lines.append(f"# TYPE {prefix}_jobs_total counter")
+        lines += [f'{prefix}_jobs_total{{event="{event}"}} {count}' for event, count in metrics['jobs'].items()]
+        for name, latency in metrics['latency'].items():
+            lines.append(f"# TYPE {prefix}_{name}_seconds summary")
+            for quantile in ('p50', 'p95'):
+                if latency[quantile] is not None:
+                    lines.append(f'{prefix}_{name}_seconds{{quantile="0.{quantile[1:]}"}} {latency[quantile]}')
+            lines.append(f"{prefix}_{name}_seconds_sum {latency['sum']}")
+            lines.append(f"{prefix}_{name}_seconds_count {latency['count']}")
+        return '\n'.join(lines) + '\n'
+    
+    def cancel_running(self):
+        with self.condition:
+            jobs = [job for job in self.jobs.values() if job.state == 'running']
+        for job in jobs:
+            job.scope.cancel()
+    
+    def close(self):
+        """受け付けを止めて待機中のジョブを取り消し、実行中のジョブの終了を待つ"""
+        with self.condition:
+            self.closed = True
+            for _, _, job in self.heap:
+                if job.state == 'queued':
+                    self.queued -= 1
+                    self._finish(job, 'cancelled')
+            self.heap = []
+            self.condition.notify_all()
+        for thread in self.workers:
+            thread.join()
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """ジョブサーバーの HTTP API
+    
+    POST /jobs（投入）・GET /jobs・GET /jobs/<id>・GET /jobs/<id>/result・GET /jobs/<id>/output・
+    DELETE /jobs/<id>（取り消し）・GET /metrics（Prometheus）・GET /health
+    """
+    
+    server_version = 'video-compressor'
+    MAX_BODY_BYTES = 1024 * 1024
+    # POST /jobs で指定できる compress_video の引数と型
+    JOB_OPTIONS = {
+        'chunks': int, 'converge': bool, 'max_iterations': int, 'predict': bool, 'passthrough': bool,
+        'ladder': bool, 'min_bpp': (int, float), 'verify': bool, 'min_ssim': (int, float)
+    }
+    
+    def address_string(self):
+        # Unix ドメインソケットでは client_address が空文字になる
+        return self.client_address[0] if self.client_address else 'unix'
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def send_error_json(self, status, message, headers=None):
+        self.send_json(status, {'error': message}, headers)
+    
+    def route(self):
+        """パスを (リソース, ジョブ, サブリソース) に分解（ジョブが見つからなければ 404 を返して None）"""
+        parts = [part for part in urllib.parse.urlsplit(self.path).path.split('/') if part]
+        if not parts or parts[0] != 'jobs' or len(parts) == 1:
+            return parts, None, None
+        job = self.server.job_server.get(parts[1])
+        if job is None:
+            self.send_error_json(404, f"ジョブ '{parts[1]}' が見つかりません")
+            return None
+        return parts, job, parts[2] if len(parts) > 2 else None
+    
+    def do_GET(self):
+        job_server = self.server.job_server
+        routed = self.route()
+        if routed is None:
+            return
+        parts, job, subresource = routed
+        if parts == ['health']:
+            self.send_json(200, {'status': 'ok'})
+        elif parts == ['metrics']:
+            data = job_server.metrics_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif parts == ['jobs']:
+            self.send_json(200, {'jobs': [job.to_dict() for job in job_server.list_jobs()],
+                                 'metrics': job_server.metrics()})
+        elif job is not None and subresource is None:
+            self.send_json(200, job.to_dict())
+        elif job is not None and subresource in ('result', 'output'):
+            if job.state != 'done':
+                self.send_error_json(409, f"ジョブは完了していません (state: {job.state})")
+            elif subresource == 'result':
+                self.send_json(200, job.result)
+            else:
+                self.send_file(Path(job.output_file))
+        else:
+            self.send_error_json(404, "見つかりません")
+    
+    def send_file(self, path):
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            self.send_error_json(410, f"出力ファイルを読めません - {e}")
+            return
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+    
+    def do_POST(self):
+        if [part for part in urllib.parse.urlsplit(self.path).path.split('/') if part] != ['jobs']:
+            self.send_error_json(404, "見つかりません")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > self.MAX_BODY_BYTES:
+                raise ValueError("リクエストが大きすぎます")
+            request = json.loads(self.rfile.read(length) or b'{}')
+            job = self.server.job_server.submit(**self.server.job_arguments(request))
+        except QueueFullError as e:
+            self.send_error_json(503, str(e), {'Retry-After': '5'})
+        except json.JSONDecodeError as e:
+            self.send_error_json(400, f"JSON を解析できません: {e}")
+        except (CompressionError, ValueError, TypeError) as e:
+            self.send_error_json(400, str(e))
+        else:
+            self.send_json(202, job.to_dict(), {'Location': f"/jobs/{job.id}"})
+    
+    def do_DELETE(self):
+        routed = self.route()
+        if routed is None:
+            return
+        _, job, subresource = routed
+        if job is None or subresource is not None:
+            self.send_error_json(404, "見つかりません")
+            return
+        self.send_json(200, self.server.job_server.cancel(job.id).to_dict())
+
+class JobHTTPServer(ThreadingHTTPServer):
+    """ジョブサーバーの HTTP API（TCP）"""
+    
+    daemon_threads = True
+    
+    def __init__(self, address, job_server, job_arguments):
+        self.job_server = job_server
+        self.job_arguments = job_arguments
+        super().__init__(address, JobRequestHandler)
+
+class JobUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ジョブサーバーの HTTP API（Unix ドメインソケット）"""
+    
+    daemon_threads = True
+    
+    def __init__(self, path, job_server, job_arguments):
+        self.job_server = job_server
+        self.job_arguments = job_arguments
+        super().__init__(str(path), JobRequestHandler)
 
 class VideoCompressor:
-    def __init__(self, config_file=None):
+    # 分割エンコード時のセグメントの最小長（秒）
+    MIN_SEGMENT_SECONDS = 30
+    # サイズ収束ループで目標サイズに対して確保する余裕と、下げられる映像ビットレートの下限
+    CONVERGENCE_MARGIN = 0.97
+    MIN_CONVERGED_BITRATE = 50000
+    # サンプルによるCRF予測の設定
+    PREDICTION_SAMPLES = 3
+    PREDICTION_SAMPLE_SECONDS = 4
+    PREDICTION_MAX_VARIATION = 0.35
+    PREDICTION_MAX_CRF_DELTA = 12
+    PREDICTION_MAX_CRF = 40
+    # 複雑度の事前解析（縮小した区間を固定CRFで試験エンコード）の設定。解析方法を変えたら
+    # COMPLEXITY_VERSION を上げてキャッシュ済みの結果を使わないようにする
+    COMPLEXITY_VERSION = 1
+    COMPLEXITY_SAMPLES = 4
+    COMPLEXITY_SAMPLE_SECONDS = 3
+    COMPLEXITY_SHORT_SIDE = 144
+    COMPLEXITY_MAX_FPS = 12
+    COMPLEXITY_CRF = 28
+    # 同じ画質に必要なビットレートは画素レートのおよそ 0.75 乗に比例する（経験則）
+    COMPLEXITY_PIXEL_EXPONENT = 0.75
+    # 品質検証（SSIM / PSNR）のサンプル数・1サンプルの長さ（秒）と、検証対象の圧縮方式
+    VERIFY_SAMPLES = 3
+    VERIFY_SAMPLE_SECONDS = 2
+    VERIFY_STRATEGIES = {'two_pass', 'crf', 'segmented', 'cache'}
+    # 品質が基準を下回った場合の再エンコードで、現在の bits-per-pixel に掛けて min_bpp にする倍率
+    # （ラダーの隣り合う段の画素レートの比は 1.25 倍以上なので、必ず一段以上低い段が選ばれる）
+    QUALITY_RETRY_BPP_STEP = 1.2
+    # ffmpeg失敗時に表示する stderr の行数
+    STDERR_TAIL_LINES = 10
+    # 再エンコード時の音声ビットレート（bps）
+    AUDIO_BITRATE = 128000
+    # 映像を再エンコードせずに済ませる場合の条件（コピー可能なコーデックと、推定サイズに対する余裕）
+    PASSTHROUGH_VIDEO_CODECS = {'h264'}
+    # （MP4 が -strict なしで受け付ける音声のみ。opus・flac は ffmpeg のバージョンによって実験的扱いになる）
+    PASSTHROUGH_AUDIO_CODECS = {'aac', 'mp3', 'ac3', 'eac3', 'alac'}
+    PASSTHROUGH_MARGIN = 0.97
+    PASSTHROUGH_OVERHEAD = 1.01
+    # バッチ・監視モードで対象とする動画ファイルの拡張子
+    VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv', '.wmv', '.flv', '.webm', '.m4v'}
+    # バッチモードで長い動画から並べ替える単位（走査しながら投入するため全体ではなくこの件数毎）
+    SCAN_WINDOW = 64
+    # 解像度・フレームレートのラダー（短辺, 最大fps）と、各段で許容する bits-per-pixel の下限
+    LADDER = [(2160, 60), (1440, 60), (1080, 60), (1080, 30), (720, 30), (540, 30), (480, 30),
+              (360, 30), (360, 24), (240, 24)]
+    LADDER_MIN_BPP = 0.05
+    
+    def __init__(self, config_file=None, use_probe_cache=True, use_output_cache=True, verbose=True):
+        # verbose=False の場合はライブラリとして使うために一切出力しない
+        self.verbose = verbose
+        # 全ジョブ共通の進捗表示（log が使うため、設定やキャッシュの読み込みより先に作る）
+        self.dashboard = ProgressDashboard()
         self.check_ffmpeg()
         self.quality_presets = {
             'fast': {'preset': 'fast', 'crf': 28},
@@ -69,232 +1488,1882 @@ class VideoCompressor:
             'high': {'preset': 'slower', 'crf': 18}
         }
         self.config = self.load_config(config_file)
+        # 一時ファイル（パスログ・セグメント・書きかけの出力）の置き場所（None ならシステムの一時ディレクトリ）
+        self.scratch_dir = None
+        self.set_scratch_dir(self.config.get('default_settings', {}).get('scratch_dir'))
+        # 品質検証のサンプリング密度（本番で常時有効にできるよう既定では短い区間を数か所だけ計測）
+        self.verify_samples = self.config.get('default_settings', {}).get('verify_samples', self.VERIFY_SAMPLES)
+        self.verify_seconds = self.config.get('default_settings', {}).get('verify_seconds',
+                                                                          self.VERIFY_SAMPLE_SECONDS)
+        self.probe_cache = self.open_probe_cache() if use_probe_cache else None
+        self.complexity_cache = self.open_complexity_cache() if use_probe_cache else None
+        self.output_cache = self.open_output_cache() if use_output_cache else None
+        self._encoder_version = None
+        # 実行中のffmpegプロセス（監視モードの強制終了時に停止させる）
+        self.active_processes = set()
+        self.process_lock = threading.Lock()
+        # True の場合、端末の Ctrl+C が直接届かないよう ffmpeg を別セッションで起動する
+        self.detach_processes = False
+        # ジョブサーバーで実行中のジョブの取り消し（CancelScope、スレッド・コンテキスト毎）
+        self.cancel_scope = contextvars.ContextVar('cancel_scope', default=None)
+        # 段階毎の処理時間などの計測（出力先は config の telemetry_log / prometheus_textfile）
+        self.telemetry = Telemetry()
+        self.configure_telemetry()
+    
+    def configure_telemetry(self, telemetry_log=None, prometheus_textfile=None, hook_specs=None):
+        """計測区間の出力先を設定（省略した項目は config の default_settings の値を使う）"""
+        defaults = self.config.get('default_settings', {})
+        telemetry_log = telemetry_log or defaults.get('telemetry_log')
+        prometheus_textfile = prometheus_textfile or defaults.get('prometheus_textfile')
+        hook_specs = hook_specs or defaults.get('telemetry_hooks', [])
+        
+        self.telemetry.close()
+        self.telemetry.hooks = []
+        if telemetry_log:
+            self.telemetry.add_hook(JsonLinesTelemetryHook(telemetry_log))
+        if prometheus_textfile:
+            self.telemetry.add_hook(PrometheusTextfileHook(prometheus_textfile))
+        for spec in hook_specs:
+            self.telemetry.add_hook(load_telemetry_hook(spec))
+    
+    def set_scratch_dir(self, scratch_dir):
+        """作業ディレクトリを設定（tmpfs やローカル SSD を指定すると NFS などへの中間 I/O を避けられる）"""
+        if not scratch_dir:
+            self.scratch_dir = None
+            return
+        self.scratch_dir = Path(scratch_dir).expanduser()
+        self.scratch_dir.mkdir(parents=True, exist_ok=True)
+    
+    def scratch_directory(self):
+        """ジョブ専用の一時ディレクトリ（作業ディレクトリの下）"""
+        return tempfile.TemporaryDirectory(prefix='video-compressor-', dir=self.scratch_dir)
+    
+    def record_io(self, method, size):
+        """出力の配置・コピーのバイト数を実行中の計測区間に記録"""
+        span = self.telemetry.current()
+        if span is not None:
+            span.add_io(method, size)
+    
+    def get_cache_dir(self):
+        """キャッシュディレクトリを取得（config の cache_dir、なければ XDG_CACHE_HOME 配下）"""
+        cache_dir = self.config.get('default_settings', {}).get('cache_dir')
+        if cache_dir:
+            return Path(cache_dir).expanduser()
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        return Path(base) / 'video-compressor'
+    
+    def open_probe_cache(self):
+        """ffprobeキャッシュを開く（開けない場合はキャッシュなしで続行）"""
+        max_entries = self.config.get('default_settings', {}).get('probe_cache_max_entries', 20000)
+        try:
+            return ProbeCache(self.get_cache_dir() / 'probe.sqlite3', max_entries)
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"{Colors.YELLOW}警告: プローブキャッシュを使用できません - {e}{Colors.NC}")
+            return None
+    
+    def open_complexity_cache(self):
+        """複雑度の解析結果のキャッシュを開く（ffprobe キャッシュと同じくパス・サイズ・mtime_ns がキー）"""
+        max_entries = self.config.get('default_settings', {}).get('probe_cache_max_entries', 20000)
+        try:
+            return ProbeCache(self.get_cache_dir() / 'complexity.sqlite3', max_entries)
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"{Colors.YELLOW}警告: 複雑度キャッシュを使用できません - {e}{Colors.NC}")
+            return None
+    
+    def open_output_cache(self):
+        """出力キャッシュを開く（開けない場合はキャッシュなしで続行）"""
+        max_mb = self.config.get('default_settings', {}).get('output_cache_max_mb', 2048)
+        try:
+            return OutputCache(self.get_cache_dir() / 'outputs', max_mb * 1024 * 1024)
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"{Colors.YELLOW}警告: 出力キャッシュを使用できません - {e}{Colors.NC}")
+            return None
+    
+    def get_encoder_version(self):
+        """ffmpegのバージョン文字列（エンコーダが変わったらキャッシュを使わないためのキー）"""
+        if self._encoder_version is None:
+            result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
+            self._encoder_version = result.stdout.splitlines()[0] if result.stdout else 'unknown'
+        return self._encoder_version
+    
+    def output_cache_settings(self, target_size_mb, preset_config, **options):
+        """出力を決める実効設定（出力キャッシュのキーに含める）"""
+        return {
+            'target_size_mb': target_size_mb,
+            'preset': preset_config['preset'],
+            'crf': preset_config['crf'],
+            'filters': preset_config.get('filters', []),
+            'video_codec': 'libx264',
+            'audio': ['aac', '128k'],
+            'encoder': self.get_encoder_version(),
+            **options
+        }
+    
+    def load_config(self, config_file=None):
+        """設定ファイルを読み込み"""
+        if config_file is None:
+            # スクリプトと同じディレクトリのconfig.jsonを探す
+            script_dir = Path(__file__).parent
+            config_file = script_dir / "config.json"
+        
+        if Path(config_file).exists():
+            try:
+                with open(config_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                self.log(f"{Colors.YELLOW}警告: 設定ファイル読み込みエラー - {e}{Colors.NC}")
+        
+        # デフォルト設定を返す
+        return {
+            "default_settings": {
+                "target_size_mb": 45,
+                "quality_preset": "medium",
+                "audio_bitrate": "128k"
+            },
+            "profiles": {}
+        }
+    
+    def get_profile_settings(self, profile_name):
+        """プロファイル設定を取得（ladder / ladder_min_bpp は省略時 default_settings の値）"""
+        if profile_name in self.config.get('profiles', {}):
+            profile = self.config['profiles'][profile_name]
+            defaults = self.config.get('default_settings', {})
+            return {
+                'target_size_mb': profile.get('target_size_mb', 45),
+                'quality_preset': profile.get('quality_preset', 'medium'),
+                'ladder': profile.get('ladder', defaults.get('ladder', True)),
+                'min_bpp': profile.get('ladder_min_bpp', defaults.get('ladder_min_bpp'))
+            }
+        return None
+    
+    def check_ffmpeg(self):
+        """ffmpegの存在確認"""
+        for command in ('ffmpeg', 'ffprobe'):
+            if not shutil.which(command):
+                raise FFmpegNotFoundError(f"{command}がインストールされていません")
+    
+    def log(self, message=''):
+        """進捗表示を崩さないようにメッセージを出力（verbose=False なら何もしない）"""
+        if self.verbose:
+            self.dashboard.print(message)
+    
+    def get_file_size_mb(self, file_path):
+        """ファイルサイズを取得（MB単位）"""
+        return os.path.getsize(file_path) / (1024 * 1024)
+    
+    def get_video_info(self, file_path, use_cache=True):
+        """動画の情報を取得（キャッシュ済みで変更がなければ ffprobe を起動しない）"""
+        with self.telemetry.span('probe', Path(file_path).name) as span:
+            span.attributes['cache_hit'] = False
+            cache_key = None
+            if use_cache and self.probe_cache is not None:
+                # プローブ前に stat を取り、プローブ中に書き換えられても古い結果が使われないようにする
+                cache_key = self.probe_cache.key(file_path)
+                cached = self.probe_cache.get(cache_key)
+                if cached is not None:
+                    span.attributes['cache_hit'] = True
+                    return cached
+            
+            video_info = self._run_ffprobe(file_path)
+            if cache_key is not None:
+                self.probe_cache.put(cache_key, video_info)
+            return video_info
+    
+    def get_video_info_bulk(self, file_paths, jobs=None):
+        """複数ファイルの情報を並列に取得（取得できなかったファイルは None）"""
+        def probe(file_path):
+            try:
+                return self.get_video_info(file_path)
+            except (CompressionError, OSError):
+                return None
+        
+        workers = jobs or min(16, (os.cpu_count() or 1) * 2)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return list(executor.map(probe, file_paths))
+    
+    async def get_video_info_async(self, file_path, use_cache=True):
+        """get_video_info の asyncio 版"""
+        with self.telemetry.span('probe', Path(file_path).name, measure_cpu=False) as span:
+            span.attributes['cache_hit'] = False
+            cache_key = None
+            if use_cache and self.probe_cache is not None:
+                cache_key = self.probe_cache.key(file_path)
+                cached = self.probe_cache.get(cache_key)
+                if cached is not None:
+                    span.attributes['cache_hit'] = True
+                    return cached
+            
+            process = await asyncio.create_subprocess_exec(
+                *self.ffprobe_command(file_path), stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await process.communicate()
+            except BaseException:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+            if process.returncode != 0:
+                raise ProbeError(f"動画情報の取得に失敗しました: {file_path}", stderr.decode(errors='replace'))
+            
+            video_info = json.loads(stdout)
+            if cache_key is not None:
+                self.probe_cache.put(cache_key, video_info)
+            return video_info
+    
+    def ffprobe_command(self, file_path):
+        return [
+            'ffprobe', '-v', 'quiet', '-print_format', 'json',
+            '-show_format', '-show_streams', str(file_path)
+        ]
+    
+    def _run_ffprobe(self, file_path):
+        """ffprobe を実行して動画の情報を取得"""
+        process = self.start_process(self.ffprobe_command(file_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     universal_newlines=True, errors='replace')
+        stderr = []
+        stderr_thread = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+        stdout = process.stdout.read()
+        stderr_thread.join()
+        if self.wait_process(process) != 0:
+            raise ProbeError(f"動画情報の取得に失敗しました: {file_path}", ''.join(stderr))
+        return json.loads(stdout)
+    
+    def start_process(self, cmd, **kwargs):
+        """子プロセスを起動し、ジョブの取り消しで停止できるよう実行中のジョブに登録する
+        
+        ジョブが取り消されていた場合は起動せずに JobCancelledError を送出する。
+        """
+        scope = self.cancel_scope.get()
+        if scope is not None:
+            scope.check()
+        kwargs.setdefault('start_new_session', self.detach_processes)
+        process = subprocess.Popen(cmd, **kwargs)
+        if scope is not None:
+            scope.add(process)
+        return process
+    
+    def wait_process(self, process):
+        """子プロセスの終了を待ち、その CPU 時間を実行中の計測区間に加算して終了コードを返す
+        
+        ジョブが取り消されていた場合は JobCancelledError を送出する。
+        """
+        if not hasattr(os, 'wait4'):
+            process.wait()
+        else:
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            span = self.telemetry.current()
+            if span is not None:
+                span.add_child_usage(usage)
+        scope = self.cancel_scope.get()
+        if scope is not None:
+            scope.discard(process)
+            scope.check()
+        return process.returncode
+    
+    def get_video_duration(self, video_info):
+        """動画の長さを取得（秒）"""
+        return float(video_info['format']['duration'])
+    
+    def analyze_streams(self, video_info, file_size=None):
+        """ストリーム毎のビットレート（bps）を解析
+        
+        ffprobe がビットレートを返さないストリーム（MKVなど）は、PCMなら
+        サンプリング周波数×チャンネル数×ビット深度から、それ以外は1つだけなら
+        ファイル全体のビットレートとの差分から推定する。推定できなければ None。
+        """
+        duration = self.get_video_duration(video_info)
+        streams = []
+        for stream in video_info.get('streams', []):
+            tags = stream.get('tags', {})
+            bitrate = stream.get('bit_rate') or tags.get('BPS') or tags.get('BPS-eng')
+            estimated = False
+            if not bitrate and stream.get('codec_name', '').startswith('pcm_') and stream.get('bits_per_sample'):
+                bitrate = int(stream['sample_rate']) * stream['channels'] * stream['bits_per_sample']
+                estimated = True
+            streams.append({
+                'index': stream['index'],
+                'codec_type': stream.get('codec_type'),
+                'codec_name': stream.get('codec_name', 'unknown'),
+                'bitrate': int(bitrate) if bitrate else None,
+                'estimated': estimated,
+                'attached_pic': bool(stream.get('disposition', {}).get('attached_pic'))
+            })
+        
+        unknown = [s for s in streams if s['bitrate'] is None and not s['attached_pic']]
+        if len(unknown) == 1:
+            if file_size is None:
+                file_size = int(video_info['format'].get('size', 0))
+            known = sum(s['bitrate'] for s in streams if s['bitrate'])
+            remaining = int(file_size * 8 / duration) - known
+            if remaining > 0:
+                unknown[0]['bitrate'] = remaining
+                unknown[0]['estimated'] = True
+        return streams
+    
+    def plan_passthrough(self, streams, duration, target_size_mb):
+        """映像を再エンコードせずに目標サイズに収める最も安い方法を選ぶ（なければ None）
+        
+        コストの低い順に、ストリームコピーでの再多重化、余分なトラックの削除、
+        音声のみの再エンコードを試し、推定サイズが目標に収まるものを返す。
+        """
+        video = next((s for s in streams if s['codec_type'] == 'video' and not s['attached_pic']), None)
+        audio = [s for s in streams if s['codec_type'] == 'audio']
+        if video is None or video['codec_name'] not in self.PASSTHROUGH_VIDEO_CODECS or not video['bitrate']:
+            return None
+        
+        def copyable(stream):
+            return stream['codec_name'] in self.PASSTHROUGH_AUDIO_CODECS and stream['bitrate']
+        
+        video_map = ['-map', f"0:{video['index']}"]
+        candidates = []
+        if all(copyable(s) for s in audio):
+            candidates.append(('remux', 'ストリームコピーで再多重化',
+                               video['bitrate'] + sum(s['bitrate'] for s in audio),
+                               [*video_map, *[arg for s in audio for arg in ('-map', f"0:{s['index']}")],
+                                '-c', 'copy']))
+        if len(audio) > 1 and copyable(audio[0]):
+            candidates.append(('drop_tracks', '余分なトラックを削除',
+                               video['bitrate'] + audio[0]['bitrate'],
+                               [*video_map, '-map', f"0:{audio[0]['index']}", '-c', 'copy']))
+        if audio:
+            candidates.append(('audio', '音声のみ再エンコード',
+                               video['bitrate'] + self.AUDIO_BITRATE,
+                               [*video_map, '-map', f"0:{audio[0]['index']}", '-c:v', 'copy',
+                                '-c:a', 'aac', '-b:a', str(self.AUDIO_BITRATE)]))
+        
+        limit_bytes = target_size_mb * 1024 * 1024 * self.PASSTHROUGH_MARGIN
+        for strategy, description, bitrate, args in candidates:
+            estimated_bytes = bitrate * duration / 8 * self.PASSTHROUGH_OVERHEAD
+            if estimated_bytes <= limit_bytes:
+                return {
+                    'strategy': strategy,
+                    'description': description,
+                    'estimated_size_mb': estimated_bytes / (1024 * 1024),
+                    'args': args
+                }
+        return None
+    
+    def passthrough_command(self, input_path, output_path, plan):
+        """plan_passthrough で選んだ方法の ffmpeg コマンド"""
+        return ['ffmpeg', '-y', '-i', str(input_path), *plan['args'], str(output_path)]
+    
+    def encode_passthrough(self, input_path, output_path, plan, duration, show_progress=True):
+        """映像をストリームコピーしたまま出力を作成"""
+        self.run_ffmpeg_with_progress(self.passthrough_command(input_path, output_path, plan), duration,
+                                      f"パススルー: {plan['description']}中", show_progress, stage='passthrough')
+    
+    def get_video_geometry(self, video_info):
+        """表示上の幅・高さ・フレームレートを取得（回転メタデータを考慮）"""
+        stream = next((s for s in video_info.get('streams', [])
+                       if s.get('codec_type') == 'video' and not s.get('disposition', {}).get('attached_pic')), None)
+        if stream is None or not stream.get('width') or not stream.get('height'):
+            return None
+        
+        width, height = stream['width'], stream['height']
+        rotation = stream.get('tags', {}).get('rotate', 0)
+        for side_data in stream.get('side_data_list', []):
+            rotation = side_data.get('rotation', rotation)
+        if abs(int(float(rotation))) % 180 == 90:
+            width, height = height, width
+        
+        fps = 0.0
+        for key in ('avg_frame_rate', 'r_frame_rate'):
+            num, _, den = stream.get(key, '0/0').partition('/')
+            if float(den or 1) > 0 and float(num) > 0:
+                fps = float(num) / float(den or 1)
+                break
+        return width, height, fps
+    
+    def select_ladder_rung(self, video_info, video_bitrate, min_bpp=None):
+        """目標ビットレートで bits-per-pixel が下限を下回らない最大の解像度・フレームレートを選ぶ
+        
+        ラダーは短辺の長さとフレームレートの上限の組で、元の解像度・フレームレートを
+        超えることはない。どの段でも下限を下回る場合は最下段を使う。
+        """
+        geometry = self.get_video_geometry(video_info)
+        if geometry is None or geometry[2] <= 0:
+            return None
+        width, height, fps = geometry
+        min_bpp = min_bpp or self.LADDER_MIN_BPP
+        short_side = min(width, height)
+        
+        for rung_short, rung_fps in self.LADDER:
+            scale = min(1.0, rung_short / short_side)
+            # libx264 は偶数の幅・高さが必要
+            out_width = max(2, int(round(width * scale / 2)) * 2)
+            out_height = max(2, int(round(height * scale / 2)) * 2)
+            out_fps = min(fps, rung_fps)
+            bpp = video_bitrate / (out_width * out_height * out_fps)
+            if bpp >= min_bpp:
+                break
+        
+        if scale >= 1.0:
+            out_width, out_height = width, height
+        filters = []
+        if (out_width, out_height) != (width, height):
+            filters.append(f"scale={out_width}:{out_height}")
+        if out_fps < fps - 0.01:
+            filters.append(f"fps={out_fps:g}")
+        return {
+            'source': (width, height, fps),
+            'width': out_width,
+            'height': out_height,
+            'fps': out_fps,
+            'bpp': bpp,
+            'filters': filters
+        }
+    
+    def video_filter_args(self, preset_config):
+        """ラダーで選んだ縮小・フレームレート変換の ffmpeg 引数"""
+        filters = preset_config.get('filters')
+        return ['-vf', ','.join(filters)] if filters else []
+    
+    def calculate_target_bitrate(self, target_size_mb, duration_sec, min_bitrate=500000):
+        """目標ビットレートを計算"""
+        target_size_bits = target_size_mb * 8 * 1024 * 1024
+        target_bitrate = int(target_size_bits / duration_sec)
+        
+        # 音声ビットレート（128kbps）を差し引く
+        video_bitrate = target_bitrate - self.AUDIO_BITRATE
+        
+        # 最小ビットレートを確保
+        if video_bitrate < min_bitrate:
+            video_bitrate = min_bitrate
+            
+        return video_bitrate
+    
+    def resolve_jobs(self, jobs, file_count):
+        """並列ジョブ数とジョブ毎のスレッド数を決定"""
+        cpu_count = os.cpu_count() or 1
+        
+        if jobs == 'auto':
+            # libx264は1ジョブあたり4スレッド程度までが効率的
+            job_count = max(1, cpu_count // 4)
+        else:
+            job_count = max(1, int(jobs))
+        
+        job_count = min(job_count, max(1, file_count))
+        # 合計スレッド数がコア数に収まるように配分
+        threads_per_job = max(1, cpu_count // job_count)
+        
+        return job_count, threads_per_job
+    
+    def analyze_complexity(self, file_path, use_cache=True):
+        """映像の複雑度を解析（結果はパス・サイズ・mtime_ns をキーにキャッシュ）
+        
+        等間隔の数区間を短辺 COMPLEXITY_SHORT_SIDE・低フレームレートに縮小して固定CRFで試験エンコードし、
+        その bits-per-pixel を複雑度とする（動き・細部が多いほど大きい）。解析できなければ None。
+        """
+        cache_key = None
+        if use_cache and self.complexity_cache is not None:
+            cache_key = self.complexity_cache.key(file_path)
+            cached = self.complexity_cache.get(cache_key)
+            if cached is not None and cached.get('version') == self.COMPLEXITY_VERSION:
+                return cached
+        
+        video_info = self.get_video_info(file_path)
+        geometry = self.get_video_geometry(video_info)
+        duration = self.get_video_duration(video_info)
+        if geometry is None or geometry[2] <= 0 or duration <= 0:
+            return None
+        width, height, fps = geometry
+        scale = min(1.0, self.COMPLEXITY_SHORT_SIDE / min(width, height))
+        sample_width = max(2, int(round(width * scale / 2)) * 2)
+        sample_height = max(2, int(round(height * scale / 2)) * 2)
+        sample_fps = min(fps, self.COMPLEXITY_MAX_FPS)
+        sample_seconds = min(self.COMPLEXITY_SAMPLE_SECONDS, duration / self.COMPLEXITY_SAMPLES)
+        
+        total_bits = 0
+        with self.telemetry.span('analyze', Path(file_path).name):
+            for i in range(self.COMPLEXITY_SAMPLES):
+                start = max(0.0, duration * (i + 0.5) / self.COMPLEXITY_SAMPLES - sample_seconds / 2)
+                cmd = [
+                    'ffmpeg', '-v', 'error',
+                    '-ss', f"{start:.3f}", '-t', f"{sample_seconds:.3f}",
+                    '-i', str(file_path),
+                    '-map', '0:v:0', '-an', '-sn', '-dn',
+                    '-vf', f"scale={sample_width}:{sample_height},fps={sample_fps:g}",
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', str(self.COMPLEXITY_CRF),
+                    '-threads', '1',
+                    '-f', 'h264', '-'
+                ]
+                process = self.start_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                total_bits += len(process.stdout.read()) * 8
+                if self.wait_process(process) != 0:
+                    return None
+        
+        frames = sample_seconds * sample_fps * self.COMPLEXITY_SAMPLES
+        analysis = {
+            'version': self.COMPLEXITY_VERSION,
+            'bpp': total_bits / (sample_width * sample_height * frames),
+            'duration': duration,
+            'width': width,
+            'height': height,
+            'fps': fps
+        }
+        if cache_key is not None:
+            self.complexity_cache.put(cache_key, analysis)
+        return analysis
+    
+    def analyze_complexity_bulk(self, file_paths, workers=None):
+        """複数ファイルの複雑度を並列に解析（解析できなかったファイルは None）
+        
+        workers は並列数の上限で、省略時はコア数。エンコードの並列数（-j）とは独立に決める。
+        """
+        def analyze(file_path):
+            try:
+                return self.analyze_complexity(file_path)
+            except (CompressionError, OSError):
+                return None
+        
+        # 各 ffmpeg は1スレッドで動かすため、コア数まで並列にする
+        workers = min(workers or math.inf, os.cpu_count() or 1, max(1, len(file_paths)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda path: contextvars.copy_context().run(analyze, path), file_paths))
+    
+    def allocate_budget(self, demands, budget_bytes):
+        """予算を複数ファイルに配分し、ファイル毎のバイト数を返す
+        
+        demands は (重み, 下限バイト数, 上限バイト数, 固定分のバイト数) のリスト。各ファイルに
+        固定分 + λ × 重み を割り当て（重みが複雑度 × 長さなら画質がほぼ揃う）、下限・上限で切った
+        合計が予算に一致する λ を二分探索で求める（ウォーターフィリング）。上限で余った分は他の
+        ファイルに回るため、最も画質の低いファイルの画質が最大になる。
+        """
+        def allocation(scale):
+            return [min(high, max(low, fixed + scale * weight)) for weight, low, high, fixed in demands]
+        
+        if sum(low for _, low, _, _ in demands) >= budget_bytes:
+            return allocation(0.0)
+        if sum(high for _, _, high, _ in demands) <= budget_bytes:
+            return [high for _, _, high, _ in demands]
+        
+        low_scale, high_scale = 0.0, 1.0
+        while sum(allocation(high_scale)) < budget_bytes:
+            high_scale *= 2
+        for _ in range(60):
+            scale = (low_scale + high_scale) / 2
+            if sum(allocation(scale)) > budget_bytes:
+                high_scale = scale
+            else:
+                low_scale = scale
+        return allocation(low_scale)
+    
+    def plan_budget(self, video_files, budget_bytes, workers=None):
+        """予算をバッチの各ファイルに配分し、ファイル毎の目標サイズ（MB）を返す"""
+        self.log(f"{Colors.BLUE}複雑度を解析しています...{Colors.NC} ({len(video_files)}ファイル)")
+        analyses = self.analyze_complexity_bulk(video_files, workers)
+        known = [analysis['bpp'] for analysis in analyses if analysis is not None]
+        # 解析できなかったファイルは平均的な複雑度として扱う
+        default_bpp = sum(known) / len(known) if known else 1.0
+        
+        demands = []
+        for video_file, analysis in zip(video_files, analyses):
+            size = video_file.stat().st_size
+            if analysis is None:
+                try:
+                    duration = self.get_video_duration(self.get_video_info(video_file))
+                except (CompressionError, OSError, KeyError, ValueError):
+                    duration = 0.0
+                pixel_rate = 1.0
+            else:
+                duration = analysis['duration']
+                pixel_rate = analysis['width'] * analysis['height'] * analysis['fps']
+            bpp = analysis['bpp'] if analysis is not None else default_bpp
+            weight = bpp * pixel_rate ** self.COMPLEXITY_PIXEL_EXPONENT * duration
+            # 音声と、calculate_target_bitrate が下回らせない最低の映像ビットレート
+            fixed = self.AUDIO_BITRATE * duration / 8
+            low = min(size, fixed + 500000 * duration / 8)
+            demands.append((weight, low, size, fixed))
+        
+        allocations = self.allocate_budget(demands, max(0, budget_bytes))
+        if sum(allocations) > budget_bytes:
+            self.log(f"{Colors.YELLOW}警告: 予算が最低ビットレートの合計に足りないため超過します{Colors.NC}")
+        
+        targets = {}
+        self.log(f"{Colors.BLUE}予算の配分:{Colors.NC} {budget_bytes / (1024 * 1024):.2f}MB")
+        for video_file, analysis, allocated, (_, _, size, _) in zip(video_files, analyses, allocations, demands):
+            # 入力サイズ以上を配分したファイルはコピーになるよう入力サイズちょうどにし、それ以外は切り捨て
+            if allocated >= size:
+                targets[video_file] = size / (1024 * 1024)
+            else:
+                targets[video_file] = math.floor(allocated / (1024 * 1024) * 1000) / 1000
+            complexity = f"{analysis['bpp']:.3f}" if analysis is not None else '不明'
+            self.log(f"  {video_file.name}: 複雑度 {complexity} → {targets[video_file]:.2f}MB")
+        return targets
+    
+    def get_video_extensions(self):
+        """処理対象の拡張子（config の video_extensions、なければ既定値）"""
+        extensions = self.config.get('default_settings', {}).get('video_extensions')
+        if not extensions:
+            return self.VIDEO_EXTENSIONS
+        return {ext.lower() if ext.startswith('.') else f".{ext.lower()}" for ext in extensions}
+    
+    def scan_videos(self, directory, include=None, exclude=None, recursive=True, exclude_dirs=()):
+        """os.scandir でディレクトリを走査し、対象の動画ファイルを見つけた順に返す（ジェネレータ）
+        
+        include / exclude はディレクトリからの相対パス（/ 区切り）に対する glob で、exclude に一致する
+        ディレクトリはその下を読まない。隠しファイル、exclude_dirs（出力先など）、シンボリックリンクの
+        ディレクトリは辿らない。
+        """
+        extensions = self.get_video_extensions()
+        include = include or []
+        exclude = exclude or []
+        excluded_dirs = set()
+        for path in exclude_dirs:
+            try:
+                stat = os.stat(path)
+                excluded_dirs.add((stat.st_dev, stat.st_ino))
+            except OSError:
+                continue
+        
+        def matches(relative, patterns):
+            return any(fnmatch.fnmatch(relative, pattern) for pattern in patterns)
+        
+        # 深いツリーでも再帰の上限に当たらないよう、ディレクトリはスタックで辿る
+        stack = [(str(directory), '')]
+        while stack:
+            current, prefix = stack.pop()
+            subdirs = []
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        relative = prefix + entry.name
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if recursive and not matches(relative, exclude) and \
+                                        not matches(relative + '/', exclude):
+                                    stat = entry.stat(follow_symlinks=False)
+                                    if (stat.st_dev, stat.st_ino) not in excluded_dirs:
+                                        subdirs.append((entry.path, relative + '/'))
+                                continue
+                            if not entry.is_file():
+                                continue
+                        except OSError:
+                            continue
+                        if os.path.splitext(entry.name)[1].lower() not in extensions:
+                            continue
+                        if (include and not matches(relative, include)) or matches(relative, exclude):
+                            continue
+                        yield Path(entry.path)
+            except OSError as e:
+                self.log(f"{Colors.YELLOW}警告: ディレクトリを読めません - {e}{Colors.NC}")
+            stack.extend(reversed(subdirs))
+    
+    def order_by_duration(self, video_files, window, jobs=None):
+        """ストリームを window 件ずつ区切り、区切り毎に長い動画から並べ替えて返す（ジェネレータ）"""
+        pending = []
+        for video_file in video_files:
+            pending.append(video_file)
+            if len(pending) >= window:
+                yield from self.sort_by_duration(pending, jobs)
+                pending = []
+        if pending:
+            yield from self.sort_by_duration(pending, jobs)
+    
+    def sort_by_duration(self, video_files, jobs=None):
+        """長い動画から処理するように並べ替え（取得失敗時はファイルサイズで代用）"""
+        durations = []
+        for video_info in self.get_video_info_bulk(video_files, jobs):
+            try:
+                durations.append(self.get_video_duration(video_info))
+            except (TypeError, KeyError, ValueError):
+                durations.append(0.0)
+        
+        keyed = [(duration, video_file.stat().st_size, video_file)
+                 for duration, video_file in zip(durations, video_files)]
+        keyed.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        return [video_file for _, _, video_file in keyed]
+    
+    def run_ffmpeg_with_progress(self, cmd, duration, pass_name, show_progress=True, on_progress=None, stage=None):
+        """ffmpegを実行してプログレスを表示
+        
+        進捗は -progress pipe:1 の key=value 出力から ProgressEvent として読み取り、
+        ダッシュボードと on_progress（指定時）に渡す。stderr は末尾のみ保持する。
+        実行は stage（省略時は pass1 / pass2 / encode）の計測区間として記録する。
+        """
+        with self.ffmpeg_span(cmd, pass_name, stage) as span:
+            self._run_ffmpeg_with_progress(cmd, duration, pass_name, show_progress, on_progress, span)
+    
+    @contextmanager
+    def ffmpeg_span(self, cmd, pass_name, stage=None, measure_cpu=True):
+        """ffmpeg 1回分の計測区間（入出力のバイト数も記録）"""
+        if stage is None:
+            stage = f"pass{cmd[cmd.index('-pass') + 1]}" if '-pass' in cmd else 'encode'
+        inputs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == '-i']
+        with self.telemetry.span(stage, pass_name, measure_cpu) as span:
+            if inputs and os.path.isfile(inputs[-1]):
+                span.input_bytes = os.path.getsize(inputs[-1])
+            yield span
+            if os.path.isfile(cmd[-1]):
+                span.output_bytes = os.path.getsize(cmd[-1])
+    
+    def _run_ffmpeg_with_progress(self, cmd, duration, pass_name, show_progress, on_progress, span):
+        # ジョブ名は入力ファイル名（concat 時は最後の -i が元動画）
+        inputs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == '-i']
+        label = f"{Path(inputs[-1]).name} {pass_name}" if inputs else pass_name
+        
+        self.log(f"{Colors.YELLOW}{pass_name}...{Colors.NC}")
+        job_id = self.dashboard.start_job(label, duration) if show_progress else None
+        
+        # 進捗は標準出力、ログは標準エラーに分離（統計行の出力は不要なので -nostats）
+        progress_cmd = [cmd[0], '-hide_banner', '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+        process = self.start_process(
+            progress_cmd, 
+            stdout=subprocess.PIPE, 
+            stderr=subprocess.PIPE, 
+            universal_newlines=True,
+            errors='replace'
+        )
+        with self.process_lock:
+            self.active_processes.add(process)
+        
+        # stderr はエラー表示用に末尾の行だけをリングバッファに保持
+        stderr_tail = deque(maxlen=self.STDERR_TAIL_LINES)
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_tail.extend(line.rstrip() for line in process.stderr)
+        )
+        stderr_thread.daemon = True
+        stderr_thread.start()
+        
+        # プログレス監視
+        try:
+            fields = {}
+            for line in process.stdout:
+                fields = self._feed_progress_line(line, fields, duration, job_id, on_progress, span)
+            
+            self.wait_process(process)
+            stderr_thread.join()
+        except BaseException:
+            # 中断時はffmpegを確実に終了させる（一時ファイルの掃除を妨げないため）
+            process.kill()
+            process.wait()
+            if job_id is not None:
+                self.dashboard.finish_job(job_id, success=False)
+            raise
+        finally:
+            with self.process_lock:
+                self.active_processes.discard(process)
+            scope = self.cancel_scope.get()
+            if scope is not None:
+                scope.discard(process)
+        
+        if job_id is not None:
+            self.dashboard.finish_job(job_id, success=process.returncode == 0)
+        
+        if process.returncode != 0:
+            raise EncodeError(f"ffmpegの実行に失敗しました ({pass_name})", process.returncode,
+                              '\n'.join(stderr_tail))
+    
+    async def run_ffmpeg_async(self, cmd, duration, pass_name, show_progress=False, on_progress=None, stage=None):
+        """run_ffmpeg_with_progress の asyncio 版
+        
+        タスクがキャンセルされた場合は ffmpeg を停止してから CancelledError を送出する。
+        """
+        # 子プロセスはイベントループが回収するため CPU 時間は計測しない
+        with self.ffmpeg_span(cmd, pass_name, stage, measure_cpu=False) as span:
+            await self._run_ffmpeg_async(cmd, duration, pass_name, show_progress, on_progress, span)
+    
+    async def _run_ffmpeg_async(self, cmd, duration, pass_name, show_progress, on_progress, span):
+        inputs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == '-i']
+        label = f"{Path(inputs[-1]).name} {pass_name}" if inputs else pass_name
+        
+        self.log(f"{Colors.YELLOW}{pass_name}...{Colors.NC}")
+        job_id = self.dashboard.start_job(label, duration) if show_progress else None
+        
+        progress_cmd = [cmd[0], '-hide_banner', '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+        process = await asyncio.create_subprocess_exec(
+            *progress_cmd, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        
+        stderr_tail = deque(maxlen=self.STDERR_TAIL_LINES)
+        
+        async def read_stderr():
+            async for line in process.stderr:
+                stderr_tail.append(line.decode(errors='replace').rstrip())
+        
+        stderr_task = asyncio.ensure_future(read_stderr())
+        try:
+            fields = {}
+            async for line in process.stdout:
+                fields = self._feed_progress_line(line.decode(errors='replace'), fields, duration, job_id,
+                                                  on_progress, span)
+            await process.wait()
+            await stderr_task
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr_task.cancel()
+            if job_id is not None:
+                self.dashboard.finish_job(job_id, success=False)
+            raise
+        
+        if job_id is not None:
+            self.dashboard.finish_job(job_id, success=process.returncode == 0)
+        
+        if process.returncode != 0:
+            raise EncodeError(f"ffmpegの実行に失敗しました ({pass_name})", process.returncode,
+                              '\n'.join(stderr_tail))
+    
+    def _feed_progress_line(self, line, fields, duration, job_id, on_progress, span=None):
+        """-progress の1行を取り込み、ブロックの終わりで進捗を通知（次に使う fields を返す）"""
+        key, _, value = line.strip().partition('=')
+        fields[key] = value
+        # 1ブロックは progress=continue|end で終わる
+        if key == 'progress':
+            event = ProgressEvent(fields, duration)
+            if span is not None:
+                span.record_progress(event)
+            if job_id is not None:
+                self.dashboard.update(job_id, event)
+            if on_progress is not None:
+                on_progress(event)
+            return {}
+        return fields
+    
+    def terminate_active_processes(self):
+        """実行中の全ffmpegプロセスを停止（各ジョブは失敗として後片付けされる）"""
+        with self.process_lock:
+            processes = list(self.active_processes)
+        for process in processes:
+            process.terminate()
+    
+    def encode_two_pass(self, input_path, output_path, target_bitrate, preset_config, duration,
+                        threads=None, show_progress=True, label='', passlog_dir=None, reuse_first_pass=False):
+        """2-passエンコード（パスログはジョブ専用の一時ディレクトリに隔離）
+        
+        passlog_dir を渡すと統計ファイルがエンコード後も残り、reuse_first_pass=True で
+        同じ入力・プリセットの Pass 1 を省略して Pass 2 だけをやり直せる。
+        """
+        if passlog_dir is None:
+            # 同じディレクトリで複数ジョブが動いても統計ファイルが衝突しないようにする
+            with self.scratch_directory() as scratch_dir:
+                self.encode_two_pass(input_path, output_path, target_bitrate, preset_config, duration,
+                                     threads, show_progress, label, passlog_dir=scratch_dir)
+            return
+        
+        passlog_prefix = str(Path(passlog_dir) / 'ffmpeg2pass')
+        for cmd, pass_name in self.two_pass_commands(input_path, output_path, target_bitrate, preset_config,
+                                                      passlog_prefix, threads, reuse_first_pass, label):
+            self.run_ffmpeg_with_progress(cmd, duration, pass_name, show_progress)
+    
+    def two_pass_commands(self, input_path, output_path, target_bitrate, preset_config, passlog_prefix,
+                          threads=None, reuse_first_pass=False, label=''):
+        """2-passエンコードの ffmpeg コマンドと表示名の組を返す（reuse_first_pass=True なら Pass 2 のみ）"""
+        # ジョブ毎のスレッド数（並列バッチ時にコア数を分け合う）
+        thread_args = ['-threads', str(threads)] if threads else []
+        commands = []
+        
+        # 2-pass エンコーディング
+        # Pass 1（統計を取るだけなので音声・字幕は読まず、x264 の高速な1パス目の設定を使う）
+        if not reuse_first_pass:
+            cmd_pass1 = [
+                'ffmpeg', '-y', '-i', str(input_path),
+                *self.video_filter_args(preset_config),
+                '-an', '-sn', '-dn',
+                '-c:v', 'libx264',
+                '-b:v', str(target_bitrate),
+                '-pass', '1',
+                '-passlogfile', passlog_prefix,
+                '-preset', preset_config['preset'],
+                '-fastfirstpass', '1',
+                *thread_args,
+                '-f', 'null',
+                '/dev/null' if os.name != 'nt' else 'NUL'
+            ]
+            
+            commands.append((cmd_pass1, f"{label}Pass 1/2: 分析中"))
+        
+        # Pass 2
+        cmd_pass2 = [
+            'ffmpeg', '-y', '-i', str(input_path),
+            *self.video_filter_args(preset_config),
+            '-c:v', 'libx264',
+            '-b:v', str(target_bitrate),
+            '-pass', '2',
+            '-passlogfile', passlog_prefix,
+            '-preset', preset_config['preset'],
+            *thread_args,
+            '-c:a', 'aac',
+            '-b:a', '128k',
+            str(output_path)
+        ]
+        
+        commands.append((cmd_pass2, f"{label}Pass 2/2: エンコード中"))
+        return commands
+    
+    def calculate_corrected_bitrate(self, output_path, current_bitrate, target_size_mb, duration):
+        """実際の出力サイズから目標サイズに収まる映像ビットレートを再計算"""
+        output_bits = os.path.getsize(output_path) * 8
+        target_bits = target_size_mb * 8 * 1024 * 1024 * self.CONVERGENCE_MARGIN
+        
+        # 出力の映像ストリームの実ビットレート（取得できなければ指定値とみなす）
+        actual_video_bitrate = self.get_stream_bitrate(output_path, 'video') or current_bitrate
+        if current_bitrate is None:
+            # CRFエンコードの後は実ビットレートを基準に補正する
+            current_bitrate = actual_video_bitrate
+        
+        # 音声とコンテナのオーバーヘッドは映像ビットレートに依存しないものとして差し引く
+        video_bits = actual_video_bitrate * duration
+        other_bits = max(0, output_bits - video_bits)
+        corrected = int(current_bitrate * (target_bits - other_bits) / video_bits)
+        
+        # 毎回少なくとも5%は下げて必ず収束に向かわせる
+        corrected = min(corrected, int(current_bitrate * 0.95))
+        return max(corrected, self.MIN_CONVERGED_BITRATE)
+    
+    def get_stream_bitrate(self, file_path, codec_type):
+        """指定種別の最初のストリームのビットレート（bps）を取得（不明な場合は None）"""
+        for stream in self.get_video_info(file_path, use_cache=False).get('streams', []):
+            if stream.get('codec_type') == codec_type and stream.get('bit_rate'):
+                return int(stream['bit_rate'])
+        return None
+    
+    def predict_crf(self, input_path, preset_config, duration, video_bitrate, threads=None):
+        """短いサンプルを試験CRFでエンコードし、目標ビットレートに収まるCRFを予測
+        
+        戻り値の confident が False の場合は予測が当てにならないため 2-pass を使う。
+        """
+        sample_count = self.PREDICTION_SAMPLES
+        sample_seconds = self.PREDICTION_SAMPLE_SECONDS
+        trial_crf = preset_config['crf']
+        prediction = {
+            'trial_crf': trial_crf,
+            'crf': None,
+            'predicted_bitrate': None,
+            'sample_bitrates': [],
+            'confident': False,
+            'reason': None
+        }
+        
+        # サンプルが全体の大部分を占めるような短い動画では予測の意味がない
+        if duration < sample_count * sample_seconds * 4:
+            prediction['reason'] = '動画が短いため'
+            return prediction
+        
+        thread_args = ['-threads', str(threads)] if threads else []
+        with self.scratch_directory() as scratch_dir, \
+                self.telemetry.span('predict', f"{sample_count}サンプル (crf {trial_crf})"):
+            for i in range(sample_count):
+                # 均等な間隔でサンプルを取る
+                start = duration * (i + 0.5) / sample_count - sample_seconds / 2
+                sample_path = Path(scratch_dir) / f"sample_{i}.mp4"
+                cmd = [
+                    'ffmpeg', '-y', '-v', 'error',
+                    '-ss', f"{max(0.0, start):.3f}", '-t', str(sample_seconds),
+                    '-i', str(input_path),
+                    '-map', '0:v:0', '-an',
+                    *self.video_filter_args(preset_config),
+                    '-c:v', 'libx264',
+                    '-crf', str(trial_crf),
+                    '-preset', preset_config['preset'],
+                    *thread_args,
+                    str(sample_path)
+                ]
+                process = self.start_process(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                if self.wait_process(process) != 0 or not sample_path.exists():
+                    prediction['reason'] = 'サンプルのエンコードに失敗したため'
+                    return prediction
+                prediction['sample_bitrates'].append(sample_path.stat().st_size * 8 / sample_seconds)
+        
+        sample_bitrates = prediction['sample_bitrates']
+        mean_bitrate = sum(sample_bitrates) / len(sample_bitrates)
+        variance = sum((bitrate - mean_bitrate) ** 2 for bitrate in sample_bitrates) / len(sample_bitrates)
+        variation = variance ** 0.5 / mean_bitrate if mean_bitrate > 0 else float('inf')
+        
+        # x264 ではCRFが6上がるとビットレートがおよそ半分になる
+        crf = trial_crf + 6 * math.log2(mean_bitrate / video_bitrate) if mean_bitrate > 0 else trial_crf
+        crf = max(float(trial_crf), math.ceil(crf * 2) / 2)
+        prediction['crf'] = crf
+        prediction['predicted_bitrate'] = int(min(mean_bitrate * 2 ** (-(crf - trial_crf) / 6), video_bitrate))
+        
+        if variation > self.PREDICTION_MAX_VARIATION:
+            prediction['reason'] = f'サンプル間のばらつきが大きいため ({variation:.2f})'
+        elif crf - trial_crf > self.PREDICTION_MAX_CRF_DELTA or crf > self.PREDICTION_MAX_CRF:
+            prediction['reason'] = f'試験CRFからの外挿が大きすぎるため (crf {crf})'
+        else:
+            prediction['confident'] = True
+        
+        return prediction
+    
+    def log_prediction_error(self, prediction, output_path, input_path):
+        """予測ビットレートと実際の結果の誤差を表示し、設定があればJSON Linesで記録"""
+        actual_bitrate = self.get_stream_bitrate(output_path, 'video')
+        if not actual_bitrate or not prediction['predicted_bitrate']:
+            return
+        
+        error = (actual_bitrate - prediction['predicted_bitrate']) / prediction['predicted_bitrate']
+        self.log(f"{Colors.BLUE}予測誤差:{Colors.NC} {error * 100:+.1f}% "
+              f"(予測 {prediction['predicted_bitrate']}bps, 実際 {actual_bitrate}bps)")
+        
+        log_file = self.config.get('default_settings', {}).get('prediction_log')
+        if log_file:
+            record = {
+                'input': str(input_path),
+                'trial_crf': prediction['trial_crf'],
+                'crf': prediction['crf'],
+                'sample_bitrates': prediction['sample_bitrates'],
+                'predicted_bitrate': prediction['predicted_bitrate'],
+                'actual_bitrate': actual_bitrate,
+                'error': error,
+                'timestamp': time.time()
+            }
+            with open(Path(log_file).expanduser(), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    
+    def encode_crf(self, input_path, output_path, crf, max_bitrate, preset_config, duration,
+                   threads=None, show_progress=True):
+        """上限ビットレート付きCRFで1-passエンコード"""
+        thread_args = ['-threads', str(threads)] if threads else []
+        cmd = [
+            'ffmpeg', '-y', '-i', str(input_path),
+            *self.video_filter_args(preset_config),
+            '-c:v', 'libx264',
+            '-crf', str(crf),
+            '-maxrate', str(max_bitrate),
+            '-bufsize', str(max_bitrate * 2),
+            '-preset', preset_config['preset'],
+            *thread_args,
+            '-c:a', 'aac',
+            '-b:a', '128k',
+            str(output_path)
+        ]
+        
+        self.run_ffmpeg_with_progress(cmd, duration, f"1-pass: エンコード中 (crf {crf})", show_progress)
+    
+    def resolve_chunks(self, chunks, duration):
+        """分割エンコードのセグメント数を決定（短すぎるセグメントは作らない）"""
+        max_chunks = max(1, int(duration // self.MIN_SEGMENT_SECONDS))
+        
+        if chunks == 'auto':
+            chunk_count = os.cpu_count() or 1
+        else:
+            chunk_count = int(chunks or 1)
+        
+        return max(1, min(chunk_count, max_chunks))
     
-    def load_config(self, config_file=None):
-        """設定ファイルを読み込み"""
-        if config_file is None:
-            # スクリプトと同じディレクトリのconfig.jsonを探す
-            script_dir = Path(__file__).parent
-            config_file = script_dir / "config.json"
+    def allocate_segment_bitrates(self, target_bitrate, segments):
+        """セグメント毎のビットレートを配分（合計ビット数は全体の目標と一致させる）
         
-        if Path(config_file).exists():
-            try:
-                with open(config_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                print(f"{Colors.YELLOW}警告: 設定ファイル読み込みエラー - {e}{Colors.NC}")
+        segments は (長さ秒, 元データのバイト数) のリスト。元データのビットレートを
+        複雑さの目安とし、差が極端にならないよう平方根で緩和して配分する。
+        """
+        total_duration = sum(duration for duration, _ in segments)
+        total_bytes = sum(size for _, size in segments)
+        if total_duration <= 0 or total_bytes <= 0:
+            return [target_bitrate for _ in segments]
         
-        # デフォルト設定を返す
-        return {
-            "default_settings": {
-                "target_size_mb": 45,
-                "quality_preset": "medium",
-                "audio_bitrate": "128k"
-            },
-            "profiles": {}
-        }
+        mean_rate = total_bytes / total_duration
+        weights = []
+        for duration, size in segments:
+            rate = size / duration if duration > 0 else mean_rate
+            weights.append(min(max((rate / mean_rate) ** 0.5, 0.5), 2.0))
+        
+        # sum(bitrate_i * duration_i) == target_bitrate * total_duration となるよう正規化
+        scale = total_duration / sum(weight * duration for weight, (duration, _) in zip(weights, segments))
+        return [int(target_bitrate * weight * scale) for weight in weights]
     
-    def get_profile_settings(self, profile_name):
-        """プロファイル設定を取得"""
-        if profile_name in self.config.get('profiles', {}):
-            profile = self.config['profiles'][profile_name]
-            return {
-                'target_size_mb': profile.get('target_size_mb', 45),
-                'quality_preset': profile.get('quality_preset', 'medium')
-            }
-        return None
+    def encode_segmented(self, input_path, output_path, target_bitrate, preset_config, duration, chunk_count,
+                         threads=None, show_progress=True):
+        """キーフレーム位置で分割し、セグメントを並列に2-passエンコードして無劣化で結合"""
+        with self.scratch_directory() as scratch_dir:
+            scratch_path = Path(scratch_dir)
+            
+            # 映像のみをストリームコピーで分割（キーフレーム位置で切られる）
+            split_times = ','.join(f"{duration * i / chunk_count:.3f}" for i in range(1, chunk_count))
+            cmd_split = [
+                'ffmpeg', '-y', '-i', str(input_path),
+                '-map', '0:v:0', '-c', 'copy',
+                '-f', 'segment',
+                '-segment_times', split_times,
+                '-reset_timestamps', '1',
+                str(scratch_path / 'src_%03d.mkv')
+            ]
+            self.run_ffmpeg_with_progress(cmd_split, duration, "分割中", show_progress, stage='split')
+            
+            source_segments = sorted(scratch_path.glob('src_*.mkv'))
+            segment_durations = [self.get_video_duration(self.get_video_info(segment, use_cache=False))
+                                 for segment in source_segments]
+            segment_bitrates = self.allocate_segment_bitrates(
+                target_bitrate,
+                [(seg_duration, segment.stat().st_size)
+                 for seg_duration, segment in zip(segment_durations, source_segments)]
+            )
+            
+            # コア数をセグメントのワーカーで分け合う
+            total_threads = threads or os.cpu_count() or 1
+            workers = max(1, min(len(source_segments), total_threads))
+            threads_per_segment = max(1, total_threads // workers)
+            self.log(f"{Colors.BLUE}分割エンコード:{Colors.NC} {len(source_segments)}セグメント, "
+                  f"{workers}並列 (セグメント毎のスレッド数: {threads_per_segment})")
+            
+            encoded_segments = [scratch_path / f"enc_{i:03d}.mp4" for i in range(len(source_segments))]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # 各セグメントの計測区間をジョブの子にするため、呼び出し元のコンテキストで実行
+                futures = [
+                    executor.submit(contextvars.copy_context().run, self.encode_two_pass,
+                                    segment, encoded, bitrate, preset_config, seg_duration,
+                                    threads_per_segment, show_progress, f"[{i + 1}/{len(source_segments)}] ")
+                    for i, (segment, encoded, bitrate, seg_duration) in enumerate(
+                        zip(source_segments, encoded_segments, segment_bitrates, segment_durations))
+                ]
+                for future in futures:
+                    future.result()
+            
+            # concat demuxer で再エンコードせずに結合し、音声は元ファイルから付与
+            concat_list = scratch_path / 'concat.txt'
+            with open(concat_list, 'w', encoding='utf-8') as f:
+                for encoded in encoded_segments:
+                    escaped = str(encoded.resolve()).replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+            
+            cmd_concat = [
+                'ffmpeg', '-y',
+                '-f', 'concat', '-safe', '0', '-i', str(concat_list),
+                '-i', str(input_path),
+                '-map', '0:v:0', '-map', '1:a:0?',
+                '-c:v', 'copy',
+                '-c:a', 'aac',
+                '-b:a', '128k',
+                str(output_path)
+            ]
+            self.run_ffmpeg_with_progress(cmd_concat, duration, "結合中", show_progress, stage='concat')
     
-    def check_ffmpeg(self):
-        """ffmpegの存在確認"""
-        if not shutil.which('ffmpeg'):
-            print(f"{Colors.RED}エラー: ffmpegがインストールされていません{Colors.NC}")
-            print("以下のコマンドでインストールしてください:")
-            print("  macOS: brew install ffmpeg")
-            print("  Ubuntu: sudo apt install ffmpeg")
-            print("  Windows: https://ffmpeg.org/download.html")
-            sys.exit(1)
+    def copy_file(self, source, destination, allow_link=False):
+        """目標サイズ以下の入力をそのままコピー（計測区間 copy として記録）
+        
+        reflink・copy_file_range が使えればデータを転送せずに済ませ、allow_link=True ならハードリンクを優先する。
+        """
+        with self.telemetry.span('copy', Path(source).name) as span:
+            method = copy_file_fast(source, destination, allow_link)
+            span.input_bytes = span.output_bytes = os.path.getsize(destination)
+            span.attributes['method'] = method
+            self.record_io(method, span.output_bytes)
     
-    def get_file_size_mb(self, file_path):
-        """ファイルサイズを取得（MB単位）"""
-        return os.path.getsize(file_path) / (1024 * 1024)
+    @staticmethod
+    def partial_path(output_path, directory=None):
+        """書きかけの出力の一意なパス（directory を省略すると出力先と同じディレクトリ）"""
+        # mkstemp は権限が 0600 になるため、umask に従って ffmpeg に作成させる一意な名前を使う
+        name = f".{output_path.stem}.{uuid.uuid4().hex[:12]}.partial{output_path.suffix}"
+        return Path(directory) / name if directory else output_path.with_name(name)
     
-    def get_video_info(self, file_path):
-        """動画の情報を取得"""
-        cmd = [
-            'ffprobe', '-v', 'quiet', '-print_format', 'json',
-            '-show_format', '-show_streams', str(file_path)
-        ]
+    @contextmanager
+    def atomic_output(self, output_path, staging=True):
+        """一時ファイルを渡し、正常終了時のみ出力パスへ原子的に置き換える
         
+        作業ディレクトリが設定されていれば一時ファイルはそこに作る。入力をコピーするだけの場合は
+        staging=False で出力先の隣に直接作り、作業ディレクトリとの間の余分なコピーを避ける。
+        """
+        output_path = Path(output_path)
+        temp_path = self.partial_path(output_path, self.scratch_dir if staging else None)
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            return json.loads(result.stdout)
-        except subprocess.CalledProcessError as e:
-            print(f"{Colors.RED}エラー: 動画情報の取得に失敗しました{Colors.NC}")
-            print(f"ffprobe error: {e.stderr}")
-            sys.exit(1)
+            yield temp_path
+            self.place_output(temp_path, output_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
     
-    def get_video_duration(self, video_info):
-        """動画の長さを取得（秒）"""
-        return float(video_info['format']['duration'])
+    def place_output(self, temp_path, output_path):
+        """完成した一時ファイルを出力パスへ移す（別のファイルシステムなら隣にコピーしてから置き換える）"""
+        size = os.path.getsize(temp_path)
+        try:
+            os.replace(temp_path, output_path)
+            self.record_io('rename', size)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        
+        partial_path = self.partial_path(output_path)
+        try:
+            method = copy_file_fast(temp_path, partial_path)
+            os.replace(partial_path, output_path)
+        finally:
+            if partial_path.exists():
+                partial_path.unlink()
+        self.record_io(method, size)
     
-    def calculate_target_bitrate(self, target_size_mb, duration_sec):
-        """目標ビットレートを計算"""
-        target_size_bits = target_size_mb * 8 * 1024 * 1024
-        target_bitrate = int(target_size_bits / duration_sec)
+    def compress_video(self, input_file, output_file, target_size_mb=45, quality_preset='medium',
+                       threads=None, show_progress=True, chunks=None, converge=False, max_iterations=3,
+                       predict=False, passthrough=True, ladder=True, min_bpp=None, verify=False, min_ssim=None):
+        """動画を圧縮して CompressionResult を返す
         
-        # 音声ビットレート（128kbps）を差し引く
-        audio_bitrate = 128000
-        video_bitrate = target_bitrate - audio_bitrate
+        passthrough=True なら映像を再エンコードせずに収まる場合はストリームコピーで済ませ、
+        ladder=True なら bits-per-pixel が min_bpp を下回らないよう解像度・フレームレートを下げる。
+        verify=True なら再エンコードした出力の SSIM / PSNR をサンプリングで計測し、min_ssim を
+        下回った場合は一段低い解像度で再エンコードして品質の良い方を残す。
+        """
+        if max_iterations < 0:
+            raise ValueError(f"max_iterations は0以上を指定してください: {max_iterations}")
         
-        # 最小ビットレートを確保
-        if video_bitrate < 500000:
-            video_bitrate = 500000
-            
-        return video_bitrate
+        def encode(output_path, min_bpp, ladder=ladder):
+            return self._compress_video(input_file, output_path, target_size_mb, quality_preset, threads,
+                                        show_progress, chunks, converge, max_iterations, predict, passthrough,
+                                        ladder, min_bpp)
+        
+        with self.job_span(input_file, target_size_mb, quality_preset) as span:
+            result = encode(output_file, min_bpp)
+            if (verify or min_ssim is not None) and result.strategy in self.VERIFY_STRATEGIES:
+                result = self.verify_and_retry(result, min_ssim, lambda path, bpp: encode(path, bpp, ladder=True))
+            self.record_job_result(span, result)
+            self.print_io_summary(result)
+            return result
+    
+    @contextmanager
+    def job_span(self, input_file, target_size_mb, quality_preset, measure_cpu=True):
+        """1ファイルの圧縮全体の計測区間（子の区間にもプリセット・入力ファイル名が付く）"""
+        with self.telemetry.span('job', Path(input_file).name, measure_cpu, input_file=str(input_file),
+                                 preset=quality_preset, target_size_mb=target_size_mb) as span:
+            yield span
     
-    def run_ffmpeg_with_progress(self, cmd, duration, pass_name):
-        """ffmpegを実行してプログレスを表示"""
-        print(f"{Colors.YELLOW}{pass_name}...{Colors.NC}")
+    def record_job_result(self, span, result):
+        result.bytes_moved = span.bytes_moved
+        result.io = dict(span.io)
+        if result.quality is not None:
+            span.attributes.update(ssim=result.quality['ssim_min'], psnr=result.quality['psnr_min'])
+        span.input_bytes = result.input_size
+        span.output_bytes = result.output_size
+        span.attributes.update(strategy=result.strategy, iterations=result.iterations,
+                               within_target=result.within_target)
+    
+    def verify_quality(self, input_path, output_path, samples=None, sample_seconds=None):
+        """等間隔のサンプル区間で出力を入力と比べ、SSIM / PSNR を並列に計測
         
-        # プログレスバーを初期化
-        progress_bar = ProgressBar(duration)
+        出力は入力の解像度に拡大してから比べる。戻り値はサンプルの平均と最小値・各サンプルの値の
+        辞書で、計測できなかった場合は None。
+        """
+        samples = samples or self.verify_samples
+        input_info = self.get_video_info(input_path)
+        geometry = self.get_video_geometry(input_info)
+        duration = self.get_video_duration(input_info)
+        if geometry is None or duration <= 0:
+            return None
+        width, height, _ = geometry
+        sample_seconds = min(sample_seconds or self.verify_seconds, duration / samples)
+        starts = [max(0.0, duration * (i + 0.5) / samples - sample_seconds / 2) for i in range(samples)]
         
-        # アニメーションスレッドを開始
-        animation_thread = threading.Thread(target=progress_bar.animate_spinner)
-        animation_thread.daemon = True
-        animation_thread.start()
+        with self.telemetry.span('verify', f"{samples}サンプル x {sample_seconds:g}秒") as span:
+            with ThreadPoolExecutor(max_workers=min(samples, os.cpu_count() or 1)) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, self.measure_sample, input_path,
+                                           output_path, start, sample_seconds, width, height)
+                           for start in starts]
+                scores = [future.result() for future in futures]
+            scores = [score for score in scores if score is not None]
+            if not scores:
+                self.log(f"{Colors.YELLOW}警告: 品質を計測できませんでした{Colors.NC}")
+                return None
+            quality = {
+                'ssim': sum(score['ssim'] for score in scores) / len(scores),
+                'ssim_min': min(score['ssim'] for score in scores),
+                'psnr': sum(score['psnr'] for score in scores) / len(scores),
+                'psnr_min': min(score['psnr'] for score in scores),
+                'samples': scores
+            }
+            span.attributes.update(ssim=quality['ssim_min'], psnr=quality['psnr_min'])
         
-        process = subprocess.Popen(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE, 
-            universal_newlines=True
+        self.log(f"{Colors.BLUE}品質検証:{Colors.NC} SSIM {quality['ssim']:.4f} (最小 {quality['ssim_min']:.4f}), "
+                 f"PSNR {quality['psnr']:.2f}dB (最小 {quality['psnr_min']:.2f}dB) - {len(scores)}サンプル")
+        return quality
+    
+    def measure_sample(self, input_path, output_path, start, sample_seconds, width, height):
+        """1サンプル区間の SSIM / PSNR を ffmpeg の ssim・psnr フィルタで計測（失敗時は None）"""
+        seek = ['-ss', f"{start:.3f}", '-t', f"{sample_seconds:.3f}"]
+        filter_graph = (
+            f"[0:v]scale={width}:{height}:flags=bicubic,format=yuv420p,setpts=PTS-STARTPTS,split[d0][d1];"
+            f"[1:v]format=yuv420p,setpts=PTS-STARTPTS,split[r0][r1];"
+            f"[d0][r0]ssim;[d1][r1]psnr"
         )
+        cmd = [
+            'ffmpeg', '-hide_banner', '-nostats',
+            *seek, '-i', str(output_path),
+            *seek, '-i', str(input_path),
+            '-filter_complex', filter_graph,
+            '-f', 'null', '-'
+        ]
+        process = self.start_process(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                     universal_newlines=True, errors='replace')
+        stderr = process.stderr.read()
+        if self.wait_process(process) != 0:
+            return None
+        ssim = re.search(r'SSIM .*All:([\d.]+)', stderr)
+        psnr = re.search(r'PSNR .*average:([\d.]+|inf)', stderr)
+        if not ssim or not psnr:
+            return None
+        return {'start': round(start, 3), 'ssim': float(ssim.group(1)), 'psnr': float(psnr.group(1))}
+    
+    def verify_and_retry(self, result, min_ssim, encode):
+        """出力の品質を検証し、min_ssim を下回れば一段低い解像度で再エンコードして良い方を残す
         
-        # プログレス監視
-        stderr_lines = []
-        for line in process.stderr:
-            stderr_lines.append(line)
-            # 時間の進行を取得
-            time_match = re.search(r'time=(\d+):(\d+):(\d+\.\d+)', line)
-            if time_match:
-                hours = int(time_match.group(1))
-                minutes = int(time_match.group(2))
-                seconds = float(time_match.group(3))
-                current_time = hours * 3600 + minutes * 60 + seconds
-                
-                progress_bar.update_progress(current_time)
+        encode(出力パス, min_bpp) は同じ設定で再エンコードして CompressionResult を返す関数。
+        """
+        result.quality = self.verify_quality(result.input_file, result.output_file)
+        retry_min_bpp = self.quality_retry_min_bpp(result, min_ssim)
+        if retry_min_bpp is None:
+            return result
+        
+        self.log(f"{Colors.YELLOW}解像度を下げて再エンコードします{Colors.NC}")
+        output_path = Path(result.output_file)
+        retry_path = self.partial_path(output_path)
+        try:
+            retry = encode(str(retry_path), retry_min_bpp)
+            retry.quality = self.verify_quality(result.input_file, retry_path)
+            retry.iterations += result.iterations
+            retry.elapsed += result.elapsed
+            if retry.quality is None or retry.quality['ssim_min'] <= result.quality['ssim_min']:
+                self.log(f"{Colors.YELLOW}再エンコードでも品質が改善しないため元の出力を残します{Colors.NC}")
+                return result
+            os.replace(retry_path, output_path)
+            retry.output_file = str(output_path)
+            if retry.quality['ssim_min'] < min_ssim:
+                self.log(f"{Colors.YELLOW}⚠️  再エンコード後も品質が基準を下回っています{Colors.NC}")
+            return retry
+        finally:
+            if retry_path.exists():
+                retry_path.unlink()
+    
+    def quality_retry_min_bpp(self, result, min_ssim):
+        """品質が基準を下回った場合に、一段低いラダーの段を選ばせる min_bpp（再エンコードしない場合は None）"""
+        quality = result.quality
+        if min_ssim is None or quality is None or quality['ssim_min'] >= min_ssim:
+            return None
+        self.log(f"{Colors.YELLOW}品質が基準を下回りました (SSIM {quality['ssim_min']:.4f} < {min_ssim}){Colors.NC}")
         
-        process.wait()
+        geometry = self.get_video_geometry(self.get_video_info(result.output_file, use_cache=False))
+        bottom_short, bottom_fps = self.LADDER[-1]
+        if geometry is None or geometry[2] <= 0 or not result.duration:
+            return None
+        width, height, fps = geometry
+        if min(width, height) <= bottom_short and fps <= bottom_fps + 0.01:
+            self.log(f"{Colors.YELLOW}これ以上解像度を下げられないため再エンコードしません{Colors.NC}")
+            return None
+        bitrate = self.calculate_target_bitrate(result.target_size_mb, result.duration, min_bitrate=1)
+        return bitrate / (width * height * fps) * self.QUALITY_RETRY_BPP_STEP
+    
+    def print_io_summary(self, result):
+        """出力の配置・コピーの方法と転送量を表示"""
+        if not result.io:
+            return
+        methods = ', '.join(f"{method} {size / (1024 * 1024):.2f}MB" for method, size in sorted(result.io.items()))
+        self.log(f"{Colors.BLUE}I/O:{Colors.NC} {methods}（データ転送: {result.bytes_moved / (1024 * 1024):.2f}MB）")
+    
+    def _compress_video(self, input_file, output_file, target_size_mb, quality_preset, threads, show_progress,
+                        chunks, converge, max_iterations, predict, passthrough, ladder, min_bpp):
+        start_time = time.perf_counter()
+        input_path = Path(input_file)
+        final_output_path = Path(output_file)
+        current_size_mb = self.start_compression(input_path, target_size_mb)
         
-        # アニメーションを停止
-        progress_bar.stop()
-        animation_thread.join(timeout=0.1)
+        # 既に目標サイズ以下の場合（作業ディレクトリを経由せず出力先の隣に直接コピーする）
+        if current_size_mb <= target_size_mb:
+            self.log(f"{Colors.GREEN}ファイルは既に目標サイズ以下です。コピーのみ実行します。{Colors.NC}")
+            with self.atomic_output(final_output_path, staging=False) as output_path:
+                self.copy_file(input_path, output_path)
+                result = self.make_result(input_path, output_path, final_output_path, target_size_mb, 'copy',
+                                          start_time)
+            self.log(f"{Colors.GREEN}完了: {output_file}{Colors.NC}")
+            return result
         
-        # 最終プログレスを表示
-        final_bar = progress_bar.draw_progress_bar(100)
-        print(f"\r{Colors.GREEN}✓{Colors.NC} {final_bar} 100.0% {Colors.GREEN}完了{Colors.NC}")
+        # 途中で失敗・中断しても壊れた出力が残らないよう、一時ファイルに書いてから置き換える
+        with self.atomic_output(final_output_path) as output_path:
+            # 動画情報を取得
+            video_info = self.get_video_info(input_path)
+            duration = self.get_video_duration(video_info)
+            self.log(f"{Colors.BLUE}動画の長さ:{Colors.NC} {duration:.2f}秒")
+            
+            # 映像がそのまま収まるなら、再多重化・トラック削除・音声のみの再エンコードで済ませる
+            plan = self.select_passthrough(video_info, input_path, duration, target_size_mb) if passthrough else None
+            if plan is not None:
+                try:
+                    self.encode_passthrough(input_path, output_path, plan, duration, show_progress)
+                except EncodeError as e:
+                    # コンテナが受け付けないストリームなどで失敗しても、通常の再エンコードなら成功しうる
+                    self.log(f"{Colors.YELLOW}パススルーに失敗したため再エンコードします: {e}{Colors.NC}")
+                else:
+                    if self.get_file_size_mb(output_path) <= target_size_mb:
+                        return self.finish_compression(input_path, output_path, final_output_path, output_file,
+                                                       target_size_mb, plan['strategy'], start_time, duration)
+                    self.log(f"{Colors.YELLOW}パススルーでは目標サイズに収まらないため再エンコードします{Colors.NC}")
+            
+            preset_config, target_bitrate = self.prepare_encode(video_info, duration, target_size_mb,
+                                                                quality_preset, ladder, min_bpp)
+            
+            # 同じ内容・設定の入力を圧縮済みなら ffmpeg を起動せずに出力を作る
+            cache_key, cache_hit = self.fetch_cached_output(
+                input_path, output_path, target_size_mb, preset_config,
+                chunks=chunks, converge=converge, max_iterations=max_iterations if converge else None, predict=predict
+            )
+            if cache_hit:
+                return self.finish_compression(input_path, output_path, final_output_path, output_file,
+                                               target_size_mb, 'cache', start_time, duration,
+                                               converge=converge, max_iterations=max_iterations)
+            
+            self.log(f"{Colors.YELLOW}圧縮を開始しています...{Colors.NC}")
+            
+            chunk_count = self.resolve_chunks(chunks, duration)
+            
+            # サンプルから1-pass CRFで収まるか予測（分割エンコード時は各セグメントが2-pass）
+            prediction = None
+            if predict and chunk_count == 1:
+                prediction = self.predict_crf(input_path, preset_config, duration, target_bitrate, threads)
+                if prediction['confident']:
+                    self.log(f"{Colors.BLUE}予測CRF:{Colors.NC} {prediction['crf']} "
+                          f"(予測ビットレート: {prediction['predicted_bitrate']}bps)")
+                else:
+                    self.log(f"{Colors.YELLOW}予測の信頼度が低いため 2-pass を使用します: {prediction['reason']}{Colors.NC}")
+            
+            # 収束ループで Pass 1 の統計を再利用できるよう、パスログはジョブ全体で保持
+            with self.scratch_directory() as passlog_dir:
+                video_bitrate = target_bitrate
+                first_pass_done = False
+                iterations = 0
+                for iteration in range(max_iterations + 1):
+                    if iteration > 0:
+                        video_bitrate = self.next_converge_bitrate(output_path, video_bitrate, target_size_mb,
+                                                                   duration, iteration, max_iterations)
+                        if video_bitrate is None:
+                            break
+                    
+                    if chunk_count > 1:
+                        strategy = 'segmented'
+                        self.encode_segmented(input_path, output_path, video_bitrate, preset_config, duration,
+                                              chunk_count, threads=threads, show_progress=show_progress)
+                    elif iteration == 0 and prediction and prediction['confident']:
+                        strategy = 'crf'
+                        self.encode_crf(input_path, output_path, prediction['crf'], target_bitrate, preset_config,
+                                        duration, threads=threads, show_progress=show_progress)
+                        self.log_prediction_error(prediction, output_path, input_path)
+                        # 超過した場合は実ビットレートを基準に 2-pass で補正する
+                        video_bitrate = None
+                    else:
+                        # 同じ入力・プリセットなので再エンコード時は Pass 2 のみ実行
+                        strategy = 'two_pass'
+                        ran_first_pass = not first_pass_done
+                        if ran_first_pass:
+                            # 同じ入力・ビットレートで以前に実行した Pass 1 の統計があれば再利用
+                            first_pass_key, first_pass_done = self.fetch_first_pass(input_path, passlog_dir,
+                                                                                    video_bitrate, preset_config)
+                            ran_first_pass = not first_pass_done
+                        self.encode_two_pass(input_path, output_path, video_bitrate, preset_config, duration,
+                                             threads=threads, show_progress=show_progress,
+                                             passlog_dir=passlog_dir, reuse_first_pass=first_pass_done)
+                        if ran_first_pass:
+                            self.store_first_pass(first_pass_key, input_path, passlog_dir)
+                        first_pass_done = True
+                    iterations += 1
+                    
+                    if not converge:
+                        break
+            
+            result = self.make_result(input_path, output_path, final_output_path, target_size_mb, strategy,
+                                      start_time, duration, video_bitrate, iterations)
         
-        if process.returncode != 0:
-            error_output = '\n'.join(stderr_lines[-10:])  # 最後の10行のみ表示
-            print(f"{Colors.RED}エラー: ffmpegの実行に失敗しました{Colors.NC}")
-            print(f"Error details: {error_output}")
-            sys.exit(1)
+        self.store_cached_output(cache_key, input_path, final_output_path)
+        self.print_compression_result(final_output_path, output_file, current_size_mb, target_size_mb,
+                                      converge, max_iterations)
+        return result
+    
+    async def compress_video_async(self, input_file, output_file, target_size_mb=45, quality_preset='medium',
+                                   threads=None, show_progress=False, converge=False, max_iterations=3,
+                                   passthrough=True, ladder=True, min_bpp=None):
+        """compress_video の asyncio 版（ffprobe / ffmpeg を asyncio のサブプロセスとして実行）
+        
+        1つのイベントループで複数のエンコードを並行して進められる。タスクがキャンセルされると
+        実行中の ffmpeg を停止し、一時ファイルを削除してから CancelledError を送出する。
+        分割エンコード（chunks）・CRF予測（predict）・品質検証（verify）には対応しない。
+        """
+        if max_iterations < 0:
+            raise ValueError(f"max_iterations は0以上を指定してください: {max_iterations}")
+        with self.job_span(input_file, target_size_mb, quality_preset, measure_cpu=False) as span:
+            result = await self._compress_video_async(input_file, output_file, target_size_mb, quality_preset,
+                                                      threads, show_progress, converge, max_iterations, passthrough,
+                                                      ladder, min_bpp)
+            self.record_job_result(span, result)
+            self.print_io_summary(result)
+            return result
     
-    def compress_video(self, input_file, output_file, target_size_mb=45, quality_preset='medium'):
-        """動画を圧縮"""
+    async def _compress_video_async(self, input_file, output_file, target_size_mb, quality_preset, threads,
+                                    show_progress, converge, max_iterations, passthrough, ladder, min_bpp):
+        start_time = time.perf_counter()
         input_path = Path(input_file)
-        output_path = Path(output_file)
+        final_output_path = Path(output_file)
+        current_size_mb = self.start_compression(input_path, target_size_mb)
         
-        # 入力ファイルの確認
-        if not input_path.exists():
-            print(f"{Colors.RED}エラー: ファイル '{input_file}' が見つかりません{Colors.NC}")
-            sys.exit(1)
+        if current_size_mb <= target_size_mb:
+            self.log(f"{Colors.GREEN}ファイルは既に目標サイズ以下です。コピーのみ実行します。{Colors.NC}")
+            with self.atomic_output(final_output_path, staging=False) as output_path:
+                await asyncio.to_thread(self.copy_file, input_path, output_path)
+                return self.make_result(input_path, output_path, final_output_path, target_size_mb, 'copy',
+                                        start_time)
         
-        # 現在のファイルサイズを確認
-        current_size_mb = self.get_file_size_mb(input_path)
-        print(f"{Colors.BLUE}入力ファイル:{Colors.NC} {input_file}")
-        print(f"{Colors.BLUE}現在のサイズ:{Colors.NC} {current_size_mb:.2f}MB")
-        print(f"{Colors.BLUE}目標サイズ:{Colors.NC} {target_size_mb}MB")
+        with self.atomic_output(final_output_path) as output_path:
+            video_info = await self.get_video_info_async(input_path)
+            duration = self.get_video_duration(video_info)
+            self.log(f"{Colors.BLUE}動画の長さ:{Colors.NC} {duration:.2f}秒")
+            
+            plan = self.select_passthrough(video_info, input_path, duration, target_size_mb) if passthrough else None
+            if plan is not None:
+                try:
+                    await self.run_ffmpeg_async(self.passthrough_command(input_path, output_path, plan), duration,
+                                                f"パススルー: {plan['description']}中", show_progress,
+                                                stage='passthrough')
+                except EncodeError as e:
+                    self.log(f"{Colors.YELLOW}パススルーに失敗したため再エンコードします: {e}{Colors.NC}")
+                else:
+                    if self.get_file_size_mb(output_path) <= target_size_mb:
+                        return self.finish_compression(input_path, output_path, final_output_path, output_file,
+                                                       target_size_mb, plan['strategy'], start_time, duration)
+                    self.log(f"{Colors.YELLOW}パススルーでは目標サイズに収まらないため再エンコードします{Colors.NC}")
+            
+            preset_config, target_bitrate = self.prepare_encode(video_info, duration, target_size_mb,
+                                                                quality_preset, ladder, min_bpp)
+            
+            # 大きなファイルのハッシュ計算でイベントループを止めないようスレッドで実行
+            cache_key, cache_hit = await asyncio.to_thread(
+                self.fetch_cached_output, input_path, output_path, target_size_mb, preset_config,
+                chunks=None, converge=converge, max_iterations=max_iterations if converge else None, predict=False
+            )
+            if cache_hit:
+                return self.finish_compression(input_path, output_path, final_output_path, output_file,
+                                               target_size_mb, 'cache', start_time, duration,
+                                               converge=converge, max_iterations=max_iterations)
+            
+            self.log(f"{Colors.YELLOW}圧縮を開始しています...{Colors.NC}")
+            
+            with self.scratch_directory() as passlog_dir:
+                passlog_prefix = str(Path(passlog_dir) / 'ffmpeg2pass')
+                video_bitrate = target_bitrate
+                first_pass_key, first_pass_done = await asyncio.to_thread(
+                    self.fetch_first_pass, input_path, passlog_dir, video_bitrate, preset_config
+                )
+                iterations = 0
+                for iteration in range(max_iterations + 1):
+                    if iteration > 0:
+                        video_bitrate = await asyncio.to_thread(
+                            self.next_converge_bitrate, output_path, video_bitrate, target_size_mb, duration,
+                            iteration, max_iterations
+                        )
+                        if video_bitrate is None:
+                            break
+                    
+                    for cmd, pass_name in self.two_pass_commands(input_path, output_path, video_bitrate,
+                                                                  preset_config, passlog_prefix, threads,
+                                                                  reuse_first_pass=first_pass_done):
+                        await self.run_ffmpeg_async(cmd, duration, pass_name, show_progress)
+                    if not first_pass_done:
+                        await asyncio.to_thread(self.store_first_pass, first_pass_key, input_path, passlog_dir)
+                        first_pass_done = True
+                    iterations += 1
+                    
+                    if not converge:
+                        break
+            
+            result = self.make_result(input_path, output_path, final_output_path, target_size_mb, 'two_pass',
+                                      start_time, duration, video_bitrate, iterations)
         
-        # 既に目標サイズ以下の場合
-        if current_size_mb <= target_size_mb:
-            print(f"{Colors.GREEN}ファイルは既に目標サイズ以下です。コピーのみ実行します。{Colors.NC}")
-            shutil.copy2(input_path, output_path)
-            print(f"{Colors.GREEN}完了: {output_file}{Colors.NC}")
-            return
+        await asyncio.to_thread(self.store_cached_output, cache_key, input_path, final_output_path)
+        self.print_compression_result(final_output_path, output_file, current_size_mb, target_size_mb,
+                                      converge, max_iterations)
+        return result
+    
+    def start_compression(self, input_path, target_size_mb):
+        """入力を確認して概要を表示し、入力サイズ（MB）を返す"""
+        if not input_path.exists():
+            raise InputNotFoundError(f"ファイル '{input_path}' が見つかりません")
         
-        # 動画情報を取得
-        video_info = self.get_video_info(input_path)
-        duration = self.get_video_duration(video_info)
-        print(f"{Colors.BLUE}動画の長さ:{Colors.NC} {duration:.2f}秒")
+        current_size_mb = self.get_file_size_mb(input_path)
+        self.log(f"{Colors.BLUE}入力ファイル:{Colors.NC} {input_path}")
+        self.log(f"{Colors.BLUE}現在のサイズ:{Colors.NC} {current_size_mb:.2f}MB")
+        self.log(f"{Colors.BLUE}目標サイズ:{Colors.NC} {target_size_mb}MB")
+        return current_size_mb
+    
+    def select_passthrough(self, video_info, input_path, duration, target_size_mb):
+        """ストリーム毎のビットレートを表示し、映像を再エンコードしない方法を選ぶ（なければ None）"""
+        streams = self.analyze_streams(video_info, os.path.getsize(input_path))
+        self.log(f"{Colors.BLUE}ストリーム:{Colors.NC}")
+        for stream in streams:
+            bitrate = f"{stream['bitrate'] / 1000:.0f}kbps" if stream['bitrate'] else "不明"
+            note = " (推定)" if stream['estimated'] else ""
+            self.log(f"  #{stream['index']} {stream['codec_type']} {stream['codec_name']}: {bitrate}{note}")
         
+        plan = self.plan_passthrough(streams, duration, target_size_mb)
+        if plan is not None:
+            self.log(f"{Colors.BLUE}パススルー:{Colors.NC} {plan['description']} "
+                     f"(推定サイズ: {plan['estimated_size_mb']:.2f}MB)")
+        return plan
+    
+    def prepare_encode(self, video_info, duration, target_size_mb, quality_preset, ladder=True, min_bpp=None):
+        """エンコード設定（ラダーのフィルタを含む）と目標ビットレートを決める"""
         # 品質プリセットを取得
         preset_config = self.quality_presets.get(quality_preset, self.quality_presets['medium'])
         
         # 目標ビットレートを計算
         target_bitrate = self.calculate_target_bitrate(target_size_mb, duration)
-        print(f"{Colors.BLUE}目標ビットレート:{Colors.NC} {target_bitrate}bps")
-        print(f"{Colors.BLUE}品質プリセット:{Colors.NC} {quality_preset} (preset: {preset_config['preset']}, crf: {preset_config['crf']})")
+        self.log(f"{Colors.BLUE}目標ビットレート:{Colors.NC} {target_bitrate}bps")
+        self.log(f"{Colors.BLUE}品質プリセット:{Colors.NC} {quality_preset} (preset: {preset_config['preset']}, crf: {preset_config['crf']})")
         
-        print(f"{Colors.YELLOW}圧縮を開始しています...{Colors.NC}")
+        # 目標ビットレートに対して画素数が多すぎる場合は縮小・フレームレートを下げてからエンコード
+        if ladder:
+            rung = self.select_ladder_rung(
+                video_info, self.calculate_target_bitrate(target_size_mb, duration, min_bitrate=1), min_bpp
+            )
+            if rung and rung['filters']:
+                preset_config = {**preset_config, 'filters': rung['filters']}
+                source_width, source_height, source_fps = rung['source']
+                self.log(f"{Colors.BLUE}解像度ラダー:{Colors.NC} {source_width}x{source_height}@{source_fps:.3g} → "
+                         f"{rung['width']}x{rung['height']}@{rung['fps']:.3g} (bpp {rung['bpp']:.3f})")
+        return preset_config, target_bitrate
+    
+    def fetch_cached_output(self, input_path, output_path, target_size_mb, preset_config, **options):
+        """出力キャッシュにあれば output_path に出力を作る（戻り値は (保存用のキー, ヒットしたか)）"""
+        if self.output_cache is None:
+            return None, False
         
-        # 2-pass エンコーディング
-        # Pass 1
-        cmd_pass1 = [
-            'ffmpeg', '-y', '-i', str(input_path),
-            '-c:v', 'libx264',
-            '-b:v', str(target_bitrate),
-            '-pass', '1',
-            '-preset', preset_config['preset'],
-            '-f', 'null',
-            '/dev/null' if os.name != 'nt' else 'NUL'
-        ]
+        settings = self.output_cache_settings(target_size_mb, preset_config, **options)
+        try:
+            cache_key = self.output_cache.key(input_path, settings)
+            cached_path = self.output_cache.lookup(cache_key, input_path)
+            if cached_path is not None:
+                self.output_cache.materialize(cached_path, output_path)
+                self.log(f"{Colors.GREEN}キャッシュ済みの圧縮結果を使用します（エンコードを省略）{Colors.NC}")
+                return cache_key, True
+            return cache_key, False
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"{Colors.YELLOW}警告: 出力キャッシュを参照できません - {e}{Colors.NC}")
+            return None, False
+    
+    def store_cached_output(self, cache_key, input_path, output_path):
+        """エンコード結果を出力キャッシュに登録（失敗しても圧縮自体は成功として扱う）"""
+        if cache_key is None:
+            return
+        try:
+            self.output_cache.store(cache_key, input_path, output_path)
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"{Colors.YELLOW}警告: 出力キャッシュに保存できません - {e}{Colors.NC}")
+    
+    def fetch_first_pass(self, input_path, passlog_dir, video_bitrate, preset_config):
+        """同じ入力・ビットレート・設定の Pass 1 統計があれば passlog_dir に復元（戻り値は (保存用のキー, 復元したか)）"""
+        if self.output_cache is None:
+            return None, False
         
-        self.run_ffmpeg_with_progress(cmd_pass1, duration, "Pass 1/2: 分析中")
+        settings = {
+            'pass': 1,
+            'bitrate': video_bitrate,
+            'preset': preset_config['preset'],
+            'filters': preset_config.get('filters', []),
+            'encoder': self.get_encoder_version()
+        }
+        try:
+            cache_key = self.output_cache.key(input_path, settings)
+            if self.output_cache.lookup_passlog(cache_key, input_path, passlog_dir):
+                self.log(f"{Colors.GREEN}キャッシュ済みの Pass 1 統計を使用します（Pass 1 を省略）{Colors.NC}")
+                return cache_key, True
+            return cache_key, False
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"{Colors.YELLOW}警告: 出力キャッシュを参照できません - {e}{Colors.NC}")
+            return None, False
+    
+    def store_first_pass(self, cache_key, input_path, passlog_dir):
+        """Pass 1 の統計を出力キャッシュに登録（失敗しても圧縮自体は成功として扱う）"""
+        if cache_key is None:
+            return
+        try:
+            self.output_cache.store_passlog(cache_key, input_path, passlog_dir)
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"{Colors.YELLOW}警告: 出力キャッシュに保存できません - {e}{Colors.NC}")
+    
+    def next_converge_bitrate(self, output_path, video_bitrate, target_size_mb, duration, iteration, max_iterations):
+        """収束ループの次のビットレート（目標サイズに収まっていれば None）"""
+        output_size_mb = self.get_file_size_mb(output_path)
+        if output_size_mb <= target_size_mb:
+            return None
+        video_bitrate = self.calculate_corrected_bitrate(output_path, video_bitrate, target_size_mb, duration)
+        self.log(f"{Colors.YELLOW}目標サイズ超過 ({output_size_mb:.2f}MB)。"
+                 f"ビットレートを {video_bitrate}bps に補正して再エンコードします "
+                 f"({iteration}/{max_iterations}){Colors.NC}")
+        return video_bitrate
+    
+    def make_result(self, input_path, output_path, final_output_path, target_size_mb, strategy, start_time,
+                    duration=None, video_bitrate=None, iterations=1):
+        """CompressionResult を作成（output_path は置き換え前の一時ファイル）"""
+        return CompressionResult(
+            input_path, final_output_path, os.path.getsize(input_path), os.path.getsize(output_path),
+            target_size_mb, strategy, duration=duration, video_bitrate=video_bitrate, iterations=iterations,
+            elapsed=time.perf_counter() - start_time
+        )
+    
+    def finish_compression(self, input_path, output_path, final_output_path, output_file, target_size_mb, strategy,
+                           start_time, duration, converge=False, max_iterations=3):
+        """エンコードせずに出力を作った場合の結果表示と CompressionResult の作成"""
+        self.print_compression_result(output_path, output_file, self.get_file_size_mb(input_path), target_size_mb,
+                                      converge, max_iterations)
+        return self.make_result(input_path, output_path, final_output_path, target_size_mb, strategy, start_time,
+                                duration)
+    
+    def print_compression_result(self, output_path, output_file, current_size_mb, target_size_mb,
+                                 converge=False, max_iterations=3):
+        """圧縮結果を表示"""
+        output_size_mb = self.get_file_size_mb(output_path)
+        compression_ratio = 100 - (output_size_mb * 100 / current_size_mb)
         
-        # Pass 2
-        cmd_pass2 = [
-            'ffmpeg', '-y', '-i', str(input_path),
-            '-c:v', 'libx264',
-            '-b:v', str(target_bitrate),
-            '-pass', '2',
-            '-preset', preset_config['preset'],
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            str(output_path)
-        ]
+        self.log()
+        self.log(f"{Colors.GREEN}圧縮完了!{Colors.NC}")
+        self.log(f"{Colors.BLUE}出力ファイル:{Colors.NC} {output_file}")
+        self.log(f"{Colors.BLUE}圧縮後サイズ:{Colors.NC} {output_size_mb:.2f}MB")
+        self.log(f"{Colors.BLUE}圧縮率:{Colors.NC} {compression_ratio:.1f}%")
         
-        self.run_ffmpeg_with_progress(cmd_pass2, duration, "Pass 2/2: エンコード中")
+        # 目標サイズチェック
+        if output_size_mb <= target_size_mb:
+            self.log(f"{Colors.GREEN}✅ 目標サイズ({target_size_mb}MB)以下です{Colors.NC}")
+        elif converge:
+            self.log(f"{Colors.YELLOW}⚠️  {max_iterations}回の再エンコードでも{target_size_mb}MBに収まりませんでした{Colors.NC}")
+        else:
+            self.log(f"{Colors.YELLOW}⚠️  まだ{target_size_mb}MBを超えています。"
+                  f"--converge で自動的に再圧縮できます{Colors.NC}")
+    
+    def compress_profiles(self, input_file, output_directory, profile_names, threads=None, show_progress=True,
+                          ladder=True):
+        """1回のデコードから複数プロファイルの出力を同時にエンコード
         
-        # ログファイルを削除
-        for log_file in ['ffmpeg2pass-0.log', 'ffmpeg2pass-0.log.mbtree']:
-            if os.path.exists(log_file):
-                os.remove(log_file)
+        1つのffmpegプロセスに複数の出力を指定し、Pass 1/Pass 2 それぞれで入力の
+        デコードを全プロファイルで共有する（N個のプロファイルで2Nではなく2回のデコード）。
+        """
+        input_path = Path(input_file)
+        output_path = Path(output_directory) if output_directory else Path('.')
         
-        # 結果を表示
-        output_size_mb = self.get_file_size_mb(output_path)
-        compression_ratio = 100 - (output_size_mb * 100 / current_size_mb)
+        if not input_path.exists():
+            raise InputNotFoundError(f"ファイル '{input_file}' が見つかりません")
+        
+        output_path.mkdir(parents=True, exist_ok=True)
+        current_size_mb = self.get_file_size_mb(input_path)
+        video_info = self.get_video_info(input_path)
+        duration = self.get_video_duration(video_info)
+        self.log(f"{Colors.BLUE}入力ファイル:{Colors.NC} {input_file}")
+        self.log(f"{Colors.BLUE}現在のサイズ:{Colors.NC} {current_size_mb:.2f}MB")
+        self.log(f"{Colors.BLUE}動画の長さ:{Colors.NC} {duration:.2f}秒")
         
-        print()
-        print(f"{Colors.GREEN}圧縮完了!{Colors.NC}")
-        print(f"{Colors.BLUE}出力ファイル:{Colors.NC} {output_file}")
-        print(f"{Colors.BLUE}圧縮後サイズ:{Colors.NC} {output_size_mb:.2f}MB")
-        print(f"{Colors.BLUE}圧縮率:{Colors.NC} {compression_ratio:.1f}%")
+        # プロファイル毎のエンコード設定
+        outputs = []
+        for profile_name in profile_names:
+            settings = self.get_profile_settings(profile_name)
+            if settings is None:
+                raise ProfileNotFoundError(f"プロファイル '{profile_name}' が見つかりません")
+            
+            output_file = output_path / f"{input_path.stem}_{profile_name}.mp4"
+            if current_size_mb <= settings['target_size_mb']:
+                self.log(f"{Colors.GREEN}{profile_name}: 既に目標サイズ以下です。コピーのみ実行します。{Colors.NC}")
+                with self.atomic_output(output_file, staging=False) as temp_output:
+                    self.copy_file(input_path, temp_output)
+                continue
+            
+            preset_config = self.quality_presets.get(settings['quality_preset'], self.quality_presets['medium'])
+            target_bitrate = self.calculate_target_bitrate(settings['target_size_mb'], duration)
+            rung = None
+            if ladder and settings['ladder']:
+                rung = self.select_ladder_rung(
+                    video_info, self.calculate_target_bitrate(settings['target_size_mb'], duration, min_bitrate=1),
+                    settings['min_bpp']
+                )
+            filters = rung['filters'] if rung else []
+            resolution = f", {rung['width']}x{rung['height']}@{rung['fps']:.3g}" if filters else ""
+            self.log(f"{Colors.BLUE}{profile_name}:{Colors.NC} 目標 {settings['target_size_mb']}MB, "
+                  f"{target_bitrate}bps, preset {preset_config['preset']}{resolution}")
+            outputs.append({
+                'profile': profile_name,
+                'output_file': output_file,
+                'target_size_mb': settings['target_size_mb'],
+                'bitrate': target_bitrate,
+                'preset': preset_config['preset'],
+                'filters': filters
+            })
         
-        # Discord制限チェック
-        if output_size_mb <= 50:
-            print(f"{Colors.GREEN}✅ Discordにアップロード可能です{Colors.NC}")
-        else:
-            print(f"{Colors.YELLOW}⚠️  まだ50MBを超えています。さらに圧縮が必要です{Colors.NC}")
+        if not outputs:
+            return
+        
+        thread_args = ['-threads', str(threads)] if threads else []
+        start_time = time.perf_counter()
+        
+        with self.scratch_directory() as scratch_dir, ExitStack() as stack:
+            # 全出力を一時ファイルに書き、全て成功した場合のみ置き換える
+            temp_outputs = [stack.enter_context(self.atomic_output(output['output_file'])) for output in outputs]
+            
+            # Pass 1: 全プロファイル分まとめて解析
+            # パスログ名は全出力を通したストリーム番号で決まるため、Pass 2 と同じ割り当てになるよう
+            # 音声もマップする（ストリームコピーなのでデコードは発生しない）
+            cmd_pass1 = ['ffmpeg', '-y', '-i', str(input_path)]
+            for i, output in enumerate(outputs):
+                cmd_pass1 += [
+                    '-map', '0:v:0', '-map', '0:a:0?',
+                    *self.video_filter_args(output),
+                    '-c:v', 'libx264',
+                    '-b:v', str(output['bitrate']),
+                    '-pass', '1',
+                    '-passlogfile', str(Path(scratch_dir) / f"ffmpeg2pass_{i}"),
+                    '-preset', output['preset'],
+                    '-fastfirstpass', '1',
+                    *thread_args,
+                    '-c:a', 'copy',
+                    '-f', 'null',
+                    '/dev/null' if os.name != 'nt' else 'NUL'
+                ]
+            self.run_ffmpeg_with_progress(cmd_pass1, duration, f"Pass 1/2: 分析中 ({len(outputs)}プロファイル)",
+                                          show_progress)
+            
+            # Pass 2: 同じデコード結果から各プロファイルの出力を書き出す
+            cmd_pass2 = ['ffmpeg', '-y', '-i', str(input_path)]
+            for i, (output, temp_output) in enumerate(zip(outputs, temp_outputs)):
+                cmd_pass2 += [
+                    '-map', '0:v:0', '-map', '0:a:0?',
+                    *self.video_filter_args(output),
+                    '-c:v', 'libx264',
+                    '-b:v', str(output['bitrate']),
+                    '-pass', '2',
+                    '-passlogfile', str(Path(scratch_dir) / f"ffmpeg2pass_{i}"),
+                    '-preset', output['preset'],
+                    *thread_args,
+                    '-c:a', 'aac',
+                    '-b:a', '128k',
+                    str(temp_output)
+                ]
+            self.run_ffmpeg_with_progress(cmd_pass2, duration, f"Pass 2/2: エンコード中 ({len(outputs)}プロファイル)",
+                                          show_progress)
+        
+        elapsed = time.perf_counter() - start_time
+        
+        # 結果を表示
+        self.log()
+        self.log(f"{Colors.GREEN}圧縮完了!{Colors.NC} ({elapsed:.1f}秒, 入力のデコード: 2回 / "
+              f"プロファイル毎に実行した場合: {len(outputs) * 2}回)")
+        for output in outputs:
+            output_size_mb = self.get_file_size_mb(output['output_file'])
+            status = (f"{Colors.GREEN}✅{Colors.NC}" if output_size_mb <= output['target_size_mb']
+                      else f"{Colors.YELLOW}⚠️{Colors.NC}")
+            self.log(f"{status} {output['profile']}: {output['output_file']} "
+                  f"{output_size_mb:.2f}MB (目標 {output['target_size_mb']}MB)")
     
-    def batch_compress(self, input_directory, output_directory=None, target_size_mb=45, quality_preset='medium'):
-        """ディレクトリ内の全動画ファイルを一括圧縮"""
+    def batch_compress(self, input_directory, output_directory=None, target_size_mb=45, quality_preset='medium',
+                       jobs=1, resume=False, include=None, exclude=None, recursive=True, under_target='copy',
+                       budget_mb=None, **options):
+        """ディレクトリ以下の動画ファイルを一括圧縮（options は compress_video にそのまま渡す）
+        
+        ファイルは走査しながら順にジョブとして投入し、出力先には入力のディレクトリ構成を再現する。
+        目標サイズ以下のファイルはジョブにせず、under_target に従ってコピー・ハードリンク（link）・
+        スキップ（skip）する。各ジョブの状態は出力ディレクトリのジャーナルに記録され、resume=True の
+        場合は同じ入力・設定で完了済みのジョブを飛ばして未完了・失敗・入力が変わったものだけを再実行する。
+        budget_mb を指定すると target_size_mb の代わりに、全出力の合計がこの予算に収まるよう
+        複雑度の事前解析に基づいてファイル毎の目標サイズを配分する（全ファイルの走査後に開始）。
+        """
         input_path = Path(input_directory)
         
         if not input_path.exists() or not input_path.is_dir():
-            print(f"{Colors.RED}エラー: ディレクトリ '{input_directory}' が見つかりません{Colors.NC}")
-            sys.exit(1)
+            raise InputNotFoundError(f"ディレクトリ '{input_directory}' が見つかりません")
         
         # 出力ディレクトリの設定
         if output_directory is None:
@@ -302,55 +3371,523 @@ class VideoCompressor:
         else:
             output_path = Path(output_directory)
         
-        output_path.mkdir(exist_ok=True)
+        output_path.mkdir(parents=True, exist_ok=True)
+        
+        journal = BatchJournal(output_path / BatchJournal.FILE_NAME, reset=not resume)
+        settings = self.journal_settings(target_size_mb, quality_preset,
+                                         options if budget_mb is None else {**options, 'budget_mb': budget_mb})
+        target_bytes = target_size_mb * 1024 * 1024
+        counts = {'found': 0, 'complete': 0, 'under_target': 0, 'queued': 0, 'success': 0, 'failed': 0}
+        # ファイル毎の目標サイズ（予算を配分した場合のみ）と、完了済みの出力の合計サイズ
+        targets = {}
+        complete_bytes = 0
+        
+        def job_key(video_file):
+            return video_file.relative_to(input_path).as_posix()
+        
+        def output_file_for(video_file):
+            relative = video_file.relative_to(input_path)
+            return output_path / relative.parent / f"{video_file.stem}_compressed.mp4"
+        
+        def work_items():
+            """走査結果から、完了済み・目標サイズ以下のファイルを除いてジョブにするものだけを返す"""
+            nonlocal complete_bytes
+            # 出力先が入力ディレクトリの下にあっても出力を再び圧縮しないよう除外する
+            for video_file in self.scan_videos(input_path, include, exclude, recursive, exclude_dirs=[output_path]):
+                counts['found'] += 1
+                key = job_key(video_file)
+                output_file = output_file_for(video_file)
+                fingerprint = BatchJournal.fingerprint(video_file)
+                if resume and journal.is_complete(key, fingerprint, settings, output_file):
+                    counts['complete'] += 1
+                    complete_bytes += output_file.stat().st_size
+                    continue
+                # 予算を配分する場合は配分後に目標サイズ以下かを判定する
+                if budget_mb is None and fingerprint['size'] <= target_bytes:
+                    counts['under_target'] += 1
+                    self._place_batch_item_under_target(video_file, output_file, under_target, journal, key,
+                                                        fingerprint, settings, overwrite=resume)
+                    continue
+                journal.record(key, state='pending', input=str(video_file), output=str(output_file),
+                               fingerprint=fingerprint, settings=settings)
+                counts['queued'] += 1
+                yield video_file
+        
+        job_count, threads_per_job = self.resolve_jobs(jobs, math.inf)
+        
+        self.log(f"{Colors.BLUE}バッチ処理開始{Colors.NC}")
+        self.log(f"{Colors.BLUE}入力ディレクトリ:{Colors.NC} {input_directory}")
+        self.log(f"{Colors.BLUE}出力ディレクトリ:{Colors.NC} {output_path}")
+        video_files = work_items()
+        if budget_mb is not None:
+            planned_files = list(video_files)
+            targets = self.plan_budget(planned_files, budget_mb * 1024 * 1024 - complete_bytes)
+            video_files = []
+            for video_file in planned_files:
+                # 配分が入力サイズ以上になったファイルはエンコードしない
+                if targets[video_file] * 1024 * 1024 < video_file.stat().st_size:
+                    video_files.append(video_file)
+                    continue
+                counts['queued'] -= 1
+                counts['under_target'] += 1
+                key = job_key(video_file)
+                self._place_batch_item_under_target(video_file, output_file_for(video_file), under_target, journal,
+                                                    key, journal.get(key)['fingerprint'], settings, overwrite=resume)
+        if job_count > 1:
+            self.log(f"{Colors.BLUE}並列ジョブ数:{Colors.NC} {job_count} (ジョブ毎のスレッド数: {threads_per_job})")
+            # 長い動画を先に投入してバッチ全体の終了を早める（全体を待たず一定件数毎に並べ替える）
+            video_files = self.order_by_duration(video_files, self.SCAN_WINDOW)
+        self.log()
+        
+        def run_item(video_file, threads):
+            return self._compress_batch_item(video_file, output_file_for(video_file),
+                                             targets.get(video_file, target_size_mb),
+                                             quality_preset, threads, options, journal, job_key(video_file),
+                                             overwrite=resume)
         
-        # 動画ファイルの拡張子
-        video_extensions = {'.mp4', '.mov', '.avi', '.mkv', '.wmv', '.flv', '.webm', '.m4v'}
+        def finish_item(video_file, status, index):
+            if status in ('success', 'failed'):
+                counts[status] += 1
+            self.log(f"{Colors.CYAN}[{index}/{counts['queued']}] {job_key(video_file)}: {status}{Colors.NC}")
+            self.log("-" * 50)
         
-        # 動画ファイルを検索
-        video_files = [f for f in input_path.iterdir() 
-                      if f.is_file() and f.suffix.lower() in video_extensions]
+        try:
+            if job_count == 1:
+                for i, video_file in enumerate(video_files, 1):
+                    self.log(f"{Colors.CYAN}[{i}] 処理中: {job_key(video_file)}{Colors.NC}")
+                    status, error = run_item(video_file, None)
+                    finish_item(video_file, status, i)
+            else:
+                with ThreadPoolExecutor(max_workers=job_count) as executor:
+                    # 走査を先に進めすぎないよう、投入済みで未完了のジョブはジョブ数の2倍までにする
+                    futures = {}
+                    finished = 0
+                    
+                    def collect():
+                        nonlocal finished
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            status, error = future.result()
+                            finished += 1
+                            finish_item(futures.pop(future), status, finished)
+                    
+                    for video_file in video_files:
+                        if len(futures) >= job_count * 2:
+                            collect()
+                        futures[executor.submit(run_item, video_file, threads_per_job)] = video_file
+                    while futures:
+                        collect()
+        finally:
+            journal.close()
+        
+        if counts['found'] == 0:
+            self.log(f"{Colors.YELLOW}処理対象の動画ファイルが見つかりませんでした{Colors.NC}")
+            return
+        if resume and counts['complete']:
+            self.log(f"{Colors.BLUE}再開:{Colors.NC} {counts['complete']}個は完了済みのためスキップしました")
+        if counts['queued'] == 0 and counts['under_target'] == 0:
+            self.log(f"{Colors.GREEN}全てのファイルが処理済みです{Colors.NC}")
+            return
         
-        if not video_files:
-            print(f"{Colors.YELLOW}処理対象の動画ファイルが見つかりませんでした{Colors.NC}")
+        # 結果サマリー
+        self.log(f"{Colors.BLUE}バッチ処理完了{Colors.NC}")
+        self.log(f"{Colors.GREEN}成功: {counts['success']}個{Colors.NC}")
+        if counts['under_target']:
+            action = {'copy': 'コピー', 'link': 'リンク', 'skip': 'スキップ'}[under_target]
+            self.log(f"{Colors.GREEN}目標サイズ以下: {counts['under_target']}個（エンコードせずに{action}）{Colors.NC}")
+        if counts['failed'] > 0:
+            self.log(f"{Colors.RED}失敗: {counts['failed']}個{Colors.NC}")
+            self.log(f"{Colors.YELLOW}--resume で未完了のファイルだけを再実行できます{Colors.NC}")
+        if budget_mb is not None:
+            output_files = [output_file_for(video_file) for video_file in targets]
+            total_bytes = complete_bytes + sum(path.stat().st_size for path in output_files if path.exists())
+            color = Colors.GREEN if total_bytes <= budget_mb * 1024 * 1024 else Colors.YELLOW
+            self.log(f"{color}出力の合計: {total_bytes / (1024 * 1024):.2f}MB / 予算 {budget_mb}MB{Colors.NC}")
+    
+    def _place_batch_item_under_target(self, video_file, output_file, mode, journal, job_key, fingerprint, settings,
+                                       overwrite=False):
+        """目標サイズ以下の入力をジョブにせずに出力先へ置く（mode: copy / link / skip）"""
+        journal.record(job_key, input=str(video_file), output=str(output_file), fingerprint=fingerprint,
+                       settings=settings)
+        if mode == 'skip' or (output_file.exists() and not overwrite):
+            journal.record(job_key, state='skipped')
+            return
+        try:
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            with self.atomic_output(output_file, staging=False) as temp_output:
+                self.copy_file(video_file, temp_output, allow_link=(mode == 'link'))
+        except OSError as e:
+            self.log(f"{Colors.RED}❌ エラー: {job_key} - {e}{Colors.NC}")
+            journal.record(job_key, state='failed', finished_at=time.time(), error=str(e))
             return
+        journal.record(job_key, state='done', finished_at=time.time(), elapsed=0,
+                       output_size=output_file.stat().st_size)
+    
+    def watch_directory(self, input_directory, output_directory=None, target_size_mb=45, quality_preset='medium',
+                        jobs=1, queue_size=None, settle_seconds=5.0, poll_interval=2.0, **options):
+        """ディレクトリを監視し、書き込みが終わった動画を順次圧縮（Ctrl+C / SIGTERM で終了）
         
-        print(f"{Colors.BLUE}バッチ処理開始:{Colors.NC} {len(video_files)}個のファイルを処理します")
-        print(f"{Colors.BLUE}入力ディレクトリ:{Colors.NC} {input_directory}")
-        print(f"{Colors.BLUE}出力ディレクトリ:{Colors.NC} {output_path}")
-        print()
+        サイズと更新時刻が settle_seconds 変化しなくなったファイルを上限付きのキューに入れ、
+        固定数のワーカーで処理する。キューが満杯の間は監視側で保留して投入を待たせる。
+        ジョブの状態は batch_compress と同じジャーナルに記録し、完了済み・処理中のファイルは
+        再投入しない。1回目のシグナルでは実行中のジョブの完了を待ち、未着手のジョブは
+        pending のまま次回の起動時に再開する。2回目のシグナルで実行中のジョブも中断する。
+        """
+        input_path = Path(input_directory)
+        if not input_path.is_dir():
+            raise InputNotFoundError(f"ディレクトリ '{input_directory}' が見つかりません")
         
-        successful = 0
-        failed = 0
+        output_path = Path(output_directory) if output_directory else input_path / "compressed"
+        output_path.mkdir(parents=True, exist_ok=True)
         
-        for i, video_file in enumerate(video_files, 1):
-            print(f"{Colors.CYAN}[{i}/{len(video_files)}] 処理中: {video_file.name}{Colors.NC}")
-            
-            try:
-                output_file = output_path / f"{video_file.stem}_compressed.mp4"
+        journal = BatchJournal(output_path / BatchJournal.FILE_NAME)
+        settings = self.journal_settings(target_size_mb, quality_preset, options)
+        job_count, threads_per_job = self.resolve_jobs(jobs, math.inf)
+        work_queue = queue.Queue(maxsize=queue_size or job_count * 2)
+        watcher = DirectoryWatcher(input_path, poll_interval)
+        
+        stop = threading.Event()
+        active_keys = set()
+        keys_lock = threading.Lock()
+        counts = {'success': 0, 'failed': 0}
+        extensions = self.get_video_extensions()
+        
+        def output_file_for(video_file):
+            return output_path / f"{video_file.stem}_compressed.mp4"
+        
+        # 出力先が監視対象と同じ・その中にある場合、書き出した出力を再び圧縮しないようにする
+        input_root = input_path.resolve()
+        output_root = output_path.resolve()
+        
+        def is_own_output(path):
+            if output_root == input_root:
+                return path.stem.endswith('_compressed')
+            return output_root in path.resolve().parents
+        
+        def worker():
+            while True:
+                video_file = work_queue.get()
+                if video_file is None:
+                    return
+                key = video_file.name
+                try:
+                    # 終了処理中は新しいジョブを始めず、pending のまま次回に回す
+                    if not stop.is_set():
+                        status, _ = self._compress_batch_item(video_file, output_file_for(video_file),
+                                                              target_size_mb, quality_preset, threads_per_job,
+                                                              options, journal, key, overwrite=True)
+                        with keys_lock:
+                            if status in counts:
+                                counts[status] += 1
+                finally:
+                    with keys_lock:
+                        active_keys.discard(key)
+        
+        def handle_signal(signum, frame):
+            if not stop.is_set():
+                stop.set()
+                self.log(f"{Colors.YELLOW}終了処理中: 実行中のジョブの完了を待っています"
+                      f"（もう一度で中断）{Colors.NC}")
+            else:
+                self.log(f"{Colors.YELLOW}実行中のジョブを中断しています...{Colors.NC}")
+                self.terminate_active_processes()
+        
+        previous_handlers = {signum: signal.signal(signum, handle_signal)
+                             for signum in (signal.SIGINT, signal.SIGTERM)}
+        # 1回目の Ctrl+C で実行中のエンコードまで止まらないようにする
+        self.detach_processes = True
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(job_count)]
+        for thread in workers:
+            thread.start()
+        
+        self.log(f"{Colors.BLUE}監視開始:{Colors.NC} {input_path} ({watcher.backend})")
+        self.log(f"{Colors.BLUE}出力ディレクトリ:{Colors.NC} {output_path}")
+        self.log(f"{Colors.BLUE}ワーカー数:{Colors.NC} {job_count} (ジョブ毎のスレッド数: {threads_per_job}, "
+              f"キューの上限: {work_queue.maxsize})")
+        
+        # path -> ((サイズ, mtime_ns), 最後に変化を確認した時刻)
+        pending = {path: None for path in watcher.existing_files()}
+        try:
+            while not stop.is_set():
+                for path in watcher.poll(timeout=min(1.0, settle_seconds)):
+                    pending[path] = None
                 
-                # すでに処理済みのファイルがある場合はスキップ
-                if output_file.exists():
-                    print(f"{Colors.YELLOW}スキップ: {output_file.name} は既に存在します{Colors.NC}")
+                now = time.monotonic()
+                for path in list(pending):
+                    if (path.name.startswith('.') or path.suffix.lower() not in extensions
+                            or is_own_output(path)):
+                        del pending[path]
+                        continue
+                    try:
+                        stat = path.stat()
+                    except FileNotFoundError:
+                        del pending[path]
+                        continue
+                    
+                    # サイズ・更新時刻が一定時間変わらなくなるまで書き込み中とみなす
+                    state = (stat.st_size, stat.st_mtime_ns)
+                    previous = pending[path]
+                    if previous is None or previous[0] != state:
+                        pending[path] = (state, now)
+                        continue
+                    if now - previous[1] < settle_seconds:
+                        continue
+                    
+                    key = path.name
+                    fingerprint = BatchJournal.fingerprint(path)
+                    with keys_lock:
+                        duplicate = key in active_keys
+                    if duplicate or journal.is_complete(key, fingerprint, settings, output_file_for(path)):
+                        del pending[path]
+                        continue
+                    
+                    # キューが満杯なら保留したまま、ワーカーが空くのを待つ（バックプレッシャー）
+                    try:
+                        work_queue.put_nowait(path)
+                    except queue.Full:
+                        break
+                    with keys_lock:
+                        active_keys.add(key)
+                    journal.record(key, state='pending', input=str(path), output=str(output_file_for(path)),
+                                   fingerprint=fingerprint, settings=settings)
+                    self.log(f"{Colors.CYAN}キューに追加: {path.name} (待機中: {work_queue.qsize()}){Colors.NC}")
+                    del pending[path]
+        finally:
+            stop.set()
+            for _ in workers:
+                work_queue.put(None)
+            for thread in workers:
+                thread.join()
+            watcher.close()
+            journal.close()
+            self.detach_processes = False
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        
+        self.log(f"{Colors.BLUE}監視を終了しました{Colors.NC}")
+        self.log(f"{Colors.GREEN}成功: {counts['success']}個{Colors.NC}")
+        if counts['failed'] > 0:
+            self.log(f"{Colors.RED}失敗: {counts['failed']}個{Colors.NC}")
+    
+    def serve(self, address='127.0.0.1:8765', output_directory=None, target_size_mb=45, quality_preset='medium',
+              jobs=1, queue_size=None, input_directory=None, **options):
+        """HTTP（TCP または Unix ドメインソケット）でジョブを受け付けて圧縮するサーバー（Ctrl+C / SIGTERM で終了）
+        
+        address は host:port・port・unix:/path のいずれか。target_size_mb・quality_preset・options は
+        ジョブで省略された項目の既定値になる。1回目のシグナルで受け付けを止めて待機中のジョブを取り消し、
+        実行中のジョブの完了を待つ。2回目のシグナルで実行中のジョブも中断する。
+        入力は input_directory の中の動画だけを読み込み、出力は output_directory の中にだけ書き出す
+        （どちらも省略時はカレントディレクトリ）。ジョブではそれぞれのディレクトリからの相対パスで指定する。
+        """
+        kind, listen_address = parse_listen_address(address)
+        input_root = Path(input_directory or '.').resolve()
+        if not input_root.is_dir():
+            raise InputNotFoundError(f"ディレクトリ '{input_directory}' が見つかりません")
+        output_path = Path(output_directory or '.').resolve()
+        output_path.mkdir(parents=True, exist_ok=True)
+        job_count, threads_per_job = self.resolve_jobs(jobs, math.inf)
+        extensions = self.get_video_extensions()
+        
+        def resolve_inside(root, value, name):
+            """クライアントが指定したパスを root の中に解決（絶対パス・..・root の外を指すリンクは ValueError）"""
+            relative = Path(value) if isinstance(value, str) and value else None
+            if relative is None or relative.is_absolute() or '..' in relative.parts:
+                raise ValueError(f"{name} はディレクトリ '{root}' からの相対パスで指定してください: {value!r}")
+            path = (root / relative).resolve()
+            # シンボリックリンク経由でディレクトリの外に出る場合も拒否する
+            if path == root or not path.is_relative_to(root):
+                raise ValueError(f"{name} がディレクトリ '{root}' の外を指しています: {relative}")
+            return path
+        
+        def job_arguments(request):
+            """POST /jobs の JSON から JobServer.submit の引数を作る（不正な値は ValueError）"""
+            if not isinstance(request, dict) or not isinstance(request.get('input_file'), str):
+                raise ValueError("input_file を指定してください")
+            known = {'input_file', 'output_file', 'target_size_mb', 'quality_preset', 'profile', 'priority'}
+            unknown = set(request) - known - set(JobRequestHandler.JOB_OPTIONS)
+            if unknown:
+                raise ValueError(f"不明な項目です: {', '.join(sorted(unknown))}")
+            
+            arguments = {'target_size_mb': target_size_mb, 'quality_preset': quality_preset, **options}
+            if 'profile' in request:
+                profile = self.get_profile_settings(request['profile'])
+                if profile is None:
+                    raise ProfileNotFoundError(f"プロファイル '{request['profile']}' が見つかりません")
+                arguments.update(target_size_mb=profile['target_size_mb'], quality_preset=profile['quality_preset'],
+                                 ladder=profile['ladder'], min_bpp=profile['min_bpp'])
+            for name, expected in {'target_size_mb': (int, float), 'quality_preset': str, 'priority': int,
+                                   **JobRequestHandler.JOB_OPTIONS}.items():
+                if name not in request:
                     continue
-                
-                self.compress_video(str(video_file), str(output_file), target_size_mb, quality_preset)
-                successful += 1
-                print(f"{Colors.GREEN}✅ 完了: {output_file.name}{Colors.NC}")
-                
-            except Exception as e:
-                print(f"{Colors.RED}❌ エラー: {video_file.name} - {str(e)}{Colors.NC}")
-                failed += 1
+                value = request[name]
+                # bool は int のサブクラスなので数値の項目では別に弾く
+                if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+                    raise ValueError(f"{name} の値が不正です: {value!r}")
+                arguments[name] = value
+            if arguments['quality_preset'] not in self.quality_presets:
+                raise ValueError(f"品質プリセット '{arguments['quality_preset']}' はありません")
+            if arguments['target_size_mb'] <= 0:
+                raise ValueError("target_size_mb は正の数を指定してください")
+            if arguments.get('max_iterations', 0) < 0:
+                raise ValueError("max_iterations は0以上を指定してください")
             
-            print("-" * 50)
+            # クライアントが任意のファイルを読み出したり上書きしたりできないよう、各ディレクトリの中に限る
+            input_path = resolve_inside(input_root, request['input_file'], 'input_file')
+            if not input_path.is_file():
+                raise InputNotFoundError(f"ファイル '{request['input_file']}' が見つかりません")
+            # 目標サイズ以下の入力はそのままコピーされるため、動画以外は受け付けない
+            if (input_path.suffix.lower() not in extensions
+                    or self.get_video_geometry(self.get_video_info(input_path)) is None):
+                raise ValueError(f"動画ファイルではありません: {request['input_file']}")
+            output_file = resolve_inside(output_path, request.get('output_file') or f"{input_path.stem}_compressed.mp4",
+                                         'output_file')
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            return {'input_file': input_path, 'output_file': output_file, **arguments}
         
-        # 結果サマリー
-        print(f"{Colors.BLUE}バッチ処理完了{Colors.NC}")
-        print(f"{Colors.GREEN}成功: {successful}個{Colors.NC}")
-        if failed > 0:
-            print(f"{Colors.RED}失敗: {failed}個{Colors.NC}")
+        def log(message):
+            print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+        
+        job_server = JobServer(self, job_count, queue_size, threads_per_job, log=log)
+        if kind == 'unix':
+            # 前回の異常終了で残ったソケットファイルは削除してから待ち受ける
+            if listen_address.is_socket():
+                listen_address.unlink()
+            httpd = JobUnixHTTPServer(listen_address, job_server, job_arguments)
+            # 同じユーザーのプロセスからだけ接続できるようにする
+            os.chmod(listen_address, 0o600)
+            url = f"unix:{listen_address}"
+        else:
+            httpd = JobHTTPServer(listen_address, job_server, job_arguments)
+            host, port = httpd.server_address[:2]
+            url = f"http://{host}:{port}"
+        
+        stopping = threading.Event()
+        
+        def handle_signal(signum, frame):
+            if not stopping.is_set():
+                stopping.set()
+                log(f"{Colors.YELLOW}終了処理中: 実行中のジョブの完了を待っています（もう一度で中断）{Colors.NC}")
+                # serve_forever と同じスレッドから shutdown すると待ち合わせで止まるため別スレッドで呼ぶ
+                threading.Thread(target=httpd.shutdown, daemon=True).start()
+            else:
+                log(f"{Colors.YELLOW}実行中のジョブを中断しています...{Colors.NC}")
+                job_server.cancel_running()
+        
+        previous_handlers = {signum: signal.signal(signum, handle_signal)
+                             for signum in (signal.SIGINT, signal.SIGTERM)}
+        # 1回目の Ctrl+C で実行中のエンコードまで止まらないようにする
+        self.detach_processes = True
+        # 各ジョブの詳細な経過は表示せず、サーバーのログ（受付・開始・終了）だけを出す
+        verbose, self.verbose = self.verbose, False
+        log(f"{Colors.BLUE}待ち受け:{Colors.NC} {url}")
+        log(f"{Colors.BLUE}入力ディレクトリ:{Colors.NC} {input_root}")
+        log(f"{Colors.BLUE}出力ディレクトリ:{Colors.NC} {output_path}")
+        log(f"{Colors.BLUE}ワーカー数:{Colors.NC} {job_count} (ジョブ毎のスレッド数: {threads_per_job}, "
+            f"待ち行列の上限: {queue_size or 'なし'})")
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+            job_server.close()
+            if kind == 'unix' and listen_address.is_socket():
+                listen_address.unlink()
+            self.verbose = verbose
+            self.detach_processes = False
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        
+        counts = job_server.metrics()['jobs']
+        log(f"{Colors.BLUE}サーバーを終了しました{Colors.NC} (完了: {counts['done']}, 失敗: {counts['failed']}, "
+            f"取り消し: {counts['cancelled']})")
+    
+    def journal_settings(self, target_size_mb, quality_preset, options):
+        """ジャーナルに記録する圧縮設定（同じ設定で完了済みかの判定に使う）"""
+        settings = {'target_size_mb': target_size_mb, 'quality_preset': quality_preset}
+        for name, value in sorted(options.items()):
+            if isinstance(value, (str, int, float, bool)) or value is None:
+                settings[name] = value
+        return settings
+    
+    def _compress_batch_item(self, video_file, output_file, target_size_mb, quality_preset, threads, options,
+                             journal, job_key, overwrite=False):
+        """バッチ内の1ファイルを圧縮し、(状態, エラー) を返す"""
+        try:
+            # すでに処理済みのファイルがある場合はスキップ（再開時はジャーナルで判定済み）
+            if output_file.exists() and not overwrite:
+                self.log(f"{Colors.YELLOW}スキップ: {output_file.name} は既に存在します{Colors.NC}")
+                journal.record(job_key, state='skipped')
+                return 'skipped', None
+            
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            started_at = time.time()
+            journal.record(job_key, state='running', started_at=started_at, pid=os.getpid())
+            self.compress_video(str(video_file), str(output_file), target_size_mb, quality_preset,
+                                threads=threads, **options)
+            finished_at = time.time()
+            journal.record(job_key, state='done', finished_at=finished_at, elapsed=finished_at - started_at,
+                           output_size=output_file.stat().st_size)
+            self.log(f"{Colors.GREEN}✅ 完了: {output_file.name}{Colors.NC}")
+            return 'success', None
+            
+        except Exception as e:
+            self.log(f"{Colors.RED}❌ エラー: {video_file.name} - {str(e)}{Colors.NC}")
+            if isinstance(e, EncodeError) and e.stderr:
+                self.log(f"Error details: {e.stderr}")
+            journal.record(job_key, state='failed', finished_at=time.time(), error=str(e))
+            return 'failed', e
 
-def main():
+async def compress(input_file, output_file=None, target_size_mb=45, quality_preset='medium', compressor=None,
+                   **options):
+    """ライブラリ用の非同期APIで1ファイルを圧縮し、CompressionResult を返す
+    
+    出力ファイル名を省略すると入力と同じディレクトリに <名前>_compressed.mp4 を作成する。
+    compressor を省略した場合は何も出力しない VideoCompressor を使う。失敗時は
+    CompressionError のサブクラスを送出する。
+    
+        result = await compress('input.mov', target_size_mb=45)
+    """
+    if compressor is None:
+        compressor = VideoCompressor(verbose=False)
+    if output_file is None:
+        input_path = Path(input_file)
+        output_file = input_path.with_name(f"{input_path.stem}_compressed.mp4")
+    return await compressor.compress_video_async(input_file, output_file, target_size_mb, quality_preset, **options)
+
+def parse_count(value):
+    """--jobs / --chunks の値を解釈（数値または auto）"""
+    if value == 'auto':
+        return value
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"数値または auto を指定してください: {value}")
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"1以上を指定してください: {value}")
+    return jobs
+
+def parse_non_negative(value):
+    """--max-iterations の値を解釈（0以上の整数）"""
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"整数を指定してください: {value}")
+    if count < 0:
+        raise argparse.ArgumentTypeError(f"0以上を指定してください: {value}")
+    return count
+
+def parse_listen_address(address):
+    """--serve の待ち受けアドレスを ('tcp', (host, port)) か ('unix', Path) に変換"""
+    address = str(address)
+    if address.startswith('unix:'):
+        return 'unix', Path(address[len('unix:'):]).expanduser()
+    host, _, port = address.rpartition(':')
+    try:
+        return 'tcp', (host.strip('[]') or '127.0.0.1', int(port))
+    except ValueError:
+        raise ValueError(f"待ち受けアドレスは host:port・port・unix:/path のいずれかで指定してください: {address}")
+
+def build_parser():
+    """コマンドライン引数の定義"""
     parser = argparse.ArgumentParser(
         description="Discord用動画圧縮ツール",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -360,6 +3897,10 @@ def main():
   python compress_video.py input.mov output.mp4
   python compress_video.py input.mov -s 300 -q slow
   python compress_video.py --batch /path/to/videos -s 200
+  python compress_video.py --batch /path/to/videos -j auto
+  python compress_video.py --watch /path/to/inbox -o /path/to/outbox -j 2
+  python compress_video.py long_recording.mov --chunks auto
+  python compress_video.py input.mov --profiles discord,twitter,instagram -o out/
         """
     )
     
@@ -370,14 +3911,118 @@ def main():
     parser.add_argument('-q', '--quality', choices=['fast', 'medium', 'slow', 'high'], 
                        default='medium', help='品質プリセット（デフォルト: medium）')
     parser.add_argument('-p', '--profile', help='設定プロファイルを使用（discord, twitter, instagram, youtube_preview）')
+    parser.add_argument('--profiles', help='複数プロファイルを1回のデコードで同時に出力（カンマ区切り、例: discord,twitter）')
+    parser.add_argument('--config', help='設定ファイルのパス（デフォルト: スクリプトと同じディレクトリの config.json）')
     parser.add_argument('--list-profiles', action='store_true', help='利用可能なプロファイルを表示')
+    parser.add_argument('--no-probe-cache', action='store_true', help='ffprobe結果のキャッシュを使用しない')
+    parser.add_argument('--clear-probe-cache', action='store_true', help='ffprobe結果のキャッシュを削除して終了')
+    parser.add_argument('--no-output-cache', action='store_true', help='圧縮結果のキャッシュを使用しない')
+    parser.add_argument('--clear-output-cache', action='store_true', help='圧縮結果のキャッシュを削除して終了')
+    parser.add_argument('--cache-stats', action='store_true', help='圧縮結果のキャッシュの統計を表示して終了')
     parser.add_argument('--batch', action='store_true', 
                        help='バッチモード: ディレクトリ内の全動画を一括処理')
-    parser.add_argument('-o', '--output-dir', help='バッチモード時の出力ディレクトリ')
+    parser.add_argument('--watch', metavar='DIR',
+                       help='ディレクトリを監視し、追加された動画を順次圧縮（Ctrl+C で終了）')
+    parser.add_argument('--serve', metavar='ADDRESS', nargs='?', const='127.0.0.1:8765',
+                       help='ジョブサーバーとして HTTP で待ち受ける（host:port・port・unix:/path、'
+                            'デフォルト: 127.0.0.1:8765）')
+    parser.add_argument('--input-dir',
+                       help='ジョブサーバーが読み込む入力のディレクトリ（ジョブの input_file はここからの相対パス、'
+                            'デフォルト: カレントディレクトリ）')
+    parser.add_argument('--queue-size', type=int,
+                       help='監視モード / ジョブサーバーの待ち行列の上限（デフォルト: 監視モードはジョブ数の2倍、サーバーはなし）')
+    parser.add_argument('--settle-seconds', type=float, default=5.0,
+                       help='監視モードで書き込み完了とみなすまでの無変化の秒数（デフォルト: 5）')
+    parser.add_argument('-o', '--output-dir', help='バッチモード / 監視モード / --profiles 使用時の出力ディレクトリ')
+    parser.add_argument('--resume', action='store_true',
+                       help='バッチモード: ジャーナルを参照し、未完了・失敗・入力が変更されたファイルだけを再実行')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                       help='バッチモード: 入力ディレクトリからの相対パスがこの glob に一致するファイルだけを処理（複数指定可）')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                       help='バッチモード: この glob に一致するファイル・ディレクトリを除外（複数指定可）')
+    parser.add_argument('--no-recursive', action='store_true',
+                       help='バッチモード: サブディレクトリを処理しない')
+    parser.add_argument('--budget-mb', type=float, metavar='MB',
+                       help='バッチモード: 全出力の合計サイズの予算。複雑度に応じてファイル毎の目標サイズを配分（-s の代わり）')
+    parser.add_argument('--under-target', choices=['copy', 'link', 'skip'], default='copy',
+                       help='バッチモード: 目標サイズ以下のファイルの扱い（コピー / ハードリンク / スキップ、デフォルト: copy）')
+    parser.add_argument('-j', '--jobs', type=parse_count, default=1,
+                       help='バッチモード時の並列ジョブ数（数値または auto、デフォルト: 1）')
+    parser.add_argument('--chunks', type=parse_count,
+                       help='長い動画を分割して並列エンコードするセグメント数（数値または auto）')
+    parser.add_argument('--converge', action='store_true',
+                       help='出力が目標サイズを超えた場合にビットレートを補正して自動で再エンコード')
+    parser.add_argument('--max-iterations', type=parse_non_negative, default=3,
+                       help='--converge 時の再エンコード回数の上限（デフォルト: 3）')
+    parser.add_argument('--predict', action='store_true',
+                       help='サンプルの試験エンコードからCRFを予測し、可能なら1-passでエンコード')
+    parser.add_argument('--no-passthrough', action='store_true',
+                       help='映像が目標サイズに収まる場合でもストリームコピーせず常に再エンコード')
+    parser.add_argument('--no-ladder', action='store_true',
+                       help='目標ビットレートに応じた解像度・フレームレートの自動調整を行わない')
+    parser.add_argument('--verify', action='store_true',
+                       help='再エンコードした出力の SSIM / PSNR をサンプル区間で計測して結果に記録')
+    parser.add_argument('--min-ssim', type=float, metavar='SSIM',
+                       help='品質検証で SSIM がこれを下回った場合は解像度を下げて再エンコード（--verify を含む）')
+    parser.add_argument('--verify-samples', type=int, metavar='N',
+                       help=f'品質検証で計測するサンプル区間の数（デフォルト: {VideoCompressor.VERIFY_SAMPLES}）')
+    parser.add_argument('--verify-seconds', type=float, metavar='SEC',
+                       help=f'品質検証の1サンプルの長さ（秒、デフォルト: {VideoCompressor.VERIFY_SAMPLE_SECONDS}）')
+    parser.add_argument('--scratch-dir', metavar='DIR',
+                       help='パスログ・セグメント・書きかけの出力を置く作業ディレクトリ（tmpfs やローカル SSD など）')
+    parser.add_argument('--telemetry-log', metavar='FILE',
+                       help='ffprobe・各パス・コピーなど段階毎の処理時間を JSON Lines で追記するファイル')
+    parser.add_argument('--prometheus-textfile', metavar='FILE',
+                       help='段階・プリセット別の累積値を書き出す Prometheus textfile（.prom）')
+    parser.add_argument('--telemetry-hook', metavar='MODULE:NAME', action='append',
+                       help='計測区間を受け取る独自のフック（複数指定可）')
     
-    args = parser.parse_args()
+    return parser
+
+def run_cli(parser, args):
+    """解析済みの引数に従って VideoCompressor を実行"""
+    compressor = VideoCompressor(args.config, use_probe_cache=not args.no_probe_cache,
+                                 use_output_cache=not args.no_output_cache)
+    if args.scratch_dir:
+        compressor.set_scratch_dir(args.scratch_dir)
+    if args.verify_samples:
+        compressor.verify_samples = args.verify_samples
+    if args.verify_seconds:
+        compressor.verify_seconds = args.verify_seconds
+    if args.telemetry_log or args.prometheus_textfile or args.telemetry_hook:
+        compressor.configure_telemetry(args.telemetry_log, args.prometheus_textfile, args.telemetry_hook)
+    try:
+        dispatch_cli(compressor, parser, args)
+    finally:
+        compressor.telemetry.close()
+
+def dispatch_cli(compressor, parser, args):
+    """キャッシュ操作・プロファイル一覧・各モードの圧縮を実行"""
+    # プローブキャッシュの削除
+    if args.clear_probe_cache:
+        if compressor.probe_cache is not None:
+            compressor.probe_cache.invalidate()
+            print(f"{Colors.GREEN}プローブキャッシュを削除しました{Colors.NC}")
+        return
     
-    compressor = VideoCompressor()
+    # 出力キャッシュの削除・統計表示
+    if args.clear_output_cache or args.cache_stats:
+        if compressor.output_cache is None:
+            print(f"{Colors.YELLOW}出力キャッシュは無効です{Colors.NC}")
+        elif args.clear_output_cache:
+            compressor.output_cache.clear()
+            print(f"{Colors.GREEN}出力キャッシュを削除しました{Colors.NC}")
+        else:
+            stats = compressor.output_cache.stats()
+            lookups = stats['hits'] + stats['misses']
+            hit_rate = stats['hits'] * 100 / lookups if lookups else 0
+            print(f"{Colors.BLUE}出力キャッシュ:{Colors.NC} {compressor.output_cache.cache_dir}")
+            print(f"  件数: {stats['entries']} ({stats['size'] / (1024 * 1024):.1f}MB / "
+                  f"上限 {compressor.output_cache.max_bytes / (1024 * 1024):.0f}MB)")
+            print(f"  ヒット: {stats['hits']} / ミス: {stats['misses']} (ヒット率: {hit_rate:.1f}%)")
+            print(f"  省略したエンコードの出力量: {stats['bytes_saved'] / (1024 * 1024):.1f}MB")
+            print(f"  Pass 1 統計のヒット: {stats['passlog_hits']} / ミス: {stats['passlog_misses']}")
+        return
     
     # プロファイル一覧表示
     if args.list_profiles:
@@ -391,34 +4036,101 @@ def main():
                 size = profile.get('target_size_mb', 'N/A')
                 quality = profile.get('quality_preset', 'N/A')
                 print(f"  {Colors.GREEN}{name}{Colors.NC}: {desc} (サイズ: {size}MB, 品質: {quality})")
-        sys.exit(0)
+        return
     
-    if not args.input_file:
+    if not args.input_file and not args.watch and not args.serve:
         parser.print_help()
         sys.exit(1)
     
     # プロファイル設定の適用
     target_size = args.size
     quality_preset = args.quality
+    default_settings = compressor.config.get('default_settings', {})
+    ladder = default_settings.get('ladder', True)
+    min_bpp = default_settings.get('ladder_min_bpp')
+    min_ssim = args.min_ssim if args.min_ssim is not None else default_settings.get('verify_min_ssim')
+    verify = args.verify or default_settings.get('verify', False)
     
     if args.profile:
         profile_settings = compressor.get_profile_settings(args.profile)
         if profile_settings:
             target_size = profile_settings['target_size_mb']
             quality_preset = profile_settings['quality_preset']
+            ladder = profile_settings['ladder']
+            min_bpp = profile_settings['min_bpp']
             print(f"{Colors.BLUE}プロファイル '{args.profile}' を適用しました{Colors.NC}")
         else:
-            print(f"{Colors.RED}エラー: プロファイル '{args.profile}' が見つかりません{Colors.NC}")
-            print("--list-profiles で利用可能なプロファイルを確認してください")
-            sys.exit(1)
+            raise ProfileNotFoundError(f"プロファイル '{args.profile}' が見つかりません"
+                                       "（--list-profiles で利用可能なプロファイルを確認してください）")
     
+    # 複数プロファイルの同時出力
+    if args.profiles:
+        profile_names = [name.strip() for name in args.profiles.split(',') if name.strip()]
+        compressor.compress_profiles(args.input_file, args.output_dir, profile_names, ladder=not args.no_ladder)
+    # ジョブサーバー
+    elif args.serve:
+        try:
+            parse_listen_address(args.serve)
+        except ValueError as e:
+            parser.error(str(e))
+        compressor.serve(
+            args.serve,
+            args.output_dir,
+            target_size,
+            quality_preset,
+            args.jobs,
+            queue_size=args.queue_size,
+            input_directory=args.input_dir,
+            converge=args.converge,
+            max_iterations=args.max_iterations,
+            predict=args.predict,
+            passthrough=not args.no_passthrough,
+            ladder=ladder and not args.no_ladder,
+            min_bpp=min_bpp,
+            verify=verify,
+            min_ssim=min_ssim
+        )
+    # 監視モード
+    elif args.watch:
+        compressor.watch_directory(
+            args.watch,
+            args.output_dir,
+            target_size,
+            quality_preset,
+            args.jobs,
+            queue_size=args.queue_size,
+            settle_seconds=args.settle_seconds,
+            converge=args.converge,
+            max_iterations=args.max_iterations,
+            predict=args.predict,
+            passthrough=not args.no_passthrough,
+            ladder=ladder and not args.no_ladder,
+            min_bpp=min_bpp,
+            verify=verify,
+            min_ssim=min_ssim
+        )
     # バッチモード
-    if args.batch:
+    elif args.batch:
         compressor.batch_compress(
             args.input_file, 
             args.output_dir, 
             target_size, 
-            quality_preset
+            quality_preset,
+            args.jobs,
+            resume=args.resume,
+            include=args.include,
+            exclude=args.exclude,
+            recursive=not args.no_recursive,
+            under_target=args.under_target,
+            budget_mb=args.budget_mb,
+            converge=args.converge,
+            max_iterations=args.max_iterations,
+            predict=args.predict,
+            passthrough=not args.no_passthrough,
+            ladder=ladder and not args.no_ladder,
+            min_bpp=min_bpp,
+            verify=verify,
+            min_ssim=min_ssim
         )
     else:
         # 単一ファイルモード
@@ -429,7 +4141,35 @@ def main():
             args.output_file = f"{stem}_compressed.mp4"
         
         # 圧縮実行
-        compressor.compress_video(args.input_file, args.output_file, target_size, quality_preset)
+        compressor.compress_video(args.input_file, args.output_file, target_size, quality_preset,
+                                  chunks=args.chunks, converge=args.converge,
+                                  max_iterations=args.max_iterations, predict=args.predict,
+                                  passthrough=not args.no_passthrough,
+                                  ladder=ladder and not args.no_ladder, min_bpp=min_bpp,
+                                  verify=verify, min_ssim=min_ssim)
+
+def main():
+    # SIGTERMでも一時ファイルの後片付けが行われるように SystemExit に変換
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    
+    parser = build_parser()
+    args = parser.parse_args()
+    
+    try:
+        run_cli(parser, args)
+    except FFmpegNotFoundError as e:
+        print(f"{Colors.RED}エラー: {e}{Colors.NC}")
+        print("以下のコマンドでインストールしてください:")
+        print("  macOS: brew install ffmpeg")
+        print("  Ubuntu: sudo apt install ffmpeg")
+        print("  Windows: https://ffmpeg.org/download.html")
+        sys.exit(1)
+    except CompressionError as e:
+        print(f"{Colors.RED}エラー: {e}{Colors.NC}")
+        details = getattr(e, 'stderr', '')
+        if details:
+            print(f"Error details: {details}")
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
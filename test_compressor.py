@@ -6,9 +6,15 @@
 
 import os
 import sys
+import json
+import re
 import subprocess
+import urllib.error
+import urllib.request
 from pathlib import Path
 import tempfile
+import time
+import signal
 import shutil
 
 class Colors:
@@ -19,21 +25,24 @@ class Colors:
     CYAN = '\033[0;36m'
     NC = '\033[0m'
 
-def run_command(cmd, description):
-    """コマンドを実行してテスト"""
+def run_command(cmd, description, check=None, returncode=0):
+    """コマンドを実行してテスト（check は実行結果を受け取って追加の確認をする関数）"""
     print(f"{Colors.BLUE}テスト: {description}{Colors.NC}")
     print(f"コマンド: {' '.join(cmd)}")
     
     try:
         result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
+        success = result.returncode == returncode and (check is None or bool(check(result)))
+        if success:
             print(f"{Colors.GREEN}✅ 成功{Colors.NC}")
             if result.stdout:
                 print(f"出力: {result.stdout[:200]}...")
         else:
             print(f"{Colors.RED}❌ 失敗{Colors.NC}")
             print(f"エラー: {result.stderr}")
-        return result.returncode == 0
+            if result.stdout:
+                print(f"出力: ...{result.stdout[-500:]}")
+        return success
     except Exception as e:
         print(f"{Colors.RED}❌ 例外発生: {e}{Colors.NC}")
         return False
@@ -58,6 +67,18 @@ def create_test_video():
         print(f"{Colors.RED}❌ テスト動画の作成に失敗しました: {e}{Colors.NC}")
         return None
 
+def create_batch_test_dir(count=2):
+    """バッチテスト用に目標サイズを超える動画を複数作成"""
+    batch_dir = tempfile.mkdtemp(prefix='compressor_batch_test_')
+    for i in range(count):
+        cmd = [
+            'ffmpeg', '-y', '-f', 'lavfi', '-i', f'testsrc2=duration={4 + i * 2}:size=640x360:rate=30',
+            '-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast',
+            os.path.join(batch_dir, f'clip{i}.mp4')
+        ]
+        subprocess.run(cmd, capture_output=True, check=True)
+    return batch_dir
+
 def main():
     print(f"{Colors.CYAN}動画圧縮ツール テストスクリプト{Colors.NC}")
     print("=" * 50)
@@ -70,6 +91,10 @@ def main():
     
     test_results = []
     
+    # キャッシュ（プローブ・圧縮結果）はテスト専用のディレクトリを使う
+    cache_home = tempfile.mkdtemp(prefix='compressor_test_cache_')
+    os.environ['XDG_CACHE_HOME'] = cache_home
+    
     # 1. ヘルプ表示テスト
     success = run_command(
         ['python3', 'compress_video.py', '--help'],
@@ -86,6 +111,18 @@ def main():
     test_results.append(("プロファイル一覧", success))
     print()
     
+    # 壊れた設定ファイルは警告して既定値で続行する
+    bad_config = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    bad_config.write('{not json')
+    bad_config.close()
+    success = run_command(
+        ['python3', 'compress_video.py', '--config', bad_config.name, '--list-profiles'],
+        "壊れた設定ファイル"
+    )
+    os.remove(bad_config.name)
+    test_results.append(("壊れた設定ファイル", success))
+    print()
+    
     # 3. 設定ファイル存在確認
     config_exists = Path("config.json").exists()
     print(f"{Colors.BLUE}テスト: 設定ファイル確認{Colors.NC}")
@@ -112,11 +149,328 @@ def main():
                 if os.path.exists(file):
                     os.remove(file)
             print()
+        
+        # 複数プロファイル同時出力テスト（音声付きの入力でも Pass 1 と Pass 2 のパスログが対応する）
+        profiles_dir = tempfile.mkdtemp(prefix='compressor_profiles_test_')
+        profiles_input = os.path.join(profiles_dir, 'audio.mp4')
+        subprocess.run([
+            'ffmpeg', '-y', '-f', 'lavfi', '-i', 'testsrc2=duration=4:size=640x360:rate=30',
+            '-f', 'lavfi', '-i', 'sine=frequency=1000:duration=4',
+            '-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast', '-c:a', 'aac', '-shortest', profiles_input
+        ], capture_output=True, check=True)
+        profiles_config = os.path.join(profiles_dir, 'config.json')
+        with open(profiles_config, 'w', encoding='utf-8') as f:
+            json.dump({'profiles': {
+                'small': {'target_size_mb': 1, 'quality_preset': 'fast'},
+                'tiny': {'target_size_mb': 0.5, 'quality_preset': 'fast'}
+            }}, f)
+        profiles_output = os.path.join(profiles_dir, 'out')
+        success = run_command(
+            ['python3', 'compress_video.py', profiles_input, '--profiles', 'small,tiny', '-o', profiles_output,
+             '--config', profiles_config],
+            "複数プロファイル (--profiles)",
+            check=lambda result: all(Path(profiles_output, f'audio_{name}.mp4').exists() for name in ('small', 'tiny'))
+        )
+        test_results.append(("複数プロファイル", success))
+        shutil.rmtree(profiles_dir, ignore_errors=True)
+        print()
+        
+        # 並列バッチ圧縮テスト（パスログが衝突しないことも確認）
+        batch_dir = create_batch_test_dir()
+        output_dir = os.path.join(batch_dir, 'out')
+        success = run_command(
+            ['python3', 'compress_video.py', '--batch', batch_dir, '-o', output_dir, '-s', '1', '-j', '2'],
+            "並列バッチ圧縮テスト"
+        )
+        outputs = sorted(Path(output_dir).glob('*_compressed.mp4')) if os.path.isdir(output_dir) else []
+        success = success and len(outputs) == 2 and not Path('ffmpeg2pass-0.log').exists()
+        test_results.append(("並列バッチ", success))
+        print()
+        
+        # 再開テスト（完了済みのファイルは再エンコードされない）
+        success = run_command(
+            ['python3', 'compress_video.py', '--batch', batch_dir, '-o', output_dir, '-s', '1', '--resume'],
+            "バッチ再開 (--resume)",
+            check=lambda result: '全てのファイルが処理済みです' in result.stdout
+        )
+        # 同じ出力先を処理中のプロセスがあれば、実行中のジョブを重複して再実行せずにエラーで終了する
+        holder = subprocess.Popen(
+            ['python3', '-c', 'import time; from compress_video import BatchJournal; '
+             f'journal = BatchJournal({os.path.join(output_dir, ".compress_journal.jsonl")!r}); '
+             'print("locked", flush=True); '
+             'time.sleep(60)'],
+            stdout=subprocess.PIPE, text=True
+        )
+        holder.stdout.readline()
+        success = run_command(
+            ['python3', 'compress_video.py', '--batch', batch_dir, '-o', output_dir, '-s', '1', '--resume'],
+            "バッチ再開（同じ出力先を処理中）",
+            check=lambda result: '別のプロセス' in result.stdout, returncode=1
+        ) and success
+        holder.kill()
+        holder.wait()
+        test_results.append(("バッチ再開", success))
+        print()
+        
+        # 再帰走査テスト（ディレクトリ構成の再現・除外パターン・目標サイズ以下のハードリンク）
+        tree_dir = os.path.join(batch_dir, 'tree')
+        tree_output = os.path.join(batch_dir, 'tree_out')
+        os.makedirs(os.path.join(tree_dir, 'a', 'b'))
+        os.makedirs(os.path.join(tree_dir, 'drafts'))
+        nested = os.path.join(tree_dir, 'a', 'b', 'clip.mp4')
+        shutil.copy(os.path.join(batch_dir, 'clip0.mp4'), nested)
+        shutil.copy(os.path.join(batch_dir, 'clip0.mp4'), os.path.join(tree_dir, 'drafts', 'draft.mp4'))
+        mirrored = Path(tree_output, 'a', 'b', 'clip_compressed.mp4')
+        success = run_command(
+            ['python3', 'compress_video.py', '--batch', tree_dir, '-o', tree_output, '-s', '50',
+             '--exclude', 'drafts', '--under-target', 'link'],
+            "再帰バッチ (--exclude / --under-target link)",
+            check=lambda result: (mirrored.exists() and os.path.samefile(mirrored, nested)
+                                  and not Path(tree_output, 'drafts').exists())
+        )
+        test_results.append(("再帰バッチ", success))
+        print()
+        
+        # 予算配分テスト（複雑度に応じて配分し、出力の合計が予算に収まる）
+        budget_output = os.path.join(batch_dir, 'budget_out')
+        
+        def within_budget(result):
+            outputs = list(Path(budget_output).glob('*_compressed.mp4'))
+            total_mb = sum(path.stat().st_size for path in outputs) / (1024 * 1024)
+            return len(outputs) == 2 and total_mb <= 1.2 and '予算の配分' in result.stdout
+        
+        success = run_command(
+            ['python3', 'compress_video.py', '--batch', batch_dir, '-o', budget_output, '--budget-mb', '1.2',
+             '--no-recursive'],
+            "予算配分 (--budget-mb)",
+            check=within_budget
+        )
+        test_results.append(("予算配分", success))
+        print()
+        
+        # 品質検証テスト（サンプル区間の SSIM / PSNR が計測される）
+        success = run_command(
+            ['python3', 'compress_video.py', os.path.join(batch_dir, 'clip1.mp4'),
+             os.path.join(output_dir, 'verified.mp4'), '-s', '1', '--verify', '--verify-samples', '2'],
+            "品質検証 (--verify)",
+            check=lambda result: '品質検証:' in result.stdout and 'SSIM' in result.stdout
+        )
+        test_results.append(("品質検証", success))
+        print()
+        
+        # サイズ収束テスト（再エンコードしてでも目標サイズに収める）
+        converged = os.path.join(output_dir, 'converged.mp4')
+        success = run_command(
+            ['python3', 'compress_video.py', os.path.join(batch_dir, 'clip1.mp4'), converged, '-s', '1',
+             '--converge', '--max-iterations', '2'],
+            "サイズ収束 (--converge)",
+            check=lambda result: 0 < os.path.getsize(converged) <= 1024 * 1024
+        )
+        test_results.append(("サイズ収束", success))
+        print()
+        
+        # CRF予測テスト（サンプルから予測し、信頼度が低ければ 2-pass に戻る）
+        predicted = os.path.join(output_dir, 'predicted.mp4')
+        success = run_command(
+            ['python3', 'compress_video.py', os.path.join(batch_dir, 'clip1.mp4'), predicted, '-s', '1', '--predict'],
+            "CRF予測 (--predict)",
+            check=lambda result: os.path.exists(predicted) and ('予測CRF:' in result.stdout or '予測の信頼度' in result.stdout)
+        )
+        test_results.append(("CRF予測", success))
+        print()
+        
+        # 解像度ラダーテスト（bits-per-pixel の下限を上げると縮小してエンコードする）
+        ladder_config = os.path.join(batch_dir, 'ladder_config.json')
+        with open(ladder_config, 'w', encoding='utf-8') as f:
+            json.dump({'default_settings': {'ladder_min_bpp': 0.5}}, f)
+        success = run_command(
+            ['python3', 'compress_video.py', os.path.join(batch_dir, 'clip1.mp4'),
+             os.path.join(output_dir, 'ladder.mp4'), '-s', '1', '--config', ladder_config],
+            "解像度ラダー",
+            check=lambda result: '解像度ラダー:' in result.stdout
+        )
+        test_results.append(("解像度ラダー", success))
+        print()
+        
+        # 分割エンコードテスト（セグメント毎に並列で 2-pass し、結合する）
+        chunks_dir = tempfile.mkdtemp(prefix='compressor_chunks_test_')
+        chunks_input = os.path.join(chunks_dir, 'long.mp4')
+        subprocess.run([
+            'ffmpeg', '-y', '-f', 'lavfi', '-i', 'testsrc2=duration=60:size=320x180:rate=30',
+            '-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast', chunks_input
+        ], capture_output=True, check=True)
+        chunks_output = os.path.join(chunks_dir, 'long_out.mp4')
+        success = run_command(
+            ['python3', 'compress_video.py', chunks_input, chunks_output, '-s', '2', '--chunks', '2'],
+            "分割エンコード (--chunks)",
+            check=lambda result: '分割エンコード:' in result.stdout and os.path.getsize(chunks_output) > 0
+        )
+        test_results.append(("分割エンコード", success))
+        shutil.rmtree(chunks_dir, ignore_errors=True)
+        print()
+        
+        # 出力キャッシュテスト（名前を変えた同じ内容の入力はエンコードせずに出力される）
+        renamed = os.path.join(batch_dir, 'renamed.mp4')
+        shutil.copy(os.path.join(batch_dir, 'clip0.mp4'), renamed)
+        success = run_command(
+            ['python3', 'compress_video.py', renamed, os.path.join(output_dir, 'renamed_out.mp4'), '-s', '1'],
+            "出力キャッシュ",
+            check=lambda result: 'キャッシュ済みの圧縮結果を使用します' in result.stdout
+        )
+        test_results.append(("出力キャッシュ", success))
+        print()
+        
+        # パススルーテスト（H.264 + PCM音声は映像を再エンコードせず音声のみ変換）
+        pcm_file = os.path.join(batch_dir, 'pcm.mov')
+        subprocess.run([
+            'ffmpeg', '-y', '-f', 'lavfi', '-i', 'testsrc2=duration=20:size=640x360:rate=30',
+            '-f', 'lavfi', '-i', 'sine=duration=20:sample_rate=48000', '-ac', '2',
+            '-c:v', 'libx264', '-b:v', '1M', '-c:a', 'pcm_s16le', pcm_file
+        ], capture_output=True, check=True)
+        success = run_command(
+            ['python3', 'compress_video.py', pcm_file, os.path.join(output_dir, 'pcm_out.mp4'), '-s', '4'],
+            "パススルー（音声のみ再エンコード）",
+            check=lambda result: '音声のみ再エンコード' in result.stdout and 'Pass 1/2' not in result.stdout
+        )
+        test_results.append(("パススルー", success))
+        print()
+        
+        # テレメトリテスト（段階毎の計測区間が JSON Lines と Prometheus textfile に出力される）
+        telemetry_log = os.path.join(batch_dir, 'telemetry.jsonl')
+        prometheus_file = os.path.join(batch_dir, 'compressor.prom')
+        
+        def telemetry_written(result):
+            with open(telemetry_log, encoding='utf-8') as f:
+                spans = [json.loads(line) for line in f]
+            jobs = [span for span in spans if span['stage'] == 'job']
+            return ([span['stage'] for span in spans] == ['probe', 'passthrough', 'job']
+                    and len(jobs) == 1 and jobs[0]['strategy'] == 'audio' and jobs[0]['cpu_time'] > 0
+                    and all(span['job_id'] == jobs[0]['job_id'] for span in spans)
+                    and 'video_compressor_jobs_total{' in Path(prometheus_file).read_text(encoding='utf-8'))
+        
+        success = run_command(
+            ['python3', 'compress_video.py', pcm_file, os.path.join(output_dir, 'pcm_telemetry.mp4'), '-s', '4',
+             '--no-output-cache', '--telemetry-log', telemetry_log, '--prometheus-textfile', prometheus_file],
+            "テレメトリ (--telemetry-log)",
+            check=telemetry_written
+        )
+        test_results.append(("テレメトリ", success))
+        print()
+        
+        # Python API テスト（非同期で圧縮結果を返し、失敗時は終了せず例外を送出する）
+        api_script = (
+            "import asyncio, sys\n"
+            "from compress_video import compress, InputNotFoundError\n"
+            "async def main():\n"
+            f"    result = await compress({os.path.join(batch_dir, 'clip1.mp4')!r}, "
+            f"{os.path.join(output_dir, 'api_out.mp4')!r}, 1)\n"
+            "    assert result.within_target and result.output_size > 0, result.to_dict()\n"
+            "    try:\n"
+            f"        await compress({os.path.join(batch_dir, 'missing.mp4')!r})\n"
+            "    except InputNotFoundError:\n"
+            "        print('ok')\n"
+            "asyncio.run(main())\n"
+        )
+        success = run_command(['python3', '-c', api_script], "Python API (compress)",
+                              check=lambda result: result.stdout.strip() == 'ok')
+        success = run_command(
+            ['python3', 'compress_video.py', os.path.join(batch_dir, 'missing.mp4')],
+            "存在しない入力ファイル",
+            check=lambda result: 'Traceback' not in result.stderr, returncode=1
+        ) and success
+        test_results.append(("Python API", success))
+        print()
+        
+        # 監視モードテスト（既存ファイルを処理し、SIGINTで正常終了する）
+        print(f"{Colors.BLUE}テスト: 監視モード (--watch){Colors.NC}")
+        watch_output = os.path.join(batch_dir, 'watch_out')
+        process = subprocess.Popen(
+            ['python3', 'compress_video.py', '--watch', batch_dir, '-o', watch_output, '-s', '1',
+             '--settle-seconds', '1'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        expected = Path(watch_output) / 'clip0_compressed.mp4'
+        deadline = time.time() + 120
+        while time.time() < deadline and not expected.exists():
+            time.sleep(1)
+        process.send_signal(signal.SIGINT)
+        success = process.wait(timeout=120) == 0 and expected.exists()
+        print(f"{Colors.GREEN}✅ 成功{Colors.NC}" if success else f"{Colors.RED}❌ 失敗{Colors.NC}")
+        test_results.append(("監視モード", success))
+        print()
+        
+        # ジョブサーバーテスト（ループバックで投入・状態取得・取り消し・メトリクスを確認し、SIGTERMで正常終了する）
+        print(f"{Colors.BLUE}テスト: ジョブサーバー (--serve){Colors.NC}")
+        server_log = os.path.join(batch_dir, 'server.log')
+        with open(server_log, 'w') as log_file:
+            process = subprocess.Popen(
+                ['python3', 'compress_video.py', '--serve', '127.0.0.1:0', '--input-dir', batch_dir,
+                 '-o', os.path.join(batch_dir, 'server_out')],
+                stdout=log_file, stderr=subprocess.STDOUT
+            )
+        try:
+            base_url = None
+            deadline = time.time() + 30
+            while time.time() < deadline and base_url is None:
+                time.sleep(0.2)
+                match = re.search(r'http://[\d.]+:\d+', Path(server_log).read_text(encoding='utf-8'))
+                base_url = match.group(0) if match else None
+            
+            def request(method, path, body=None):
+                data = json.dumps(body).encode('utf-8') if body is not None else None
+                req = urllib.request.Request(base_url + path, data=data, method=method)
+                try:
+                    with urllib.request.urlopen(req, timeout=30) as response:
+                        payload = response.read().decode('utf-8')
+                        status = response.status
+                except urllib.error.HTTPError as e:
+                    payload, status = e.read().decode('utf-8'), e.code
+                return status, json.loads(payload) if payload.startswith('{') else payload
+            
+            status, first = request('POST', '/jobs', {'input_file': 'clip0.mp4', 'target_size_mb': 1})
+            # 取り消すジョブは出力キャッシュに当たらない目標サイズにして、ffmpeg を起動せずに完了しないようにする
+            _, second = request('POST', '/jobs', {'input_file': 'clip1.mp4', 'target_size_mb': 0.9})
+            cancel_status, _ = request('DELETE', f"/jobs/{second['id']}")
+            invalid_status, _ = request('POST', '/jobs', {'input_file': 'clip0.mp4', 'target_size_mb': 'big'})
+            # 入力・出力ディレクトリの外や動画以外のファイルは受け付けない
+            Path(batch_dir, 'secret.txt').write_text('SECRET', encoding='utf-8')
+            Path(batch_dir, 'secret.mp4').write_text('SECRET', encoding='utf-8')
+            escape_statuses = [request('POST', '/jobs', {'input_file': 'clip0.mp4', 'output_file': output_file})[0]
+                               for output_file in ('../escape.mp4', os.path.join(batch_dir, 'escape.mp4'))]
+            escape_statuses += [request('POST', '/jobs', {'input_file': input_file})[0]
+                                for input_file in (os.path.join(batch_dir, 'clip0.mp4'), '../clip0.mp4',
+                                                   'secret.txt', 'secret.mp4')]
+            deadline = time.time() + 120
+            jobs = {}
+            while time.time() < deadline:
+                jobs = {job['id']: job['state'] for job in request('GET', '/jobs')[1]['jobs']}
+                if jobs.get(first['id']) == 'done' and jobs.get(second['id']) == 'cancelled':
+                    break
+                time.sleep(1)
+            result_status, job_result = request('GET', f"/jobs/{first['id']}/result")
+            _, metrics = request('GET', '/metrics')
+            success = (status == 202 and cancel_status == 200 and invalid_status == 400
+                       and escape_statuses == [400] * 6 and not os.path.exists(os.path.join(batch_dir, 'escape.mp4'))
+                       and jobs.get(first['id']) == 'done' and jobs.get(second['id']) == 'cancelled'
+                       and result_status == 200 and os.path.exists(job_result['output_file'])
+                       and 'video_compressor_server_jobs_total{event="cancelled"} 1' in metrics)
+        except Exception as e:
+            print(f"エラー: {e}")
+            success = False
+        finally:
+            process.send_signal(signal.SIGTERM)
+        success = process.wait(timeout=120) == 0 and success
+        print(f"{Colors.GREEN}✅ 成功{Colors.NC}" if success else f"{Colors.RED}❌ 失敗{Colors.NC}")
+        test_results.append(("ジョブサーバー", success))
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        print()
     else:
         print(f"{Colors.YELLOW}⚠️  ffmpegが見つからないため、動画圧縮テストはスキップします{Colors.NC}")
         test_results.append(("動画圧縮", False))
         print()
     
+    shutil.rmtree(cache_home, ignore_errors=True)
+    
     # テスト結果サマリー
     print(f"{Colors.CYAN}テスト結果サマリー{Colors.NC}")
     print("=" * 50)